@@ -35,8 +35,10 @@ def upload_files_to_blob():
         print(f"{blob_name} isimli blob basariyla yuklendi")
     print("Butun Dosyalar Basariyla Yuklendi")
 
-schedule.every().day.at("21:00").do(upload_files_to_blob)
+# Only when run as a script, importing the module must not start the polling loop
+if __name__ == "__main__":
+    schedule.every().day.at("21:00").do(upload_files_to_blob)
 
-while True:
-    schedule.run_pending()
-    time.sleep(1)
\ No newline at end of file
+    while True:
+        schedule.run_pending()
+        time.sleep(1)
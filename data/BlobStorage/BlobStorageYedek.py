@@ -3,7 +3,14 @@ import os
 from chardet import detect
 from fpdf import FPDF
 import json
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import dotenv
+from BlobStorage.contentManifest import ContentManifest, file_hash, hash_metadata_key
+from instrumentation import metrics
+from documentFormat import isDocumentFile, documentStem, decompress, fromColumnar
 
 
 dotenv.load_dotenv()
@@ -11,9 +18,26 @@ dotenv.load_dotenv()
 # Azure storage baglanti ayalari
 
 connection_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+container_name = os.getenv("AZURE_BLOB_CONTAINER_NAME")
 script_directory= os.path.dirname(os.path.abspath(__file__))
 data_file = os.path.join(script_directory, "DataFiles")
 
+# Concurrent uploads of one batch
+upload_workers = int(os.getenv("UPLOAD_WORKERS", "8"))
+# Files bigger than this are streamed in blocks of this size instead of a single put
+upload_block_size = int(os.getenv("UPLOAD_BLOCK_SIZE", str(4 * 1024 * 1024)))
+
+# Processes rendering pdfs, 1 renders them on the upload threads
+render_workers = int(os.getenv("RENDER_WORKERS", str(os.cpu_count() or 1)))
+
+# upload_batch is called from several fetch threads, only one of them may walk DataFiles at a time
+upload_lock = threading.Lock()
+
+# One client (and its connection pool) for the whole process
+_blob_service_client = None
+_client_lock = threading.Lock()
+_render_pool = None
+
 
 class PDF(FPDF):
     def header(self):
@@ -35,47 +59,199 @@ class PDF(FPDF):
         self.chapter_title(title)
         self.chapter_body(body)
 
+    # One fixed width line per row, much denser than wrapping the pretty printed json
+    def table(self, columns, rows, size=8):
+        self.set_font('Courier', 'B', size)
+        self.cell(0, size * 0.5, columns, 0, 1)
+        self.set_font('Courier', '', size)
+        for row in rows:
+            self.cell(0, size * 0.5, row, 0, 1)
+        self.ln()
+
+    # Header fields as "key: value" lines, the daily analytics and the bars as tables
+    def add_document(self, title, document):
+        self.add_page()
+        self.chapter_title(title)
+        self.set_font('Courier', '', 8)
+        for key, value in document.items():
+            if key != 'Analytics' and not key.startswith('Date: '):
+                self.cell(0, 4, f"{key}: {value}", 0, 1)
+        self.ln()
+
+        daily = document.get('Analytics', {}).get('Daily', {})
+        if daily:
+            names = list(next(iter(daily.values())))
+            self.table("Date       " + " ".join(f"{name:>12}" for name in names),
+                       (f"{date:<10} " + " ".join(format_cell(row.get(name)) for name in names) for date, row in sorted(daily.items())), size=6)
+
+        bars = [(key[len('Date: '):], bar) for key, bar in document.items() if key.startswith('Date: ')]
+        if bars:
+            has_volume = any('Volume' in bar for _, bar in bars)
+            self.table(f"{'Date':<19} {'AnlikDeger':>22}" + (f" {'Volume':>22}" if has_volume else ""),
+                       (f"{date:<19} {str(bar.get('AnlikDeger')):>22}" + (f" {str(bar.get('Volume')):>22}" if has_volume else "") for date, bar in bars))
+
+def format_cell(value):
+    return f"{value:>12.6g}" if isinstance(value, float) else f"{str(value):>12}"
+
 def detect_encoding(file_path):
     with open(file_path, 'rb') as file:
         raw_data = file.read()
     result = detect(raw_data)
     return result['encoding']
 
+# dumpToBlob writes ascii only jsons, only other files go through the (slow) encoding detection
+# Compressed and columnar documents are read back into the per bar layout
+def read_json_file(file_path):
+    with open(file_path, 'rb') as file:
+        raw_data = decompress(file.read(), file_path)
+    if raw_data.isascii():
+        json_data = json.loads(raw_data)
+    else:
+        try:
+            json_data = json.loads(raw_data.decode('utf-8'))
+        except UnicodeDecodeError:
+            json_data = json.loads(raw_data.decode(detect(raw_data)['encoding'] or 'utf-8', errors='replace'))
+    if isinstance(json_data, list):
+        return [fromColumnar(document) if isinstance(document, dict) else document for document in json_data]
+    return json_data
+
+# Returns the number of pages written
 def file_to_pdf(file_path, pdf_path):
     pdf = PDF()
-    encoding = detect_encoding(file_path)
-
-    with open(file_path, 'r', encoding=encoding, errors='replace') as file:
-        json_data = json.load(file)
+    json_data = read_json_file(file_path)
+    title = documentStem(file_path) + ".json"
 
-    json_str = json.dumps(json_data, indent=4)
-    pdf.add_content(os.path.basename(file_path), json_str)
+    if isinstance(json_data, list) and len(json_data) == 1 and isinstance(json_data[0], dict):
+        pdf.add_document(title, json_data[0])
+    else:
+        pdf.add_content(title, json.dumps(json_data, indent=4))
 
     pdf.output(pdf_path, 'F')
+    return pdf.page_no()
+
+# file_to_pdf in a render worker process, returns (pages, seconds)
+def render_file(file_path, pdf_path):
+    start = time.perf_counter()
+    pages = file_to_pdf(file_path, pdf_path)
+    return pages, time.perf_counter() - start
+
+# Worker processes shared by every batch of the process, None when rendering on the upload threads
+# Spawned rather than forked, the fetch threads may hold locks while a batch starts
+def get_render_pool():
+    global _render_pool
+    with _client_lock:
+        if _render_pool is None and render_workers > 1:
+            _render_pool = ProcessPoolExecutor(max_workers=render_workers, mp_context=multiprocessing.get_context("spawn"))
+        return _render_pool
+
+def get_blob_service_client():
+    global _blob_service_client
+    with _client_lock:
+        if _blob_service_client is None:
+            _blob_service_client = BlobServiceClient.from_connection_string(
+                connection_string, max_single_put_size=upload_block_size, max_block_size=upload_block_size)
+        return _blob_service_client
 
-def upload_blob(blob_service_client, container_name, local_file_path, target_content_type):
+# Replaces the shared client, ex. with an Azurite connection or a fake client
+def set_blob_service_client(blob_service_client):
+    global _blob_service_client
+    with _client_lock:
+        _blob_service_client = blob_service_client
+
+# Uploads a local file, streaming it in upload_block_size blocks
+# Returns {'name', 'bytes', 'seconds'} of the upload
+def upload_blob(blob_service_client, container_name, local_file_path, target_content_type, metadata=None):
     blob_name = os.path.basename(local_file_path)
     blob_client = blob_service_client.get_blob_client(container=container_name, blob=blob_name)
+    size = os.path.getsize(local_file_path)
 
+    start = time.perf_counter()
     with open(local_file_path, "rb") as data:
         content_settings = ContentSettings(content_type=target_content_type)
-        blob_client.upload_blob(data, overwrite=True, content_settings=content_settings)
+        blob_client.upload_blob(data, length=size, overwrite=True, content_settings=content_settings, metadata=metadata)
+    elapsed = time.perf_counter() - start
+    metrics.addTime('blob.upload', elapsed)
+    metrics.count('blob.bytes', size)
 
-    print(f"{blob_name} isimli blob başarıyla yüklendi")
+    print(f"{blob_name} isimli blob başarıyla yüklendi ({size} bytes, {elapsed:.2f}s)")
+    return {'name': blob_name, 'bytes': size, 'seconds': elapsed}
 
+# 'DataFiles/AAPL.json.gz' -> 'DataFiles/AAPL.pdf'
+def pdf_path_of(local_file_path):
+    return os.path.join(os.path.dirname(local_file_path), documentStem(local_file_path) + ".pdf")
 
-def upload_batch():
+# Content hash of a DataFiles json, None (and the json removed) when it matches the last upload
+def changed_file_hash(local_file_path, manifest):
+    blob_name = documentStem(local_file_path) + ".pdf"
+    content_hash = file_hash(local_file_path)
+    if manifest.unchanged(blob_name, content_hash):
+        metrics.count('blob.unchanged')
+        os.remove(local_file_path)
+        return None
+    return content_hash
 
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    container_client = blob_service_client.get_container_client(container_name)
+# Uploads a rendered pdf with its json's content hash and removes both local files
+def upload_rendered(blob_service_client, local_file_path, local_pdf_path, content_hash, manifest):
+    metrics.count('pdf.bytes', os.path.getsize(local_pdf_path))
+    stats = upload_blob(blob_service_client, container_name, local_pdf_path, "application/pdf", {hash_metadata_key: content_hash})
+    manifest.set(os.path.basename(local_pdf_path), content_hash)
+    os.remove(local_file_path)
+    os.remove(local_pdf_path)
+    return stats
 
-    for file_name in os.listdir(data_file):
-        if file_name.endswith('.json'):
-            local_file_path = os.path.join(data_file, file_name)
-            local_pdf_path = os.path.splitext(local_file_path)[0] + ".pdf"
+# Renders every changed json in DataFiles on the render processes and uploads each pdf as soon as it is ready,
+# with upload_workers threads sharing one client
+# Returns the per-file stats of the successful uploads
+def upload_batch(blob_service_client=None, manifest=None):
+    with upload_lock:
+        blob_service_client = blob_service_client or get_blob_service_client()
+        manifest = manifest or ContentManifest()
+        paths = [os.path.join(data_file, file_name) for file_name in os.listdir(data_file) if isDocumentFile(file_name)]
+        if not paths:
+            return []
 
-        file_to_pdf(local_file_path, local_pdf_path)
-        upload_blob(blob_service_client, container_name, local_pdf_path, "application/pdf")
-        os.remove(local_file_path)
-        os.remove(local_pdf_path)
-    print("All files uploaded successfully")
\ No newline at end of file
+        stats = []
+        start = time.perf_counter()
+        render_pool = get_render_pool()
+        with ThreadPoolExecutor(max_workers=upload_workers, thread_name_prefix="upload") as pool:
+            renders = {}
+            for path in paths:
+                try:
+                    content_hash = changed_file_hash(path, manifest)
+                except Exception as e:
+                    metrics.failure('hash', e, os.path.basename(path))
+                    print(f"{os.path.basename(path)} could not be read: {e}")
+                    continue
+                if content_hash is None:
+                    stats.append({'name': os.path.basename(path), 'bytes': 0, 'seconds': 0.0, 'skipped': True})
+                    continue
+                pdf_path = pdf_path_of(path)
+                renders[(render_pool or pool).submit(render_file, path, pdf_path)] = (path, pdf_path, content_hash)
+
+            uploads = {}
+            for future in as_completed(renders):
+                path, pdf_path, content_hash = renders[future]
+                try:
+                    pages, seconds = future.result()
+                except Exception as e:
+                    metrics.failure('render', e, os.path.basename(path))
+                    print(f"{os.path.basename(path)} could not be rendered: {e}")
+                    continue
+                metrics.addTime('pdf.render', seconds)
+                metrics.count('pdf.pages', pages)
+                uploads[pool.submit(upload_rendered, blob_service_client, path, pdf_path, content_hash, manifest)] = path
+
+            for future, path in uploads.items():
+                try:
+                    stats.append(future.result())
+                except Exception as e:
+                    metrics.failure('upload', e, os.path.basename(path))
+                    print(f"{os.path.basename(path)} could not be uploaded: {e}")
+        elapsed = time.perf_counter() - start
+        metrics.addTime('upload.batch', elapsed)
+        manifest.save()
+
+        total_bytes = sum(stat['bytes'] for stat in stats)
+        skipped = sum(1 for stat in stats if stat.get('skipped'))
+        print(f"All files uploaded successfully ({len(stats) - skipped}/{len(paths)} files, {skipped} unchanged, {total_bytes} bytes, {elapsed:.2f}s)")
+        return stats
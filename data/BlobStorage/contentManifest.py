@@ -0,0 +1,57 @@
+import hashlib
+import json
+import os
+import threading
+from documentFormat import readDocument
+
+
+script_directory = os.path.dirname(os.path.abspath(__file__))
+manifest_path = os.getenv("CONTENT_MANIFEST_PATH", os.path.join(script_directory, "content_manifest.json"))
+
+# Blob metadata key the hash is stored under, read by Indexing/createOrUpdateIndex.py
+hash_metadata_key = "content_hash"
+
+
+# Hash of the normalized document, independent of indentation and key order of the file
+def document_hash(document):
+    normalized = json.dumps(document, sort_keys=True, separators=(',', ':'), ensure_ascii=True)
+    return hashlib.sha256(normalized.encode('ascii')).hexdigest()
+
+# Hash of a dumped file's documents whatever its format / compression, the same document always hashes the same
+def file_hash(file_path):
+    return document_hash(readDocument(file_path))
+
+
+# blob name -> content hash of the document last uploaded under that name
+class ContentManifest:
+    def __init__(self, path=manifest_path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.hashes = {}
+        self.changed = set()
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                self.hashes = json.load(file)
+
+    def unchanged(self, blob_name, content_hash):
+        with self.lock:
+            return self.hashes.get(blob_name) == content_hash
+
+    def set(self, blob_name, content_hash):
+        with self.lock:
+            self.hashes[blob_name] = content_hash
+            self.changed.add(blob_name)
+
+    # Entries set by this instance are written over the file as it is now,
+    # the uploads of another process (a shard worker) saved in the meantime are kept
+    def save(self):
+        hashes = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as file:
+                hashes = json.load(file)
+        with self.lock:
+            hashes.update({blob_name: self.hashes[blob_name] for blob_name in self.changed})
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(hashes, file)
+        os.replace(tmp_path, self.path)
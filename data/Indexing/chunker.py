@@ -0,0 +1,107 @@
+import os
+from datetime import datetime
+from Indexing.createOrUpdateIndex import sanitize_key
+
+# Splits a symbol's price history into time windowed search documents with summary statistics,
+# so a question about one week only retrieves that week instead of the whole history
+
+windows = ("week", "month")
+
+
+# 'YYYY-mm-dd...' -> first day of its window
+def window_start(date, window):
+    if window == "month":
+        return date[:7] + "-01"
+    day = datetime.strptime(date[:10], "%Y-%m-%d")
+    year, week, _ = day.isocalendar()
+    return datetime.fromisocalendar(year, week, 1).strftime("%Y-%m-%d")
+
+# Open/close/min/max, total volume and % change of one window
+# From the window's daily OHLCV rows [(date, row), ...] (Analytics.Daily) when there are any: first open, last close,
+# lowest low and highest high. The bars [(date, bar), ...] are only used without them (currencies, whose AnlikDeger
+# is the day's rate), since a stock's hourly AnlikDeger is the hour's opening price, not its high, low or close
+def window_statistics(bars, daily=()):
+    rows = [row for _, row in daily if all(isinstance(row.get(field), float) for field in ("Open", "High", "Low", "Close"))]
+    if rows:
+        first, last = rows[0]["Open"], rows[-1]["Close"]
+        volumes = [row["Volume"] for row in rows if isinstance(row.get("Volume"), float)]
+        return {
+            "open": first,
+            "close": last,
+            "min": min(row["Low"] for row in rows),
+            "max": max(row["High"] for row in rows),
+            "volume": float(sum(volumes)) if volumes else None,
+            "change_pct": round((last - first) / first * 100, 4) if first else None,
+        }
+    values = [bar.get("AnlikDeger") for _, bar in bars if bar.get("AnlikDeger") is not None]
+    volumes = [bar.get("Volume") for _, bar in bars if bar.get("Volume") is not None]
+    if not values:
+        return {"open": None, "close": None, "min": None, "max": None, "volume": None, "change_pct": None}
+    first, last = float(values[0]), float(values[-1])
+    return {
+        "open": first,
+        "close": last,
+        "min": min(float(value) for value in values),
+        "max": max(float(value) for value in values),
+        "volume": float(sum(volumes)) if volumes else None,
+        "change_pct": round((last - first) / first * 100, 4) if first else None,
+    }
+
+# "date | Close | Return | SMA20..." lines of the precomputed daily analytics rows [(date, row), ...]
+def analytics_lines(rows):
+    if not rows:
+        return []
+    columns = list(rows[0][1])
+    lines = ["Date | " + " | ".join(columns)]
+    for date, row in rows:
+        lines.append(" | ".join([date] + [f"{row[column]:.6g}" if isinstance(row.get(column), float) else str(row.get(column)) for column in columns]))
+    return lines
+
+def render_chunk(header, window, start, end, statistics, bars, daily=()):
+    lines = [f"{key}: {value}" for key, value in header.items()]
+    lines.append(f"{window.capitalize()} {start} - {end}")
+    lines.append(", ".join(f"{key}: {value}" for key, value in statistics.items() if value is not None))
+    lines.extend(analytics_lines(daily))
+    has_volume = any("Volume" in bar for _, bar in bars)
+    lines.append("Date | AnlikDeger | Volume" if has_volume else "Date | AnlikDeger")
+    for date, bar in bars:
+        line = [date, str(bar.get("AnlikDeger"))]
+        if has_volume:
+            line.append(str(bar.get("Volume")))
+        lines.append(" | ".join(line))
+    return "\n".join(lines)
+
+# Search documents of a fetched json document ([{...}] as written by fetch.dumpToBlob), one per window
+def chunk_document(file_name, document, window="week"):
+    if window not in windows:
+        raise ValueError(f"window must be one of {windows}, got {window}")
+    if isinstance(document, list):
+        document = document[0]
+    header = {key: value for key, value in document.items() if not key.startswith("Date: ") and key != "Analytics"}
+    bars = sorted((key[len("Date: "):], value) for key, value in document.items() if key.startswith("Date: "))
+    daily = sorted(document.get("Analytics", {}).get("Daily", {}).items())
+
+    groups = {}
+    for date, bar in bars:
+        groups.setdefault(window_start(date, window), []).append((date, bar))
+
+    stem = os.path.splitext(file_name)[0]
+    chunks = []
+    for start, window_bars in groups.items():
+        end = window_bars[-1][0]
+        window_daily = [(date, row) for date, row in daily if window_start(date, window) == start]
+        statistics = window_statistics(window_bars, window_daily)
+        chunks.append({
+            "id": sanitize_key(f"{stem}_{window}_{start}"),
+            "content": render_chunk(header, window, start, end, statistics, window_bars, window_daily),
+            "symbol": header.get("Symbol"),
+            "name": header.get("Name"),
+            "type": header.get("Type"),
+            "index": header.get("Index"),
+            "exchange": header.get("StockExchange"),
+            "window": window,
+            "start": window_bars[0][0],
+            "end": end,
+            **statistics,
+        })
+    return chunks
@@ -1,6 +1,9 @@
 import re
 import os
+import sys
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 from dotenv import load_dotenv
 from azure.storage.blob import BlobServiceClient
@@ -10,6 +13,10 @@ from azure.search.documents.indexes.models import SearchIndex, SimpleField, Sear
 from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
 
+# Shared run metrics of fetch.py, also when this file is run on its own
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from instrumentation import metrics
+
 # Load environment variables
 load_dotenv()
 
@@ -21,6 +28,12 @@ azure_blob_container_name = os.getenv("AZURE_BLOB_CONTAINER_NAME")
 azure_document_intelligence_endpoint = os.getenv("AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT")
 azure_document_intelligence_key = os.getenv("AZURE_DOCUMENT_INTELLIGENCE_KEY")
 indexed_files_metadata_path = "indexed_files_metadata.json"
+# Blob metadata key BlobStorage/BlobStorageYedek.py stores the document's content hash under
+content_hash_metadata_key = "content_hash"
+# Changes whenever new data is published to the index, model/responseCache.py drops its answers when it does
+data_version_path = os.getenv("DATA_VERSION_PATH", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data_version.txt"))
+# Concurrent Document Intelligence extractions
+extraction_workers = int(os.getenv("EXTRACTION_WORKERS", "8"))
 
 def load_indexed_files_metadata():
     if os.path.exists(indexed_files_metadata_path):
@@ -29,25 +42,56 @@ def load_indexed_files_metadata():
     return {}
 
 def save_indexed_files_metadata(metadata):
-    with open(indexed_files_metadata_path, "w") as file:
+    tmp_path = indexed_files_metadata_path + ".tmp"
+    with open(tmp_path, "w") as file:
         json.dump(metadata, file)
+    os.replace(tmp_path, indexed_files_metadata_path)
+
+def publish_data_version():
+    tmp_path = data_version_path + ".tmp"
+    with open(tmp_path, "w") as file:
+        file.write(datetime.now().isoformat())
+    os.replace(tmp_path, data_version_path)
 
-def create_or_update_search_index():
-    index_client = SearchIndexClient(endpoint=azure_search_endpoint, credential=AzureKeyCredential(azure_search_key))
+def create_or_update_search_index(index_client=None):
+    index_client = index_client or SearchIndexClient(endpoint=azure_search_endpoint, credential=AzureKeyCredential(azure_search_key))
+    # Structured fields are filled by Indexing/directIngest.py and Indexing/chunker.py, pdf documents only have id and content
     fields = [
         SimpleField(name="id", type="Edm.String", key=True),
-        SearchableField(name="content", type="Edm.String")
+        SearchableField(name="content", type="Edm.String"),
+        SimpleField(name="symbol", type="Edm.String", filterable=True),
+        SearchableField(name="name", type="Edm.String"),
+        SimpleField(name="type", type="Edm.String", filterable=True, facetable=True),
+        SimpleField(name="index", type="Edm.String", filterable=True, facetable=True),
+        SimpleField(name="exchange", type="Edm.String", filterable=True, facetable=True),
+        SimpleField(name="start", type="Edm.String", filterable=True, sortable=True),
+        SimpleField(name="end", type="Edm.String", filterable=True, sortable=True),
+        # Indexing/chunker.py window summaries
+        SimpleField(name="window", type="Edm.String", filterable=True, facetable=True),
+        SimpleField(name="open", type="Edm.Double", filterable=True, sortable=True),
+        SimpleField(name="close", type="Edm.Double", filterable=True, sortable=True),
+        SimpleField(name="min", type="Edm.Double", filterable=True, sortable=True),
+        SimpleField(name="max", type="Edm.Double", filterable=True, sortable=True),
+        SimpleField(name="volume", type="Edm.Double", filterable=True, sortable=True),
+        SimpleField(name="change_pct", type="Edm.Double", filterable=True, sortable=True)
     ]
     index = SearchIndex(name=azure_search_index, fields=fields)
     index_client.create_or_update_index(index)
 
-def extract_text_from_file(blob_service_client, container_name, blob_name):
-    document_analysis_client = DocumentAnalysisClient(endpoint=azure_document_intelligence_endpoint, credential=AzureKeyCredential(azure_document_intelligence_key))
+def get_document_analysis_client():
+    return DocumentAnalysisClient(endpoint=azure_document_intelligence_endpoint, credential=AzureKeyCredential(azure_document_intelligence_key))
+
+def extract_text_from_file(blob_service_client, container_name, blob_name, document_analysis_client=None):
+    document_analysis_client = document_analysis_client or get_document_analysis_client()
     blob_client = blob_service_client.get_blob_client(container=container_name, blob=blob_name)
-    file_content = blob_client.download_blob().readall()
+    with metrics.timer("blob.download"):
+        file_content = blob_client.download_blob().readall()
+    metrics.count("ocr.bytes", len(file_content))
     
-    poller = document_analysis_client.begin_analyze_document(model_id="prebuilt-receipt", document=file_content)
-    result = poller.result()
+    with metrics.timer("ocr.extract"):
+        poller = document_analysis_client.begin_analyze_document(model_id="prebuilt-receipt", document=file_content)
+        result = poller.result()
+    metrics.count("ocr.pages", len(result.pages))
 
     text = ""
     for page in result.pages:
@@ -55,50 +99,113 @@ def extract_text_from_file(blob_service_client, container_name, blob_name):
             text += line.content + "\n"
     return text
 
+# Version of a blob's content: its content hash, or last modified time for blobs uploaded without one
+def blob_version(blob):
+    metadata = blob.metadata or {}
+    if content_hash_metadata_key in metadata:
+        return metadata[content_hash_metadata_key]
+    return blob.last_modified.strftime("%Y-%m-%dT%H:%M:%S")
+
 def sanitize_key(key):
     sanitized_key = re.sub(r'[^a-zA-Z0-9_-]', '_', key)
     return sanitized_key
 
+# Returns the keys of the documents that were uploaded successfully
 def index_documents(search_client, documents, chunk_size=128):
+    succeeded = []
     for i in range(0, len(documents), chunk_size):
         chunk = documents[i:i + chunk_size]
-        results = search_client.upload_documents(documents=chunk)
+        with metrics.timer("search.upload"):
+            results = search_client.upload_documents(documents=chunk)
         for result in results:
             if result.succeeded:
+                succeeded.append(result.key)
                 print(f"Document {result.key} uploaded to index")
             else:
+                metrics.failure("index", getattr(result, "error_message", None) or "upload rejected", result.key)
                 print(f"Failed to upload document {result.key}")
+    metrics.count("search.documents", len(succeeded))
+    return succeeded
 
-def main():
-    blob_service_client = BlobServiceClient.from_connection_string(azure_storage_connection_string)
-    search_client = SearchClient(endpoint=azure_search_endpoint, index_name=azure_search_index, credential=AzureKeyCredential(azure_search_key))
-
-    create_or_update_search_index()  # Update the index if it exists
-
-    indexed_files_metadata = load_indexed_files_metadata()
-    documents = []
-
-    container_client = blob_service_client.get_container_client(azure_blob_container_name)
-    blobs_list = container_client.list_blobs()
-
-    for blob in blobs_list:
+# Blobs whose content changed since they were last indexed
+def changed_blobs(container_client, indexed_files_metadata):
+    for blob in container_client.list_blobs(include=["metadata"]):
         if blob.name.endswith(".pdf"):
-            last_modified_str = blob.last_modified.strftime("%Y-%m-%dT%H:%M:%S")
-            if blob.name in indexed_files_metadata and indexed_files_metadata[blob.name] == last_modified_str:
+            version = blob_version(blob)
+            if blob.name in indexed_files_metadata and indexed_files_metadata[blob.name] == version:
+                metrics.count("index.unchanged")
                 print(f"Skipping {blob.name}, no changes detected.")
                 continue
+            yield blob, version
+
+def extract_document(blob_service_client, document_analysis_client, blob):
+    pdf_text = extract_text_from_file(blob_service_client, azure_blob_container_name, blob.name, document_analysis_client)
+    return {"id": sanitize_key(blob.name), "content": pdf_text}
+
+# Pipelined indexing: extractions run on `workers` threads sharing one Document Intelligence client,
+# finished documents are uploaded as soon as chunk_size of them are ready and the metadata file is saved after every upload,
+# so at most chunk_size documents plus the extractions in flight are held in memory and a crash only redoes the last batch
+# Returns the number of documents indexed
+def main(blob_service_client=None, search_client=None, document_analysis_client=None, index_client=None, chunk_size=128, workers=extraction_workers):
+    blob_service_client = blob_service_client or BlobServiceClient.from_connection_string(azure_storage_connection_string)
+    search_client = search_client or SearchClient(endpoint=azure_search_endpoint, index_name=azure_search_index, credential=AzureKeyCredential(azure_search_key))
+    document_analysis_client = document_analysis_client or get_document_analysis_client()
 
-            pdf_text = extract_text_from_file(blob_service_client, azure_blob_container_name, blob.name)
-            sanitized_key = sanitize_key(blob.name)
-            documents.append({"id": sanitized_key, "content": pdf_text})
-            indexed_files_metadata[blob.name] = last_modified_str
+    create_or_update_search_index(index_client)  # Update the index if it exists
+
+    indexed_files_metadata = load_indexed_files_metadata()
+    container_client = blob_service_client.get_container_client(azure_blob_container_name)
 
-    if documents:
-        index_documents(search_client, documents)
+    batch = []
+    versions = {}
+    indexed = 0
+
+    def flush():
+        nonlocal batch, indexed
+        succeeded = index_documents(search_client, batch, chunk_size)
+        for key in succeeded:
+            blob_name, version = versions.pop(key)
+            indexed_files_metadata[blob_name] = version
+        versions.clear()
         save_indexed_files_metadata(indexed_files_metadata)
-        print(f"Indexing Completed {azure_search_index}")
+        indexed += len(succeeded)
+        batch = []
+
+    def collect(future, blob, version):
+        try:
+            document = future.result()
+        except Exception as e:
+            metrics.failure("extract", e, blob.name)
+            print(f"Could not extract {blob.name}: {e}")
+            return
+        batch.append(document)
+        versions[document["id"]] = (blob.name, version)
+        if len(batch) >= chunk_size:
+            flush()
+
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="extract") as pool:
+        for blob, version in changed_blobs(container_client, indexed_files_metadata):
+            future = pool.submit(extract_document, blob_service_client, document_analysis_client, blob)
+            in_flight.append((future, blob, version))
+            # keep at most 2 * workers extractions queued, collect whichever finish first
+            while len(in_flight) >= 2 * workers:
+                wait([item[0] for item in in_flight], return_when=FIRST_COMPLETED)
+                for item in [item for item in in_flight if item[0].done()]:
+                    in_flight.remove(item)
+                    collect(*item)
+        while in_flight:
+            collect(*in_flight.popleft())
+
+    if batch:
+        flush()
+
+    if indexed:
+        publish_data_version()
+        print(f"Indexing Completed {azure_search_index}, {indexed} documents")
     else:
         print("No new or updated documents to index.")
+    return indexed
 
 if __name__ == "__main__":
     main()
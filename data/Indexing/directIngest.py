@@ -0,0 +1,124 @@
+import os
+from azure.search.documents import SearchClient
+from azure.core.credentials import AzureKeyCredential
+from Indexing.createOrUpdateIndex import (azure_search_endpoint, azure_search_key, azure_search_index,
+                                          create_or_update_search_index, index_documents, sanitize_key,
+                                          publish_data_version)
+from BlobStorage.contentManifest import ContentManifest, document_hash
+from Indexing.chunker import chunk_document, analytics_lines
+from instrumentation import metrics
+from documentFormat import isDocumentFile, documentStem, readDocument
+
+# Builds search documents straight from the fetched jsons instead of rendering them to pdf,
+# uploading them and reading the text back with Document Intelligence
+
+# 'week' / 'month' splits every symbol into one search document per window, 'none' indexes one document per symbol
+chunk_window = os.getenv("CHUNK_WINDOW", "week")
+
+
+# Compact text of a fetched document: one header line per field, the daily analytics rows,
+# then one "date | value | volume" line per bar
+def render_text(document):
+    header_lines = []
+    bar_lines = []
+    daily = sorted(document.get("Analytics", {}).get("Daily", {}).items())
+    for key, value in document.items():
+        if key == "Analytics":
+            continue
+        if key.startswith("Date: "):
+            bar = [key[len("Date: "):], str(value.get("AnlikDeger"))]
+            if "Volume" in value:
+                bar.append(str(value["Volume"]))
+            bar_lines.append(" | ".join(bar))
+        else:
+            header_lines.append(f"{key}: {value}")
+    columns = "Date | AnlikDeger | Volume" if bar_lines and bar_lines[0].count("|") == 2 else "Date | AnlikDeger"
+    return "\n".join(header_lines + analytics_lines(daily) + [columns] + bar_lines)
+
+# Search document of a fetched json document ([{...}] as written by fetch.dumpToBlob)
+# The id is the one the pdf path gives the same file, so with CHUNK_WINDOW=none switching modes replaces documents
+# instead of duplicating them; window chunks have ids of their own and leave a symbol's pdf document in the index
+def build_index_document(file_name, document):
+    if isinstance(document, list):
+        document = document[0]
+    dates = sorted(key[len("Date: "):] for key in document if key.startswith("Date: "))
+    return {
+        "id": sanitize_key(os.path.splitext(file_name)[0] + ".pdf"),
+        "content": render_text(document),
+        "symbol": document.get("Symbol"),
+        "name": document.get("Name"),
+        "type": document.get("Type"),
+        "index": document.get("Index"),
+        "exchange": document.get("StockExchange"),
+        "start": dates[0] if dates else None,
+        "end": dates[-1] if dates else None,
+    }
+
+# Search documents of one fetched json, one per window or a single one when chunk_window is 'none'
+def index_documents_of(file_name, document, chunk_window=chunk_window):
+    if chunk_window == "none":
+        return [build_index_document(file_name, document)]
+    return chunk_document(file_name, document, chunk_window)
+
+# Indexes the given fetched jsons, chunk_size documents per upload, returns the ids uploaded
+# Documents (or window chunks) whose content hash did not change since they were last indexed are skipped,
+# so with chunking only the windows that received new bars are uploaded again
+# A file is removed once all of its documents are uploaded, files with a failed document are kept for the next run
+def index_files(paths, search_client, manifest, chunk_size=128, chunk_window=chunk_window):
+    documents = []
+    hashes = {}
+    files = {}
+    indexed = []
+
+    def flush():
+        nonlocal documents, hashes, files
+        succeeded = set(index_documents(search_client, documents, chunk_size))
+        for key in succeeded:
+            manifest.set(key, hashes[key])
+            indexed.append(key)
+        manifest.save()
+        for path, ids in files.items():
+            if ids <= succeeded:
+                os.remove(path)
+        documents, hashes, files = [], {}, {}
+
+    for path in paths:
+        file_name = os.path.basename(path)
+        document = readDocument(path)
+
+        # ids are built from 'AAPL.json' whatever the format the file was dumped in
+        with metrics.timer("ingest.render"):
+            file_documents = index_documents_of(documentStem(file_name) + ".json", document, chunk_window)
+        ids = set()
+        for index_document in file_documents:
+            content_hash = document_hash(index_document)
+            if manifest.unchanged(index_document["id"], content_hash):
+                metrics.count("index.unchanged")
+                continue
+            documents.append(index_document)
+            hashes[index_document["id"]] = content_hash
+            ids.add(index_document["id"])
+        # a file with nothing new is already in the index
+        files[path] = ids
+
+        if len(documents) >= chunk_size:
+            flush()
+
+    if files:
+        flush()
+    if indexed:
+        publish_data_version()
+    return indexed
+
+# Indexes every json in data_folder
+def main(data_folder, search_client=None, manifest=None, chunk_size=128, chunk_window=chunk_window):
+    search_client = search_client or SearchClient(endpoint=azure_search_endpoint, index_name=azure_search_index, credential=AzureKeyCredential(azure_search_key))
+    manifest = manifest or ContentManifest(os.path.join(str(data_folder), os.pardir, "indexed_content_manifest.json"))
+    create_or_update_search_index()
+
+    paths = [os.path.join(data_folder, file_name) for file_name in sorted(os.listdir(data_folder)) if isDocumentFile(file_name)]
+    indexed = index_files(paths, search_client, manifest, chunk_size, chunk_window)
+    print(f"Indexing Completed {azure_search_index}, {len(indexed)} documents")
+
+if __name__ == "__main__":
+    main(os.path.join("BlobStorage", "DataFiles"))
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+
+
+# Rolling window (in days) of the moving averages and the volatility
+WINDOW = 20
+
+AGGREGATIONS = {'Open': 'first', 'High': 'max', 'Low': 'min', 'Close': 'last', 'Volume': 'sum'}
+
+
+# Daily OHLCV of every downloaded symbol, resampled in one pass over a panel of the whole group
+# frames -> dict of symbol -> flattened yf.download dataframe (intraday bars)
+# Returns dict of symbol -> {'yyyy-mm-dd': {'Open', 'High', 'Low', 'Close', 'Volume'}}
+def dailyBars(frames):
+    frames = {symbol: df for symbol, df in frames.items() if df is not None and not df.empty}
+    if not frames:
+        return {}
+
+    panels = {}
+    for field, aggregation in AGGREGATIONS.items():
+        columns = {}
+        for symbol, df in frames.items():
+            if field not in df.columns:
+                continue
+            series = df[field]
+            # every symbol is bucketed by its own exchange's local date
+            if series.index.tz is not None:
+                series = series.tz_localize(None)
+            columns[symbol] = series
+        if not columns:
+            continue
+        resampler = pd.DataFrame(columns).sort_index().resample('1D')
+        panels[field] = resampler.sum(min_count=1) if aggregation == 'sum' else getattr(resampler, aggregation)()
+
+    daily = {}
+    if 'Close' not in panels:
+        return daily
+    closes = panels['Close']
+    dates = closes.index.strftime('%Y-%m-%d')
+    for symbol in frames:
+        if symbol not in closes:
+            continue
+        values = {field: panels[field][symbol].to_numpy() for field in AGGREGATIONS if symbol in panels[field]}
+        daily[symbol] = {dates[i]: {field: float(column[i]) for field, column in values.items()}
+                         for i in np.flatnonzero(~np.isnan(values['Close']))}
+    return daily
+
+# Adds returns, SMA / EMA, rolling volatility and drawdown to the daily rows of every document,
+# computed on one date x symbol panel of closes for the whole group, plus the newest row as 'Latest'
+# documents -> dict of symbol -> document dict with 'Analytics': {'Daily': {...}}
+# periods_per_year annualizes the volatility (252 trading days, 365 for cryptos)
+def addIndicators(documents, window=WINDOW, periods_per_year=252):
+    closes = pd.DataFrame({symbol: pd.Series({date: row.get('Close') for date, row in document['Analytics']['Daily'].items()}, dtype=float)
+                           for symbol, document in documents.items() if document.get('Analytics', {}).get('Daily')})
+    if closes.empty:
+        return
+    closes = closes.sort_index()
+    traded = closes.notna()
+    # holidays of one symbol do not break the rolling windows of the others
+    filled = closes.ffill()
+
+    returns = filled.pct_change(fill_method=None)
+    indicators = {
+        'Return': returns,
+        f'SMA{window}': filled.rolling(window, min_periods=window).mean(),
+        f'EMA{window}': filled.ewm(span=window, adjust=False).mean(),
+        f'Volatility{window}': returns.rolling(window, min_periods=window).std() * np.sqrt(periods_per_year),
+        'Drawdown': filled / filled.cummax() - 1,
+    }
+
+    dates = closes.index
+    for symbol in closes.columns:
+        daily = documents[symbol]['Analytics']['Daily']
+        columns = {name: frame[symbol].to_numpy() for name, frame in indicators.items()}
+        rows = np.flatnonzero(traded[symbol].to_numpy())
+        for i in rows:
+            row = daily[dates[i]]
+            for name, column in columns.items():
+                row[name] = None if np.isnan(column[i]) else float(column[i])
+        documents[symbol]['Analytics']['Latest'] = dict(daily[dates[rows[-1]]], Date=dates[rows[-1]])
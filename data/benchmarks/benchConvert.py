@@ -0,0 +1,73 @@
+# Micro-benchmark of the dataframe -> document conversion in fetch.py
+# Run from the data folder: python benchmarks/benchConvert.py [--bars 10000] [--symbols 800]
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fetch import frameToBars
+
+
+# Hourly OHLCV frame shaped like a flattened yf.download result
+def syntheticFrame(bars, seed):
+    rng = np.random.default_rng(seed)
+    index = pd.date_range("2024-07-17 09:30", periods=bars, freq="h", tz="America/New_York")
+    close = 100 + rng.standard_normal(bars).cumsum()
+    return pd.DataFrame({
+        "Open": close + rng.standard_normal(bars) * 0.1,
+        "High": close + 1,
+        "Low": close - 1,
+        "Close": close,
+        "Adj Close": close,
+        "Volume": rng.integers(1_000, 1_000_000, bars),
+    }, index=index)
+
+# The conversion getStocks used before: to_dict, strftime per timestamp per column, then per-bar dict copies
+def legacyBars(df, symbol):
+    our_dict = df.to_dict()
+    to_json = {'Name': symbol}
+    for title in our_dict.keys():
+        to_json[title] = {}
+        for key in our_dict[title].keys():
+            to_json[title][key.strftime("%Y-%m-%d %H:%M:%S")] = our_dict[title][key]
+    new_json = [{}]
+    for key in to_json['Open'].keys():
+        temp1 = {}
+        temp2 = {}
+        temp2['AnlikDeger'] = to_json['Open'][key]
+        temp2['Volume'] = to_json['Volume'][key]
+        temp1['Date: ' + key] = temp2.copy()
+        new_json[0].update(temp1.copy())
+    return new_json[0]
+
+def run(name, convert, frames):
+    start = time.perf_counter()
+    total = 0
+    for symbol, df in frames:
+        total += len(convert(df, symbol))
+    elapsed = time.perf_counter() - start
+    print(f"{name:<12} {len(frames):>5} symbols {total:>10} bars {elapsed:>8.2f}s {total / elapsed:>12,.0f} bars/s")
+    return total / elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bars", type=int, default=10_000)
+    parser.add_argument("--symbols", type=int, default=800)
+    # the old path is slow, its throughput is measured on a subset of the symbols
+    parser.add_argument("--legacy-symbols", type=int, default=50)
+    args = parser.parse_args()
+
+    frames = [(f"SYM{i}", syntheticFrame(args.bars, i)) for i in range(args.symbols)]
+
+    # both paths must produce the same bars
+    assert legacyBars(frames[0][1], frames[0][0]) == frameToBars(frames[0][1])
+
+    legacy = run("legacy", legacyBars, frames[:args.legacy_symbols])
+    vectorized = run("vectorized", lambda df, symbol: frameToBars(df), frames)
+    print(f"speedup x{vectorized / legacy:.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# Compares the pdf -> Document Intelligence ingestion path with Indexing/directIngest.py
+# The pdf path runs createOrUpdateIndex.extract_text_from_file on fakes.py's blob storage and Document Intelligence,
+# which has a fixed latency per document
+# Run from the data folder: python benchmarks/benchIngest.py [--documents 200] [--bars 1500] [--ocr-latency 2.0]
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from BlobStorage.BlobStorageYedek import file_to_pdf
+from Indexing.createOrUpdateIndex import extract_text_from_file
+from Indexing.directIngest import build_index_document
+from fakes import FakeBlobServiceClient, FakeOcrClient
+
+
+def syntheticDocument(i, bars):
+    document = {'Name': f'Company {i}', 'Symbol': f'SYM{i}', 'Type': 'Stock', 'Index': 'S&P 500',
+                'StockExchange': 'New York Stock Exchange / NASDAQ'}
+    for bar in range(bars):
+        document[f'Date: 2024-07-{17 + bar // 1000:02d} {bar // 60 % 24:02d}:{bar % 60:02d}:00'] = {'AnlikDeger': 100.0 + bar * 0.01, 'Volume': 1000 + bar}
+    return [document]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, default=200)
+    parser.add_argument("--bars", type=int, default=1500)
+    parser.add_argument("--ocr-latency", type=float, default=2.0)
+    args = parser.parse_args()
+
+    ocr = FakeOcrClient(args.ocr_latency)
+    blob_service = FakeBlobServiceClient(latency=0.0)
+    with tempfile.TemporaryDirectory() as folder:
+        paths = []
+        for i in range(args.documents):
+            path = os.path.join(folder, f"Company {i}.json")
+            with open(path, 'w') as file:
+                json.dump(syntheticDocument(i, args.bars), file, indent=2)
+            paths.append(path)
+
+        start = time.perf_counter()
+        pdf_bytes = 0
+        for path in paths:
+            pdf_path = os.path.splitext(path)[0] + ".pdf"
+            file_to_pdf(path, pdf_path)
+            with open(pdf_path, 'rb') as file:
+                data = file.read()
+            pdf_bytes += len(data)
+            blob_name = os.path.basename(pdf_path)
+            blob_service.get_blob_client(blob=blob_name).upload_blob(data)
+            extract_text_from_file(blob_service, "bench", blob_name, ocr)
+        pdf_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        content_bytes = 0
+        for path in paths:
+            with open(path, 'r') as file:
+                document = build_index_document(os.path.basename(path), json.load(file))
+            content_bytes += len(document['content'])
+        direct_elapsed = time.perf_counter() - start
+
+    print(f"pdf + ocr  {args.documents:>5} documents {pdf_elapsed:>8.2f}s {args.documents / pdf_elapsed:>8.1f} docs/s {pdf_bytes:>12} pdf bytes")
+    print(f"direct     {args.documents:>5} documents {direct_elapsed:>8.2f}s {args.documents / direct_elapsed:>8.1f} docs/s {content_bytes:>12} content bytes")
+    print(f"speedup x{pdf_elapsed / direct_elapsed:.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# End to end benchmark of the pipeline without network or Azure: yf.download, EVDS, Blob Storage, Document Intelligence,
+# Search and Azure OpenAI are replaced by the deterministic fakes in fakes.py / evdsStandIn.py
+# Times getStocks, getCurrency, upload_batch, createOrUpdateIndex.main and the rag.py request path per universe size
+# Run from the data folder: python benchmarks/benchPipeline.py [--sizes 100,1000,10000] [--days 10] [--output results.json] [--baseline previous.json]
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+data_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, data_directory)
+sys.path.insert(0, os.path.join(data_directory, "model"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Every run works in its own temporary folder, nothing is written next to the real data
+os.environ["INGEST_MODE"] = "direct"
+os.environ["DATA_VERSION_PATH"] = "data_version.txt"
+os.environ.setdefault("AZURE_OAI_KEY", "benchmark")
+os.environ.setdefault("AZURE_OAI_ENDPOINT", "https://localhost")
+
+import fetch
+import deltaFetch as delta
+import BlobStorage.BlobStorageYedek as blob
+import Indexing.createOrUpdateIndex as create_index
+from BlobStorage.contentManifest import ContentManifest
+from fetchEngine import FetchEngine
+from snapshotStore import SnapshotStore
+from fakes import FakeYahoo, FakeBlobServiceClient, FakeOcrClient, FakeSearchClient, FakeIndexClient, FakeCompletionClient
+import evdsStandIn
+
+
+def timed(results, name, fn, *args, **kwargs):
+    start = time.perf_counter()
+    value = fn(*args, **kwargs)
+    results[name] = round(time.perf_counter() - start, 3)
+    return value
+
+# Questions of the rag path: numeric ones the router answers, open ones that go to the model, each asked twice for the cache
+def questions(symbols, count):
+    asked = []
+    for i in range(count // 2):
+        symbol = symbols[i * 7 % len(symbols)]
+        asked.append([f"{symbol} price", f"% change of {symbol} this week", f"why did {symbol} move and what happened to it?"][i % 3])
+    return asked + asked
+
+def runSize(size, args):
+    import rag
+    from localRetrieval import LocalIndex
+    from queryRouter import QueryRouter
+    from responseCache import ResponseCache
+
+    results = {"symbols": size}
+    yahoo = FakeYahoo(args.yahoo_latency)
+    blob_service_client = FakeBlobServiceClient(args.blob_latency)
+    ocr = FakeOcrClient(args.ocr_latency)
+    search = FakeSearchClient(args.search_latency)
+    completions = FakeCompletionClient(args.completion_latency)
+    fetch.yf.download = yahoo.download
+    blob.set_blob_service_client(blob_service_client)
+
+    series = max(10, size // 25)
+    server, _ = evdsStandIn.serve(evdsStandIn.syntheticFixture(series, start="01-01-2024", days=400))
+    fetch.EVDS_URL = f"http://127.0.0.1:{server.server_port}"
+
+    start_date = fetch.START_DATE
+    today = (fetch.pd.Timestamp(start_date) + fetch.pd.Timedelta(days=args.days)).strftime("%Y-%m-%d")
+    today_tr = fetch.pd.Timestamp(today).strftime("%d-%m-%Y")
+    symbols = [f"SYM{i}" for i in range(size)]
+    names = [f"Company {i}" for i in range(size)]
+
+    with tempfile.TemporaryDirectory() as folder:
+        # the pipeline's relative default paths (BlobStorage/History, watermarks...) all land in the temporary folder
+        os.chdir(folder)
+        try:
+            data_folder = os.path.join(folder, "BlobStorage", "DataFiles")
+            os.makedirs(data_folder)
+            blob.data_file = data_folder
+            watermarks = delta.Watermarks()
+            snapshots = SnapshotStore()
+
+            with FetchEngine(max_workers=args.workers, rate_limits={}) as engine:
+                timed(results, "getStocks", fetch.getStocks, symbols, names, data_folder, today, "S&P 500",
+                      engine=engine, watermarks=watermarks, snapshots=snapshots)
+                timed(results, "getCurrency", fetch.getCurrency, data_folder, today_tr, engine, watermarks, False, snapshots)
+            server.shutdown()
+            results["yahoo_requests"] = yahoo.requests
+            results["json_files"] = len(os.listdir(data_folder))
+
+            stats = timed(results, "upload_batch", blob.upload_batch, blob_service_client, ContentManifest(os.path.join(folder, "content_manifest.json")))
+            results["uploaded_bytes"] = sum(stat["bytes"] for stat in stats)
+            timed(results, "createOrUpdateIndex", create_index.main, blob_service_client, search, ocr, FakeIndexClient(), workers=args.workers)
+            results["indexed_documents"] = len(search.documents)
+
+            retriever = timed(results, "rag_index", LocalIndex.from_folder, delta.HISTORY_FOLDER)
+            router = QueryRouter(snapshots)
+            cache = ResponseCache(version_path=os.path.join(folder, "data_version.txt"))
+            asked = questions(symbols, args.questions)
+            timed(results, "rag_requests", lambda: [rag.ask(text, completions, cache, retriever, router) for text in asked])
+            results["rag_questions"] = len(asked)
+            results["rag_model_calls"] = completions.requests
+        finally:
+            os.chdir(data_directory)
+    return results
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=data_directory, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="100,1000,10000")
+    parser.add_argument("--days", type=int, default=10, help="days of hourly bars per symbol")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--questions", type=int, default=100)
+    parser.add_argument("--yahoo-latency", type=float, default=0.05)
+    parser.add_argument("--blob-latency", type=float, default=0.005)
+    parser.add_argument("--ocr-latency", type=float, default=0.02)
+    parser.add_argument("--search-latency", type=float, default=0.01)
+    parser.add_argument("--completion-latency", type=float, default=0.2)
+    parser.add_argument("--output", help="write the results as json")
+    parser.add_argument("--baseline", help="results json of an earlier run to compare with")
+    args = parser.parse_args()
+
+    report = {"commit": gitCommit(), "python": platform.python_version(), "settings": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")}, "sizes": {}}
+    for size in [int(size) for size in args.sizes.split(",")]:
+        report["sizes"][str(size)] = runSize(size, args)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)["sizes"]
+
+    stages = ["getStocks", "getCurrency", "upload_batch", "createOrUpdateIndex", "rag_index", "rag_requests"]
+    print(f"{'symbols':>8} " + " ".join(f"{stage:>20}" for stage in stages))
+    for size, results in report["sizes"].items():
+        cells = []
+        for stage in stages:
+            cell = f"{results[stage]:.2f}s"
+            if baseline and size in baseline and baseline[size].get(stage):
+                cell += f" ({results[stage] / baseline[size][stage]:.2f}x)"
+            cells.append(f"{cell:>20}")
+        print(f"{size:>8} " + " ".join(cells))
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# Pdf rendering of the DataFiles jsons: the old pretty printed json path against the table layout, serially and on the render processes
+# Run from the data folder: python benchmarks/benchRender.py [--documents 300] [--bars 1500] [--workers 8]
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from BlobStorage.BlobStorageYedek import PDF, detect_encoding, render_file
+from benchIngest import syntheticDocument
+
+
+# The rendering upload_batch used before: chardet over the whole file, json re-dumped with indent=4, one multi_cell
+def legacyRender(file_path, pdf_path):
+    start = time.perf_counter()
+    pdf = PDF()
+    encoding = detect_encoding(file_path)
+    with open(file_path, 'r', encoding=encoding, errors='replace') as file:
+        json_data = json.load(file)
+    pdf.add_content(os.path.basename(file_path), json.dumps(json_data, indent=4))
+    pdf.output(pdf_path, 'F')
+    return pdf.page_no(), time.perf_counter() - start
+
+def run(name, jobs, render, pool=None):
+    start = time.perf_counter()
+    if pool is None:
+        pages = sum(render(path, pdf_path)[0] for path, pdf_path in jobs)
+    else:
+        pages = sum(result[0] for result in pool.map(render, *zip(*jobs)))
+    elapsed = time.perf_counter() - start
+    size = sum(os.path.getsize(pdf_path) for _, pdf_path in jobs)
+    print(f"{name:<18} {len(jobs):>5} documents {elapsed:>8.2f}s {len(jobs) / elapsed:>8.1f} docs/s {pages:>7} pages {pages / elapsed:>9.1f} pages/s {size:>12} bytes")
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, default=300)
+    parser.add_argument("--bars", type=int, default=1500)
+    # the old path is slow, it is measured on a subset of the documents
+    parser.add_argument("--legacy-documents", type=int, default=30)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        jobs = []
+        for i in range(args.documents):
+            path = os.path.join(folder, f"Company {i}.json")
+            with open(path, 'w') as file:
+                json.dump(syntheticDocument(i, args.bars), file, ensure_ascii=True, indent=2)
+            jobs.append((path, os.path.splitext(path)[0] + ".pdf"))
+
+        legacy = run("legacy", jobs[:args.legacy_documents], legacyRender) / args.legacy_documents
+        serial = run("table", jobs, render_file) / args.documents
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            # workers are started before timing, upload_batch keeps its pool for the whole process
+            list(pool.map(time.sleep, [0] * args.workers))
+            parallel = run(f"table x{args.workers}", jobs, render_file, pool) / args.documents
+    print(f"per document: table x{legacy / serial:.1f}, table on {args.workers} processes x{legacy / parallel:.1f} faster than legacy")
+
+if __name__ == "__main__":
+    main()
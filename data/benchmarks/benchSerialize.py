@@ -0,0 +1,48 @@
+# Size, dump and parse time of the DataFiles documents in every format / compression of documentFormat.py
+# against the previous indent=2 simplejson dumps
+# Run from the data folder: python benchmarks/benchSerialize.py [--documents 200] [--bars 1500]
+import argparse
+import os
+import sys
+import time
+import simplejson
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import documentFormat
+from benchIngest import syntheticDocument
+
+
+def run(name, documents, dump, load):
+    start = time.perf_counter()
+    payloads = [dump(document) for document in documents]
+    dumped = time.perf_counter() - start
+    start = time.perf_counter()
+    for payload in payloads:
+        load(payload)
+    loaded = time.perf_counter() - start
+    size = sum(len(payload) for payload in payloads)
+    print(f"{name:<18} {size:>12} bytes {dumped:>8.2f}s dump {loaded:>8.2f}s parse")
+    return size
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, default=200)
+    parser.add_argument("--bars", type=int, default=1500)
+    args = parser.parse_args()
+
+    documents = [syntheticDocument(i, args.bars) for i in range(args.documents)]
+    legacy = run("indent=2 json", documents,
+                 lambda document: simplejson.dumps(document, ensure_ascii=True, indent=2, ignore_nan=True).encode(),
+                 simplejson.loads)
+    compressions = ["none", "gzip"] + (["zstd"] if documentFormat.zstandard is not None else [])
+    for fmt in ("json", "columnar"):
+        for compression in compressions:
+            extension = documentFormat.EXTENSIONS[compression]
+            size = run(f"{fmt} {compression}", documents,
+                       lambda document: documentFormat.dumps(document, fmt, compression),
+                       lambda payload: [documentFormat.fromColumnar(document) for document in documentFormat.decode(documentFormat.decompress(payload, extension))])
+            print(f"{'':<18} x{legacy / size:.1f} smaller")
+
+if __name__ == "__main__":
+    main()
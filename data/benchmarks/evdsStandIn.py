@@ -0,0 +1,101 @@
+# Local stand-in of the EVDS service for running the currency fetch offline
+# Serves a recorded fixture ({"serieList": [...], "items": [...]} as EVDS returned them) or synthetic series,
+# single and multi-series (series=A-B-C) requests are answered like EVDS does
+# Run from the data folder: python benchmarks/evdsStandIn.py [--fixture evds.json] [--series 40] [--port 8765]
+# then EVDS_URL=http://127.0.0.1:8765 python fetch.py
+import argparse
+import json
+import threading
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+
+CURRENCIES = ["USD", "EUR", "GBP", "CHF", "JPY", "SEK", "NOK", "DKK", "CAD", "AUD", "SAR", "KWD", "RUB", "CNY", "RON", "BGN", "IRR", "PKR", "QAR", "KRW"]
+
+
+# Series list and daily items of count synthetic buy / sell series since start
+def syntheticFixture(count=40, start="01-07-2024", days=365, seed=0):
+    rng = np.random.default_rng(seed)
+    serie_list = []
+    for i in range(count):
+        currency = CURRENCIES[i // 2 % len(CURRENCIES)] + (str(i // (2 * len(CURRENCIES))) if i >= 2 * len(CURRENCIES) else "")
+        action, suffix = ("Doviz Alis", "A") if i % 2 == 0 else ("Doviz Satis", "S")
+        serie_list.append({"SERIE_CODE": f"TP.DK.{currency}.{suffix}", "SERIE_NAME": f"({currency}) {currency} Kuru ({action})"})
+
+    first = datetime.strptime(start, "%d-%m-%Y")
+    levels = 10 + rng.random(count) * 30
+    paths = levels * np.exp(np.cumsum(rng.standard_normal((days, count)) * 0.005, axis=0))
+    items = []
+    for day in range(days):
+        date = first + timedelta(days=day)
+        item = {"Tarih": date.strftime("%d-%m-%Y")}
+        for serie, value in zip(serie_list, paths[day]):
+            # weekends have no rates, like EVDS returns them
+            item[serie["SERIE_CODE"].replace(".", "_")] = None if date.weekday() >= 5 else f"{value:.4f}"
+        items.append(item)
+    return {"serieList": serie_list, "items": items}
+
+
+def parameters(path):
+    return dict(part.split("=", 1) for part in path.strip("/").split("&") if "=" in part)
+
+
+def handlerFor(fixture, requests_log):
+    items = [(datetime.strptime(item["Tarih"], "%d-%m-%Y"), item) for item in fixture["items"]]
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_log.append(self.path)
+            if self.path.startswith("/serieList/"):
+                body = fixture["serieList"]
+            elif self.path.startswith("/series="):
+                query = parameters(self.path)
+                columns = [code.replace(".", "_") for code in query["series"].split("-")]
+                start = datetime.strptime(query["startDate"], "%d-%m-%Y")
+                end = datetime.strptime(query["endDate"], "%d-%m-%Y")
+                body = {"totalCount": 0, "items": [
+                    {"Tarih": item["Tarih"], **{column: item.get(column) for column in columns}}
+                    for date, item in items if start <= date <= end
+                ]}
+                body["totalCount"] = len(body["items"])
+            else:
+                self.send_error(404)
+                return
+            payload = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+# Starts the stand-in on a background thread, returns (server, requests_log), server.shutdown() stops it
+def serve(fixture=None, port=0):
+    requests_log = []
+    server = ThreadingHTTPServer(("127.0.0.1", port), handlerFor(fixture or syntheticFixture(), requests_log))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, requests_log
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fixture", help="recorded EVDS responses, synthetic series when omitted")
+    parser.add_argument("--series", type=int, default=40)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    if args.fixture:
+        with open(args.fixture, "r") as file:
+            fixture = json.load(file)
+    else:
+        fixture = syntheticFixture(args.series)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), handlerFor(fixture, []))
+    print(f"EVDS stand-in with {len(fixture['serieList'])} series on http://127.0.0.1:{args.port}")
+    server.serve_forever()
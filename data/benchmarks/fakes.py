@@ -0,0 +1,176 @@
+# Deterministic stand-ins for the services the pipeline talks to, for running it offline
+# Every fake sleeps a configurable latency per call so the results stay comparable to the real services' shape
+import time
+import zlib
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+
+def symbolSeed(symbol):
+    return zlib.crc32(symbol.encode())
+
+
+# yf.download replacement: hourly OHLCV bars of every requested ticker, the same bars for the same ticker and dates
+class FakeYahoo:
+    def __init__(self, latency=0.05, bars_per_day=7):
+        self.latency = latency
+        self.bars_per_day = bars_per_day
+        self.requests = 0
+
+    def frame(self, symbol, index):
+        rng = np.random.default_rng(symbolSeed(symbol))
+        close = 100 + rng.standard_normal(len(index)).cumsum()
+        return pd.DataFrame({
+            "Open": close + rng.standard_normal(len(index)) * 0.1,
+            "High": close + 1,
+            "Low": close - 1,
+            "Close": close,
+            "Adj Close": close,
+            "Volume": rng.integers(1_000, 1_000_000, len(index)).astype(float),
+        }, index=index)
+
+    def download(self, tickers, start=None, end=None, interval="1h", group_by=None, progress=True, **kwargs):
+        self.requests += 1
+        time.sleep(self.latency)
+        days = pd.bdate_range(start, end, inclusive="left")
+        index = pd.DatetimeIndex([day + pd.Timedelta(hours=9, minutes=30) + pd.Timedelta(hours=hour)
+                                  for day in days for hour in range(self.bars_per_day)]).tz_localize("America/New_York")
+        symbols = tickers if isinstance(tickers, list) else [tickers]
+        return pd.concat({symbol: self.frame(symbol, index) for symbol in symbols}, axis=1)
+
+
+# In-memory BlobServiceClient / ContainerClient / BlobClient
+class FakeBlobServiceClient:
+    class Properties:
+        def __init__(self, name, metadata, last_modified):
+            self.name = name
+            self.metadata = metadata
+            self.last_modified = last_modified
+
+    class Download:
+        def __init__(self, data):
+            self.data = data
+
+        def readall(self):
+            return self.data
+
+    class BlobClient:
+        def __init__(self, service, name):
+            self.service = service
+            self.name = name
+
+        def upload_blob(self, data, length=None, overwrite=True, content_settings=None, metadata=None, **kwargs):
+            time.sleep(self.service.latency)
+            content = data.read() if hasattr(data, "read") else data
+            self.service.blobs[self.name] = (content, dict(metadata or {}), datetime.now(timezone.utc))
+            self.service.bytes += len(content)
+
+        def download_blob(self):
+            time.sleep(self.service.latency)
+            return FakeBlobServiceClient.Download(self.service.blobs[self.name][0])
+
+    class ContainerClient:
+        def __init__(self, service):
+            self.service = service
+
+        def get_blob_client(self, blob):
+            return FakeBlobServiceClient.BlobClient(self.service, blob)
+
+        def list_blobs(self, include=None):
+            for name, (_, metadata, last_modified) in sorted(self.service.blobs.items()):
+                yield FakeBlobServiceClient.Properties(name, metadata, last_modified)
+
+    def __init__(self, latency=0.005):
+        self.latency = latency
+        self.blobs = {}
+        self.bytes = 0
+
+    def get_blob_client(self, container=None, blob=None):
+        return self.BlobClient(self, blob)
+
+    def get_container_client(self, container=None):
+        return self.ContainerClient(self)
+
+
+# DocumentAnalysisClient: one page per 4 KB of the document, one line per 80 bytes
+class FakeOcrClient:
+    class Line:
+        def __init__(self, content):
+            self.content = content
+
+    class Page:
+        def __init__(self, lines):
+            self.lines = lines
+
+    class Result:
+        def __init__(self, pages):
+            self.pages = pages
+
+    class Poller:
+        def __init__(self, result):
+            self._result = result
+
+        def result(self):
+            return self._result
+
+    def __init__(self, latency=0.02):
+        self.latency = latency
+        self.documents = 0
+
+    def begin_analyze_document(self, model_id=None, document=None, **kwargs):
+        time.sleep(self.latency)
+        self.documents += 1
+        lines = [self.Line(f"line {i}") for i in range(max(1, len(document) // 80))]
+        return self.Poller(self.Result([self.Page(lines[i:i + 50]) for i in range(0, len(lines), 50)]))
+
+
+# SearchClient and SearchIndexClient
+class FakeSearchClient:
+    class Result:
+        def __init__(self, key):
+            self.key = key
+            self.succeeded = True
+
+    def __init__(self, latency=0.01):
+        self.latency = latency
+        self.documents = {}
+
+    def upload_documents(self, documents):
+        time.sleep(self.latency)
+        for document in documents:
+            self.documents[document["id"]] = document
+        return [self.Result(document["id"]) for document in documents]
+
+
+class FakeIndexClient:
+    def create_or_update_index(self, index):
+        return index
+
+
+# openai chat completions client, answers with a fixed text after latency
+class FakeCompletionClient:
+    class Message:
+        def __init__(self, content):
+            self.content = content
+
+    class Choice:
+        def __init__(self, content):
+            self.message = FakeCompletionClient.Message(content)
+
+    class Response:
+        def __init__(self, content):
+            self.choices = [FakeCompletionClient.Choice(content)]
+
+    def __init__(self, latency=0.2):
+        self.latency = latency
+        self.requests = 0
+        self.chat = self
+        self.completions = self
+
+    def create(self, messages=None, **kwargs):
+        self.requests += 1
+        time.sleep(self.latency)
+        prompt_size = sum(len(message["content"] or "") for message in messages or [])
+        return self.Response(f"Answer based on {prompt_size} characters of context [doc1].")
@@ -0,0 +1,105 @@
+import json
+import os
+import threading
+from pathlib import Path
+import simplejson
+
+
+# Last stored bar of every symbol / currency series
+WATERMARKS_PATH = Path(os.getenv("WATERMARKS_PATH", "BlobStorage/watermarks.json"))
+# Full documents of the previous runs, DataFiles is emptied by upload_batch so they are kept here
+HISTORY_FOLDER = Path(os.getenv("HISTORY_FOLDER", "BlobStorage/History"))
+
+
+# Persistent per-symbol high-water marks ("YYYY-mm-dd HH:MM:SS" or "YYYY-mm-dd" of the newest stored bar)
+# Shared by every fetch thread of a run
+class Watermarks:
+    def __init__(self, path=WATERMARKS_PATH):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.marks = {}
+        if self.path.exists():
+            with open(self.path, "r") as file:
+                self.marks = json.load(file)
+
+    def get(self, symbol):
+        with self.lock:
+            return self.marks.get(symbol)
+
+    def update(self, symbol, last):
+        with self.lock:
+            if symbol not in self.marks or last > self.marks[symbol]:
+                self.marks[symbol] = last
+
+    # Keeps the later watermark of every symbol, ex. the watermarks saved by the shard workers of a run
+    def merge(self, marks):
+        for symbol, last in marks.items():
+            self.update(symbol, last)
+
+    # Earliest date (yyyy-mm-dd) any of the symbols needs, default_start if one of them was never fetched
+    def startDate(self, symbols, default_start):
+        with self.lock:
+            marks = [self.marks.get(symbol) for symbol in symbols]
+        if not marks or None in marks:
+            return default_start
+        return min(marks)[:10]
+
+    def save(self):
+        with self.lock:
+            marks = dict(self.marks)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as file:
+            json.dump(marks, file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def loadHistory(name, history_folder=HISTORY_FOLDER):
+    path = Path(history_folder) / f"{name}.json"
+    if not path.exists():
+        return None
+    with open(path, "r") as file:
+        return json.load(file)
+
+def saveHistory(name, document, history_folder=HISTORY_FOLDER):
+    history_folder = Path(history_folder)
+    history_folder.mkdir(parents=True, exist_ok=True)
+    path = history_folder / f"{name}.json"
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as file:
+        simplejson.dump(document, file, ensure_ascii=True, ignore_nan=True)
+    os.replace(tmp_path, path)
+
+# Merges freshly fetched bars ({'Date: ...': {...}}) of a symbol into its previous document
+# header -> dict with Name, Symbol, Type... fields of the document, its 'Analytics' daily rows are merged the same way
+# Only bars newer than the symbol's watermark are kept, full_backfill replaces the previous document instead
+# save=False leaves writing the history and moving the watermark to the caller (ex. after adding the analytics),
+# it calls advance() once the document is persisted so a failed save or dump is fetched again by the next run
+# Returns the merged document ([{...}] like dumpToBlob expects), None if nothing new was fetched
+def applyDelta(header, bars, symbol, name, watermarks, full_backfill=False, history_folder=HISTORY_FOLDER, save=True):
+    last = None if full_backfill else watermarks.get(symbol)
+    if last is not None:
+        bars = {key: value for key, value in bars.items() if key[len("Date: "):] > last}
+    if not bars:
+        return None
+
+    previous = None if full_backfill else loadHistory(name, history_folder)
+    document = dict(previous[0]) if previous else {}
+    previous_daily = document.get("Analytics", {}).get("Daily", {})
+    document.update(header)
+    document.update(bars)
+    if "Analytics" in header:
+        # the watermark's day is downloaded again in full, so its new daily row replaces the old one
+        document["Analytics"] = {"Daily": {**previous_daily, **header["Analytics"].get("Daily", {})}}
+    if save:
+        saveHistory(name, [document], history_folder)
+        advance(watermarks, symbol, [document])
+    return [document]
+
+# Moves a symbol's watermark to the last bar of its persisted document
+def advance(watermarks, symbol, document):
+    if isinstance(document, list):
+        document = document[0]
+    dates = [key[len("Date: "):] for key in document if key.startswith("Date: ")]
+    if dates:
+        watermarks.update(symbol, max(dates))
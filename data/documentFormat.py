@@ -0,0 +1,137 @@
+import gzip
+import os
+import shutil
+from pathlib import Path
+import simplejson
+
+# orjson / zstandard are optional, simplejson and gzip are used without them
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# 'columnar' stores the bars as parallel arrays ({'Bars': {'Date': [...], 'AnlikDeger': [...], 'Volume': [...]}}),
+# 'json' keeps one {'Date: ...': {'AnlikDeger', 'Volume'}} entry per bar
+DUMP_FORMAT = os.getenv("DUMP_FORMAT", "columnar")
+# 'none', 'gzip' or 'zstd'
+DUMP_COMPRESSION = os.getenv("DUMP_COMPRESSION", "none")
+# How dumpToBlob's second copy in the working directory is made: 'link' (hard link, no second write), 'copy' or 'none'
+DUMP_MIRROR = os.getenv("DUMP_MIRROR", "link")
+
+EXTENSIONS = {"none": ".json", "gzip": ".json.gz", "zstd": ".json.zst"}
+
+
+def isDocumentFile(file_name):
+    return str(file_name).endswith(tuple(EXTENSIONS.values()))
+
+# 'AAPL.json.gz' -> 'AAPL', blob and search document names are built from it whatever the file format
+def documentStem(file_name):
+    name = os.path.basename(str(file_name))
+    for extension in sorted(EXTENSIONS.values(), key=len, reverse=True):
+        if name.endswith(extension):
+            return name[:-len(extension)]
+    return os.path.splitext(name)[0]
+
+# {'Date: ...': {'AnlikDeger', 'Volume'}} bars of a document -> parallel arrays
+def toColumnar(document):
+    columnar = {key: value for key, value in document.items() if not key.startswith("Date: ")}
+    bars = [(key[len("Date: "):], value) for key, value in document.items() if key.startswith("Date: ")]
+    columns = {"Date": [date for date, _ in bars], "AnlikDeger": [bar.get("AnlikDeger") for _, bar in bars]}
+    if any("Volume" in bar for _, bar in bars):
+        columns["Volume"] = [bar.get("Volume") for _, bar in bars]
+    columnar["Bars"] = columns
+    return columnar
+
+# Parallel arrays back to the per bar layout every consumer reads
+def fromColumnar(document):
+    if "Bars" not in document:
+        return document
+    columns = document["Bars"]
+    restored = {key: value for key, value in document.items() if key != "Bars"}
+    volumes = columns.get("Volume")
+    for i, date in enumerate(columns["Date"]):
+        bar = {"AnlikDeger": columns["AnlikDeger"][i]}
+        if volumes is not None:
+            bar["Volume"] = volumes[i]
+        restored[f"Date: {date}"] = bar
+    return restored
+
+# NaN is written as null like the previous simplejson dumps
+def encode(documents):
+    if orjson is not None:
+        return orjson.dumps(documents)
+    return simplejson.dumps(documents, ensure_ascii=True, ignore_nan=True, separators=(",", ":")).encode()
+
+def decode(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return simplejson.loads(data)
+
+def compress(data, compression):
+    if compression == "gzip":
+        # no timestamp in the header, the same document always gives the same bytes (and content hash)
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ValueError("DUMP_COMPRESSION=zstd needs the zstandard package")
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return data
+
+def decompress(data, file_name):
+    if str(file_name).endswith(EXTENSIONS["gzip"]):
+        return gzip.decompress(data)
+    if str(file_name).endswith(EXTENSIONS["zstd"]):
+        if zstandard is None:
+            raise ValueError(f"{os.path.basename(str(file_name))} is zstd compressed, reading it needs the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+# Serialized bytes of a dumped document list ([{...}]) in the given format / compression
+def dumps(documents, fmt=DUMP_FORMAT, compression=DUMP_COMPRESSION):
+    if fmt == "columnar":
+        documents = [toColumnar(document) for document in documents]
+    return compress(encode(documents), compression)
+
+# Writes documents to <stem><extension> under a temporary name and renames it, returns the final path
+# A file of the same stem in another format is removed so a document is never picked up twice
+def writeDocument(stem, documents, fmt=DUMP_FORMAT, compression=DUMP_COMPRESSION):
+    stem = Path(stem)
+    path = stem.with_name(stem.name + EXTENSIONS[compression])
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as file:
+        file.write(dumps(documents, fmt, compression))
+    os.replace(tmp_path, path)
+    for extension in EXTENSIONS.values():
+        if extension != EXTENSIONS[compression]:
+            stem.with_name(stem.name + extension).unlink(missing_ok=True)
+    return path
+
+# Second copy of a written document, a hard link when the file system allows it
+def mirror(path, target, mode=DUMP_MIRROR):
+    if mode == "none":
+        return None
+    target = Path(target)
+    tmp_path = target.with_name(target.name + ".tmp")
+    tmp_path.unlink(missing_ok=True)
+    try:
+        if mode != "link":
+            raise OSError("copy requested")
+        os.link(path, tmp_path)
+    except OSError:
+        shutil.copyfile(path, tmp_path)
+    os.replace(tmp_path, target)
+    return target
+
+# Documents of a file in any of the formats, always in the per bar layout
+def readDocument(path):
+    with open(path, "rb") as file:
+        data = decompress(file.read(), path)
+    documents = decode(data)
+    if isinstance(documents, list):
+        return [fromColumnar(document) if isinstance(document, dict) else document for document in documents]
+    return fromColumnar(documents) if isinstance(documents, dict) else documents
@@ -1,17 +1,57 @@
 import yfinance as yf
 import pandas as pd
 import requests
-import simplejson
 from datetime import datetime
-import schedule
-import time
+import argparse
 import os
+import sys
+import json
+import signal
+import socket
+import subprocess
+import time
 from pathlib import Path
 import BlobStorage.BlobStorageYedek as blob
 import Indexing.createOrUpdateIndex as create_index
-import pytz
+import Indexing.directIngest as direct_ingest
 import re
+from concurrent.futures import as_completed
+from functools import partial
 from bs4 import BeautifulSoup
+from fetchEngine import FetchEngine
+import deltaFetch as delta
+from snapshotStore import SnapshotStore
+from symbolCache import SymbolCache
+from scheduler import Stage, Scheduler, runStages
+from instrumentation import metrics, Profiler
+from shardQueue import ShardQueue
+import analytics
+import documentFormat
+
+# Number of tickers requested together in one yf.download call
+DOWNLOAD_GROUP_SIZE = int(os.getenv("DOWNLOAD_GROUP_SIZE", "50"))
+
+# First date fetched for a symbol without history, or for every symbol on a full backfill
+START_DATE = '2024-07-17'
+FULL_BACKFILL = os.getenv("FULL_BACKFILL", "0") == "1"
+
+# 'pdf' uploads rendered pdfs and indexes them through Document Intelligence,
+# 'direct' indexes the fetched jsons straight away at the end of fetchAll
+INGEST_MODE = os.getenv("INGEST_MODE", "pdf")
+
+# EVDS service, can be pointed to a local stand-in
+EVDS_URL = os.getenv("EVDS_URL", "https://evds2.tcmb.gov.tr/service/evds")
+EVDS_KEY = os.getenv("EVDS_KEY", "3wDP3F3LPD")
+# Series codes requested together in one EVDS call
+EVDS_SERIES_PER_REQUEST = int(os.getenv("EVDS_SERIES_PER_REQUEST", "20"))
+# Symbols in one task of a sharded run, a few download groups the worker downloads concurrently
+SHARD_TASK_SIZE = int(os.getenv("SHARD_TASK_SIZE", str(DOWNLOAD_GROUP_SIZE * 4)))
+# Every worker of a sharded run dumps to <SHARD_FOLDER>/<run>/<worker>/DataFiles and saves its own watermarks there
+SHARD_FOLDER = Path(os.getenv("SHARD_FOLDER", "BlobStorage/Shards"))
+# Seconds between the coordinator's looks at the queue
+SHARD_POLL_SECONDS = float(os.getenv("SHARD_POLL_SECONDS", "5"))
+# '(USD) ABD Dolari (Doviz Alis)' -> symbol, name, action
+CURRENCY_NAME = re.compile(r"\((?P<symbol>[^)]*)\) (?P<name>.*?) \((?P<action>[^)]*)\)")
 
 
 # Returns a pandas dataframe for specified ticker and start-end dates
@@ -25,37 +65,73 @@ def getTickerDataPeriod(ticker_symbol, period):
 # ticker_symbol -> String (ex. 'AAPL', 'TSLA')
 # start_date, end_date -> String in yyyy-mm-dd format
 def getTickerDataDate(ticker_symbol, start_date, end_date, interval):
-    ticker_data = yf.download(ticker_symbol, start=start_date, end=end_date, interval=interval)
+    metrics.count('yahoo.requests')
+    with metrics.timer('yahoo.download'):
+      ticker_data = yf.download(ticker_symbol, start=start_date, end=end_date, interval=interval)
     return ticker_data
 
-# Creates a json from scratch, converting numpy.Timestamp() to a string
-# So that it can be dumped
-def removeTimestamp(our_dict, ticker):
-    to_json = {}
-    to_json['Name'] = ticker
-    for title in our_dict.keys():
-      if isinstance(title, tuple):
-        return None
-      to_json[title] = {}
-      for key in our_dict[title].keys():
-        if isinstance(key, tuple):
-           return None
-        to_json[title][key.strftime("%Y-%m-%d %H:%M:%S")] = our_dict[title][key]
-    return to_json
-
-# Returns resulting json file of a given ticker
-def convertToJson(symbol, period, need_date = False, *start_end, interval='1h'):
-  df = None
-  if not need_date:
-    df = getTickerDataPeriod(symbol, period)
-  else:
-    df = getTickerDataDate(symbol, start_end[0], start_end[1], interval=interval)
-    
-  if df.empty or df is None:
+# Returns a dict of symbol -> pandas dataframe for a whole list of tickers
+# Tickers are downloaded group_size at a time in a single multi-symbol request each
+# symbols -> list of Strings (ex. ['AAPL', 'TSLA'])
+# start_date, end_date -> String in yyyy-mm-dd format
+def getTickersDataDate(symbols, start_date, end_date, interval, group_size=DOWNLOAD_GROUP_SIZE):
+    frames = {}
+    for i in range(0, len(symbols), group_size):
+      group = list(symbols[i:i + group_size])
+      metrics.count('yahoo.requests')
+      with metrics.timer('yahoo.download'):
+        ticker_data = yf.download(group, start=start_date, end=end_date, interval=interval, group_by='ticker', progress=False)
+      group_frames = splitTickerFrames(ticker_data, group)
+      # an empty result is a failed request (ex. rate limited), not a group without bars
+      if not group_frames:
+        raise ValueError(f"no data returned for {len(group)} tickers")
+      frames.update(group_frames)
+    return frames
+
+# Splits a multi-symbol (MultiIndex columns) dataframe into one dataframe per symbol
+# Rows where a symbol has no data at all (other markets' trading hours) are dropped
+def splitTickerFrames(ticker_data, symbols):
+    frames = {}
+    if ticker_data is None or ticker_data.empty:
+      return frames
+    for symbol in symbols:
+      df = flattenColumns(ticker_data, symbol)
+      if df is None:
+        continue
+      df = df.dropna(how='all')
+      if not df.empty:
+        frames[symbol] = df
+    return frames
+
+# yf.download returns (Ticker, Price) or (Price, Ticker) tuple columns depending on version and group_by
+# Returns the dataframe with plain 'Open', 'Volume'... columns for the given symbol, None if it is missing
+def flattenColumns(df, symbol):
+    if not isinstance(df.columns, pd.MultiIndex):
+      return df
+    for level in range(df.columns.nlevels):
+      if symbol in df.columns.get_level_values(level):
+        return df.xs(symbol, axis=1, level=level)
     return None
-  our_json = df.to_dict()
-  to_json = removeTimestamp(our_json, symbol)
-  return to_json
+
+# Returns the flattened dataframe of a single ticker
+# yf.download reports a failed ticker as an empty (or all NaN) frame instead of raising,
+# that is raised here so the engine retries it and the symbol is recorded as a failure
+def getTickerFrame(symbol, start_date, end_date, interval='1h'):
+  df = getTickerDataDate(symbol, start_date, end_date, interval=interval)
+  if df is not None and not df.empty:
+    df = flattenColumns(df, symbol)
+  if df is None or df.dropna(how='all').empty:
+    raise ValueError(f"no data returned for {symbol}")
+  return df.dropna(how='all')
+
+# Converts a downloaded dataframe into the document's bars in one pass
+# {'Date: yyyy-mm-dd HH:MM:SS': {'AnlikDeger': Open, 'Volume': Volume}}
+# The whole index is formatted at once and only the Open / Volume columns are read
+def frameToBars(df):
+  dates = ('Date: ' + df.index.strftime("%Y-%m-%d %H:%M:%S")).tolist()
+  opens = df['Open'].tolist()
+  volumes = df['Volume'].tolist()
+  return {date: {'AnlikDeger': value, 'Volume': volume} for date, value, volume in zip(dates, opens, volumes)}
 
 # Non ascii characters caused formatting errors in jsons so it is replaced with format friendly ones
 def asciify(target):
@@ -64,103 +140,312 @@ def asciify(target):
    target = target.replace("\u00d6", "O")
    return target
 
-# jsons are dumped both in home directory and BlobStorage/DataFiles
-def dumpToBlob(name, temp, data_folder):
-  with open(data_folder / f'{name}.json', 'w') as f:
-    simplejson.dump(temp, f, ensure_ascii=True, indent=2, ignore_nan=True)  
-    f.close()
-  with open(f"{name}.json", 'w') as f:
-    simplejson.dump(temp, f, ensure_ascii=True, indent=2, ignore_nan=True)
-    f.close()
+# jsons are dumped in BlobStorage/DataFiles, the copy in the home directory is a hard link to the same file
+# Files are written once under a temporary name and renamed, upload_batch running on another thread only sees complete jsons
+# DUMP_FORMAT / DUMP_COMPRESSION choose the layout and compression (documentFormat.py)
+# symbol -> key the written bytes are counted under in the run report
+def dumpToBlob(name, temp, data_folder, symbol=None):
+  with metrics.timer('json.dump', symbol):
+    path = documentFormat.writeDocument(Path(data_folder) / name, temp)
+    documentFormat.mirror(path, Path(path.name))
+    metrics.count('json.bytes', path.stat().st_size, symbol)
+
+# Uploads the dumped jsons as pdfs, in direct mode they stay in DataFiles until fetchAll indexes them
+def uploadBatch():
+  if INGEST_MODE != 'direct':
+    blob.upload_batch()
+
+# Name, exchange and currency of a ticker from its yahoo info
+def tickerMetadata(symbol):
+  info = yf.Ticker(symbol).info
+  return {'Name': info['longName'], 'Exchange': info.get('exchange'), 'Currency': info.get('currency')}
 
-def getTickerLists(ticker_link, suffix=""):
+# Scrapes the ticker codes of an index page, names come from the symbol cache
+# and are only looked up on yahoo (concurrently through the engine) for tickers missing or expired in it
+def getTickerLists(ticker_link, suffix="", engine=None, cache=None):
   try:
-    response = requests.get(ticker_link)
+    response = engine.get(ticker_link) if engine else requests.get(ticker_link)
     soup = BeautifulSoup(response.text, 'html.parser')
     all_a = soup.find_all('a', attrs= {'class': 'title stock-code'})
   except:
     print("site access not possible")
     return
   
+  cache = cache or SymbolCache(path=None)
+  codes = [a.text for a in all_a]
+  metadata = cache.resolve([code + suffix for code in codes], tickerMetadata, engine)
   ticker_list = []
   ticker_names = []
-  for a in all_a:
-    try:
-      name = yf.Ticker(a.text + suffix)
-      name = name.info['longName']
-      ticker_names.append(name)
-      ticker_list.append(a.text)
-    except:
-      print(f"{a.text} info not found, skipping")
+  for code in codes:
+    if code + suffix not in metadata:
+      print(f"{code} info not found, skipping")
+      continue
+    ticker_list.append(code)
+    ticker_names.append(metadata[code + suffix]['Name'])
   return ticker_list, ticker_names
 
-def getStocks(stock_list, name_list, data_folder, today,index, interval = '1h', is_crypto = False):
+# Yields (symbols, names, start_date, frames) for every group of the universe
+# groups -> list of (symbols, names, start_date)
+# frames is None when the group could not be downloaded together, those tickers are fetched one by one
+# With an engine the groups are downloaded concurrently and yielded as they complete
+def downloadGroups(groups, today, interval, group_size, engine=None):
+    if group_size <= 1:
+      for group, names, start_date in groups:
+        yield group, names, start_date, None
+      return
+
+    if engine is None:
+      for group, names, start_date in groups:
+        try:
+          yield group, names, start_date, getTickersDataDate(group, start_date, today, interval, group_size)
+        except Exception as e:
+          metrics.failure('download', e)
+          print(f"batch download failed, falling back to single tickers: {e}")
+          yield group, names, start_date, None
+      return
+
+    futures = {engine.submit('yahoo', getTickersDataDate, group, start_date, today, interval, group_size): (group, names, start_date) for group, names, start_date in groups}
+    for future in as_completed(futures):
+      group, names, start_date = futures[future]
+      try:
+        yield group, names, start_date, future.result()
+      except Exception as e:
+        metrics.failure('download', e)
+        print(f"batch download failed, falling back to single tickers: {e}")
+        yield group, names, start_date, None
+
+# With watermarks only bars after each symbol's last stored bar are fetched and merged into its previous document
+# full_backfill fetches everything from START_DATE again and replaces the previous documents
+# done(symbol) is called for every symbol dumped, or left unchanged, by this call
+# Bars still forming at now (default: the current time) are left for a later call, the watermark never passes a partial bar
+# and its final values are fetched by the next run; upload=False leaves the dumped files in data_folder
+def getStocks(stock_list, name_list, data_folder, today,index, interval = '1h', is_crypto = False, group_size = DOWNLOAD_GROUP_SIZE, engine = None, watermarks = None, full_backfill = False, snapshots = None, done = None, now = None, upload = True):
     limit = 0
-    for stock_tuple in zip(stock_list, name_list, strict=True):
-      new_json = [{}]
-      stock = stock_tuple[0]
-      name = stock_tuple[1]
-
-      new_json[0]['Name'] = asciify(name)
-      new_json[0]['Symbol'] = stock
-      new_json[0]['Type'] = 'Crypto' if is_crypto else 'Stock'
-      
-      if not is_crypto:
-        new_json[0]['Index'] = index
-        new_json[0]['StockExchange'] = getExchange(stock)
+    now = now or pd.Timestamp.now(tz='UTC')
+    stock_list = list(stock_list)
+    name_list = list(name_list)
+    if len(stock_list) != len(name_list):
+      raise ValueError(f"{index}: {len(stock_list)} symbols but {len(name_list)} names")
+
+    size = max(group_size, 1)
+    groups = []
+    for i in range(0, len(stock_list), size):
+      group = stock_list[i:i + size]
+      start_date = START_DATE if watermarks is None or full_backfill else watermarks.startDate(group, START_DATE)
+      groups.append((group, name_list[i:i + size], start_date))
+
+    for group, names, start_date, frames in downloadGroups(groups, today, interval, group_size, engine):
+      group_frames = {}
+      for stock in group:
+        try:
+          df = frames.get(stock) if frames is not None else None
+          # missing or all NaN in the group's result: the ticker failed inside yf.download, it is requested again alone
+          if df is None and frames is not None:
+            metrics.count('download.missing', symbol=stock)
+          if df is None and engine is not None:
+            df = engine.call('yahoo', getTickerFrame, stock, start_date, today, interval=interval)
+          elif df is None:
+            df = getTickerFrame(stock, start_date, today, interval=interval)
+          if df is not None:
+            df = localTime(df, stock, is_crypto)
+          if df is not None and df.index.tz is not None:
+            df = df[df.index + pd.Timedelta(interval) <= now]
+          
+          if df is not None and not df.empty:
+            group_frames[stock] = df
+            metrics.count('rows', len(df), stock)
+          else:
+            metrics.count('download.empty', symbol=stock)
+        except Exception as e:
+          metrics.failure('download', e, stock)
+          print(f"{stock} could not be downloaded: {e}")
+
+      # daily OHLCV of the whole group in one resampling pass
       try:
-        to_json = convertToJson(stock, '1d', True, '2024-07-17', today, interval=interval)
-        
-        if to_json is None:
+        with metrics.timer('analytics.daily'):
+          daily = analytics.dailyBars(group_frames)
+      except Exception as e:
+        metrics.failure('analytics', e)
+        print(f"daily bars of {index} could not be computed: {e}")
+        daily = {}
+
+      documents = {}
+      for stock_tuple in zip(group, names, strict=True):
+        header = {}
+        stock = stock_tuple[0]
+        name = stock_tuple[1]
+        if stock not in group_frames:
           continue
+
+        header['Name'] = asciify(name)
+        header['Symbol'] = stock
+        header['Type'] = 'Crypto' if is_crypto else 'Stock'
         
-        for key in to_json['Open'].keys():
-          temp1 = {}
-          temp2 = {}
-          temp2['AnlikDeger'] = to_json['Open'][key]
-          temp2['Volume'] = to_json['Volume'][key]
-          temp1['Date: ' + key] = temp2.copy()
-          
-          new_json[0].update(temp1.copy())
+        if not is_crypto:
+          header['Index'] = index
+          header['StockExchange'] = getExchange(stock)
+        try:
+          with metrics.timer('convert', stock):
+            bars = frameToBars(group_frames[stock])
+          if snapshots is not None:
+            with metrics.timer('snapshot.append'):
+              snapshots.append(stock, bars, header, replace=full_backfill)
 
-        dumpToBlob(asciify(name), new_json, data_folder)
+          header['Analytics'] = {'Daily': daily.get(stock, {})}
+          if watermarks is not None:
+            with metrics.timer('delta.merge'):
+              new_json = delta.applyDelta(header, bars, stock, asciify(name), watermarks, full_backfill, save=False)
+            if new_json is None:
+              metrics.count('delta.unchanged', symbol=stock)
+              if done is not None:
+                done(stock)
+              continue
+          else:
+            header.update(bars)
+            new_json = [header]
+          documents[stock] = (asciify(name), new_json)
+        except Exception as e:
+          metrics.failure('convert', e, stock)
+          print(f"{stock} could not be converted: {e}")
+          continue
 
-        limit += 1
-        if limit > 10:
-          blob.upload_batch()
-          limit = 0
-      except:
-        print("what happened?")
-        continue
+      # returns, moving averages, volatility and drawdown over the merged daily history of the whole group
+      try:
+        with metrics.timer('analytics.indicators'):
+          analytics.addIndicators({stock: new_json[0] for stock, (_, new_json) in documents.items()}, periods_per_year=365 if is_crypto else 252)
+      except Exception as e:
+        metrics.failure('analytics', e)
+        print(f"analytics of {index} could not be computed: {e}")
+
+      for stock, (name, new_json) in documents.items():
+        try:
+          if watermarks is not None:
+            with metrics.timer('history.save'):
+              delta.saveHistory(name, new_json)
+          dumpToBlob(name, new_json, data_folder, stock)
+          # only a persisted and dumped document moves the watermark
+          if watermarks is not None:
+            delta.advance(watermarks, stock, new_json)
+          metrics.count('symbols.dumped')
+          if done is not None:
+            done(stock)
+
+          limit += 1
+          if limit > 10 and upload:
+            uploadBatch()
+            limit = 0
+        except Exception as e:
+          metrics.failure('dump', e, stock)
+          print(f"{stock} could not be dumped: {e}")
+          continue
+      # the group's watermarks survive a crash later in the universe
+      if watermarks is not None and documents:
+        watermarks.save()
       
-    if limit > 0:
-      blob.upload_batch()
+    if limit > 0 and upload:
+      uploadBatch()
       limit = 0
+    if watermarks is not None:
+      watermarks.save()
 
-def getCurrency(data_folder, today_tr):
-  
-  response = requests.get("https://evds2.tcmb.gov.tr/service/evds/serieList/type=json&code=bie_dkdovytl", headers= {'key':'3wDP3F3LPD'}).json()
-  for res in response:
-    try: 
-      req_str = f"https://evds2.tcmb.gov.tr/service/evds/series={res['SERIE_CODE']}&startDate=17-07-2024&endDate={today_tr}&type=json&aggregationTypes=last&formulas=0&frequency=1"
-      values = requests.get(req_str, headers={'key': '3wDP3F3LPD'}).json()
-      temp = [{}]
-      temp[0]['Name'] = re.findall(r"(?<=\) )(.*?)(?= \()", asciify(res['SERIE_NAME']))[0]
-      temp[0]['Symbol'] = re.findall(r"(?<=\()(.*?)(?=\))", asciify(res['SERIE_NAME']))[0]
-      temp[0]['Action'] = re.findall(r"(?<=\()(.*?)(?=\))", asciify(res['SERIE_NAME']))[1]
-      temp[0]['Type'] = 'Currency (kur)'
-      for dic in values['items']:
-        converted_date = datetime.strptime(dic['Tarih'], '%d-%m-%Y').strftime('%Y-%m-%d')
-        add = {}
-        add['AnlikDeger'] = dic[res['SERIE_CODE'].replace(".", "_")]
-        temp[0][f'Date: {converted_date}'] = add
-        
-      dumpToBlob(asciify(res['SERIE_NAME']), temp, data_folder)
-      
+# Header fields of a currency series from its name, ex. '(USD) ABD Dolari (Doviz Alis)'
+def currencyHeader(serie_name):
+  match = CURRENCY_NAME.search(asciify(serie_name))
+  return {'Name': match['name'], 'Symbol': match['symbol'], 'Action': match['action'], 'Type': 'Currency (kur)'}
+
+def getEvds(url, engine=None):
+  return (engine.get(url, headers={'key': EVDS_KEY}) if engine else requests.get(url, headers={'key': EVDS_KEY})).json()
+
+# Daily values of several series in a single EVDS request (series=A-B-C, one aggregation type and formula per series)
+# codes -> list of series codes (ex. ['TP.DK.USD.A', 'TP.DK.EUR.A'])
+# Returns dict of code -> {'Date: yyyy-mm-dd': {'AnlikDeger': ...}}
+def getCurrencyValues(codes, start_date, today_tr, engine=None):
+  start_tr = datetime.strptime(start_date, '%Y-%m-%d').strftime('%d-%m-%Y')
+  req_str = (f"{EVDS_URL}/series={'-'.join(codes)}&startDate={start_tr}&endDate={today_tr}&type=json"
+             f"&aggregationTypes={'-'.join(['last'] * len(codes))}&formulas={'-'.join(['0'] * len(codes))}&frequency=1")
+  metrics.count('evds.requests')
+  with metrics.timer('evds.request'):
+    values = getEvds(req_str, engine)
+  columns = {code: code.replace(".", "_") for code in codes}
+  bars = {code: {} for code in codes}
+  for dic in values['items']:
+    date_key = 'Date: ' + datetime.strptime(dic['Tarih'], '%d-%m-%Y').strftime('%Y-%m-%d')
+    for code, column in columns.items():
+      if column in dic:
+        bars[code][date_key] = {'AnlikDeger': dic[column]}
+  for code in codes:
+    metrics.count('rows', len(bars[code]), code)
+  return bars
+
+# Stores the freshly fetched bars of one series (snapshot, delta merge with its history, json)
+def storeCurrencySeries(res, bars, data_folder, watermarks=None, full_backfill=False, snapshots=None):
+  header = currencyHeader(res['SERIE_NAME'])
+  temp = [{**header, **bars}]
+  if snapshots is not None:
+    snapshots.append(res['SERIE_CODE'], bars, header, replace=full_backfill)
+  if watermarks is not None:
+    temp = delta.applyDelta(header, bars, res['SERIE_CODE'], asciify(res['SERIE_NAME']), watermarks, full_backfill, save=False)
+    if temp is None:
+      metrics.count('delta.unchanged', symbol=res['SERIE_CODE'])
+      return
+    delta.saveHistory(asciify(res['SERIE_NAME']), temp)
+    
+  dumpToBlob(asciify(res['SERIE_NAME']), temp, data_folder, res['SERIE_CODE'])
+  if watermarks is not None:
+    delta.advance(watermarks, res['SERIE_CODE'], temp)
+  metrics.count('symbols.dumped')
+
+# Fetches a group of series together, starting from the oldest watermark of the group
+# If the combined request fails the series are requested one by one
+def getCurrencyGroup(group, data_folder, today_tr, engine=None, watermarks=None, full_backfill=False, snapshots=None):
+  codes = [res['SERIE_CODE'] for res in group]
+  start_date = START_DATE
+  if watermarks is not None and not full_backfill:
+    start_date = watermarks.startDate(codes, START_DATE)
+  try:
+    values = getCurrencyValues(codes, start_date, today_tr, engine)
+  except Exception as e:
+    if len(group) == 1:
+      raise
+    metrics.failure('evds', e)
+    print(f"batched currency request failed, falling back to single series: {e}")
+    for res in group:
+      try:
+        getCurrencyGroup([res], data_folder, today_tr, engine, watermarks, full_backfill, snapshots)
+      except Exception as e:
+        metrics.failure('evds', e, res['SERIE_CODE'])
+        print(f"{res['SERIE_CODE']} could not be fetched: {e}")
+    return
+  for res in group:
+    try:
+      storeCurrencySeries(res, values[res['SERIE_CODE']], data_folder, watermarks, full_backfill, snapshots)
     except Exception as e:
-      print(e)
-      continue
-  blob.upload_batch()
+      metrics.failure('dump', e, res['SERIE_CODE'])
+      print(f"{res['SERIE_CODE']} could not be stored: {e}")
+
+# Currency series are requested EVDS_SERIES_PER_REQUEST at a time, the groups concurrently through the engine
+def getCurrency(data_folder, today_tr, engine=None, watermarks=None, full_backfill=False, snapshots=None, group_size=EVDS_SERIES_PER_REQUEST):
+  
+  series_list_url = f"{EVDS_URL}/serieList/type=json&code=bie_dkdovytl"
+  response = getEvds(series_list_url, engine)
+  groups = [response[i:i + group_size] for i in range(0, len(response), group_size)]
+  if engine is None:
+    for group in groups:
+      try:
+        getCurrencyGroup(group, data_folder, today_tr, watermarks=watermarks, full_backfill=full_backfill, snapshots=snapshots)
+      except Exception as e:
+        print(e)
+        continue
+  else:
+    futures = [engine.pool.submit(getCurrencyGroup, group, data_folder, today_tr, engine, watermarks, full_backfill, snapshots) for group in groups]
+    for future in as_completed(futures):
+      try:
+        future.result()
+      except Exception as e:
+        print(e)
+  uploadBatch()
+  if watermarks is not None:
+    watermarks.save()
       
 def getExchange(symbol):
    if ".IS" in symbol:
@@ -186,83 +471,340 @@ def getExchange(symbol):
    else:
       return "New York Stock Exchange / NASDAQ"
 
-#TODO: Merge previous day's json with current json
-def fetchAll():
+# Time zone of every exchange getExchange names, cryptos are kept in UTC
+EXCHANGE_TIMEZONES = {
+  "Istanbul Stock Exchange": "Europe/Istanbul",
+  "London Stock Exchange": "Europe/London",
+  "Frankfurt Stock Exchange": "Europe/Berlin",
+  "Euronext": "Europe/Amsterdam",
+  "Euronext Paris": "Europe/Paris",
+  "Bolsa de Madrid": "Europe/Madrid",
+  "Borsa Italiana": "Europe/Rome",
+  "Nasdaq Helsinki": "Europe/Helsinki",
+  "Hong Kong Stock Exchange": "Asia/Hong_Kong",
+  "New York Stock Exchange / NASDAQ": "America/New_York",
+}
 
-    today = datetime.today().strftime('%Y-%m-%d')
-    today_tr = datetime.today().strftime('%d-%m-%Y')
-    # get s&p500 tickers
-    tables=pd.read_html("https://en.wikipedia.org/wiki/List_of_S%26P_500_companies")
-    sp_500 = list(tables[0]['Symbol'])
-    sp_500_names = list(tables[0]['Security'])
-    
-    # get bist tickers
+# Currency a symbol's prices are quoted in, by exchange (London quotes in pence)
+EXCHANGE_CURRENCIES = {
+  "Istanbul Stock Exchange": "TRY",
+  "London Stock Exchange": "GBp",
+  "Frankfurt Stock Exchange": "EUR",
+  "Euronext": "EUR",
+  "Euronext Paris": "EUR",
+  "Bolsa de Madrid": "EUR",
+  "Borsa Italiana": "EUR",
+  "Nasdaq Helsinki": "EUR",
+  "Hong Kong Stock Exchange": "HKD",
+  "New York Stock Exchange / NASDAQ": "USD",
+}
+
+# Exchange and currency of any universe's symbol, kept in the symbol cache ('BTC-USD' -> Crypto, USD)
+def symbolMetadata(symbol, is_crypto=False):
+  if is_crypto:
+    return {'Exchange': 'Crypto', 'Currency': symbol.rsplit('-', 1)[-1]}
+  exchange = getExchange(symbol)
+  return {'Exchange': exchange, 'Currency': EXCHANGE_CURRENCIES[exchange]}
+
+# A multi-symbol download puts every ticker of the group on one (UTC) index, bars are converted back
+# to the exchange's local time so documents and watermarks read the same as a single ticker download
+def localTime(df, symbol, is_crypto=False):
+  if df.index.tz is None:
+    return df
+  return df.tz_convert('UTC' if is_crypto else EXCHANGE_TIMEZONES[getExchange(symbol)])
+
+# Index universes: (index name, loader, is_crypto), every loader returns (symbols, names)
+def getSP500(engine, cache=None):
+    tables = engine.call('wikipedia', pd.read_html, "https://en.wikipedia.org/wiki/List_of_S%26P_500_companies")
+    return list(tables[0]['Symbol']), list(tables[0]['Security'])
+
+def getBist100(engine, cache=None):
     bist100_link = "https://www.getmidas.com/canli-borsa/xu100-bist-100-hisseleri"
-    bist_list,bist_names = getTickerLists(bist100_link, ".IS")
-    bist_100 = [x + '.IS' for x in bist_list]
-
-    # FTSE 100 tickers
-    tables=pd.read_html("https://en.wikipedia.org/wiki/FTSE_100_Index", match='Ticker')
-    london_exc = list(tables[0]['Ticker'])
-    london_exc = [x + ".L" for x in london_exc]
-    london_name = list(tables[0]['Company'])
-
-    # Euro Stoxx 50
-    tables=pd.read_html("https://en.wikipedia.org/wiki/EURO_STOXX_50", match='Ticker')
-    stoxx = list(tables[0]['Ticker'])
-    stoxx_name = list(tables[0]['Name'])
-
-    # Hang Seng tickers
-    tables=pd.read_html("https://en.wikipedia.org/wiki/Hang_Seng_Index", match='Ticker')
-    hk_tickers = list(tables[0]['Ticker'])
-    hk_tickers = ["0"*(4-len(x[6::])) + x[6::] + ".HK" for x in hk_tickers]
-    hk_name = list(tables[0]['Name'])
-    
-    # Top cryptos
-    response = requests.get("https://coinranking.com/")
+    bist_list,bist_names = getTickerLists(bist100_link, ".IS", engine, cache)
+    return [x + '.IS' for x in bist_list], bist_names
+
+def getFTSE100(engine, cache=None):
+    tables = engine.call('wikipedia', pd.read_html, "https://en.wikipedia.org/wiki/FTSE_100_Index", match='Ticker')
+    return [x + ".L" for x in tables[0]['Ticker']], list(tables[0]['Company'])
+
+def getStoxx50(engine, cache=None):
+    tables = engine.call('wikipedia', pd.read_html, "https://en.wikipedia.org/wiki/EURO_STOXX_50", match='Ticker')
+    return list(tables[0]['Ticker']), list(tables[0]['Name'])
+
+def getHangSeng(engine, cache=None):
+    tables = engine.call('wikipedia', pd.read_html, "https://en.wikipedia.org/wiki/Hang_Seng_Index", match='Ticker')
+    hk_tickers = ["0"*(4-len(x[6::])) + x[6::] + ".HK" for x in tables[0]['Ticker']]
+    return hk_tickers, list(tables[0]['Name'])
+
+def getCryptos(engine, cache=None):
+    response = engine.get("https://coinranking.com/")
     soup = BeautifulSoup(response.text, 'html.parser')
     all_span = soup.find_all("span", attrs={'class': 'profile__subtitle'})
     all_a = soup.find_all("a", attrs={'class': 'profile__link'})
     cryptos = [span.text.strip().split("\n")[0] + "-USD" for span in all_span]
     crypto_names = [a.text.strip() for a in all_a]
+    return cryptos, crypto_names
 
-    data_folder = Path("BlobStorage/DataFiles")
-    
-    getStocks(sp_500, sp_500_names, data_folder,today, "S&P 500", interval='1h')
-    getStocks(bist_100,bist_names, data_folder,today, "BIST 100", interval='1h')
-    getStocks(cryptos,crypto_names, data_folder, today, "crypto", interval='1h', is_crypto=True)
-    getStocks(london_exc, london_name, data_folder, today, "FTSE 100", interval = '1h')
-    getStocks(stoxx,stoxx_name,data_folder, today, "Stoxx Europe 50", interval='1h')
-    getStocks(hk_tickers,hk_name, data_folder, today, "Hang Seng Index", interval='1h')
-    getCurrency(data_folder,today_tr)
-
-    # index them all at the end
-    create_index.main()
+UNIVERSES = [
+    ("S&P 500", getSP500, False),
+    ("BIST 100", getBist100, False),
+    ("crypto", getCryptos, True),
+    ("FTSE 100", getFTSE100, False),
+    ("Stoxx Europe 50", getStoxx50, False),
+    ("Hang Seng Index", getHangSeng, False),
+]
+
+# Resolves one universe (from the symbol cache while its constituents are fresh) and fetches all of its tickers
+def fetchUniverse(index, loader, is_crypto, data_folder, today, engine, watermarks=None, full_backfill=False, snapshots=None, interval='1h', symbols=None):
+    stocks, names = symbols.universe(index, loader, engine, partial(symbolMetadata, is_crypto=is_crypto)) if symbols else loader(engine)
+    getStocks(stocks, names, data_folder, today, index, interval=interval, is_crypto=is_crypto, engine=engine, watermarks=watermarks, full_backfill=full_backfill, snapshots=snapshots)
+
+# Indexes everything fetched at the end of a run, straight from the jsons in DataFiles in direct mode
+def indexAll(data_folder):
+    if INGEST_MODE == 'direct':
+      direct_ingest.main(data_folder)
+    else:
+      create_index.main()
+
+# Stages of a run: every universe and the currencies are fetched (downloaded, converted, analytics added, dumped) in parallel,
+# then the state is saved and what is left in DataFiles is uploaded, then everything is indexed
+# Symbol downloads of all universes share the engine's worker pool
+# Only bars newer than the previous run are fetched and merged into the previous documents,
+# full_backfill (or FULL_BACKFILL=1) downloads everything since START_DATE again
+def fetchStages(engine, data_folder=Path("BlobStorage/DataFiles"), full_backfill=FULL_BACKFILL):
+    today = datetime.today().strftime('%Y-%m-%d')
+    today_tr = datetime.today().strftime('%d-%m-%Y')
+    watermarks = delta.Watermarks()
+    snapshots = SnapshotStore()
+    symbols = SymbolCache()
+
+    def saveState():
+      watermarks.save()
+      symbols.save()
+
+    fetches = [Stage(f"fetch {index}", partial(fetchUniverse, index, loader, is_crypto, data_folder, today, engine, watermarks, full_backfill, snapshots, symbols=symbols), optional=True)
+               for index, loader, is_crypto in UNIVERSES]
+    fetches.append(Stage("fetch currency", partial(getCurrency, data_folder, today_tr, engine, watermarks, full_backfill, snapshots), optional=True))
+    fetch_names = [stage.name for stage in fetches]
+    return fetches + [
+      Stage("save state", saveState, after=fetch_names),
+      Stage("upload", uploadBatch, after=fetch_names),
+      Stage("index", partial(indexAll, data_folder), after=["upload"]),
+    ]
+
+# Runs all stages once, returns the per stage report (status, duration)
+# Timers, counters and failures of the run are written to a JSON run report at the end (instrumentation.py),
+# PIPELINE_PROFILE=cpu,memory adds cProfile files of the stages and the top allocation sites
+def fetchAll(engine=None, data_folder=Path("BlobStorage/DataFiles"), full_backfill=FULL_BACKFILL):
+    own_engine = engine is None
+    engine = engine or FetchEngine()
+    metrics.reset()
+    profiler = Profiler()
+    profiler.start()
+    stages = {}
+    try:
+      stages = fetchStages(engine, data_folder, full_backfill)
+      for stage in stages:
+        stage.fn = profiler.wrap(stage.name, stage.fn)
+      stages = runStages(stages)
+      return stages
+    finally:
+      if own_engine:
+        engine.shutdown()
+      report_path = metrics.write(stages=stages, profile=profiler.stop())
+      print(f"run report written to {report_path}")
     
-def fetch_schedule():
+def shardFolder(run, worker=None):
+    folder = SHARD_FOLDER / re.sub(r'[^A-Za-z0-9._-]+', '_', run)
+    return folder if worker is None else folder / re.sub(r'[^A-Za-z0-9._-]+', '_', worker)
+
+# Sharded runs split the universes over worker processes (on one or several machines sharing the queue file):
+# planShards resolves the universes once and queues them in SHARD_TASK_SIZE slices plus one currency task,
+# every shardWorker claims tasks until none is left and coordinateShards indexes once all of them are done
+# Planning a run that is already queued (ex. every node planning the same day) leaves it as it is
+def planShards(run, queue, engine, full_backfill=FULL_BACKFILL, task_size=SHARD_TASK_SIZE):
+    if queue.run(run) is not None:
+      return False
+    today = datetime.today().strftime('%Y-%m-%d')
+    symbols = SymbolCache()
+    tasks = []
+    for index, loader, is_crypto in UNIVERSES:
+      try:
+        stocks, names = symbols.universe(index, loader, engine, partial(symbolMetadata, is_crypto=is_crypto))
+      except Exception as e:
+        metrics.failure('plan', e, index)
+        print(f"{index} could not be resolved: {e}")
+        continue
+      for i in range(0, len(stocks), task_size):
+        tasks.append({'kind': 'stocks', 'index': index, 'is_crypto': is_crypto,
+                      'symbols': list(stocks[i:i + task_size]), 'names': list(names[i:i + task_size])})
+    tasks.append({'kind': 'currency'})
+    symbols.save()
+    return queue.plan(run, today, tasks, full_backfill)
+
+# Fetches the tasks of a run one after another into the worker's own folder, returns the number of tasks done
+# Symbols already marked done in the queue (by a worker that died before finishing the task) are skipped,
+# every symbol fetched is marked done as soon as its document is dumped
+def shardWorker(run, worker, queue=None, engine=None):
+    queue = queue or ShardQueue()
+    planned = queue.run(run)
+    if planned is None:
+      raise ValueError(f"run {run} is not planned")
+    own_engine = engine is None
+    engine = engine or FetchEngine()
+    metrics.reset()
+
+    folder = shardFolder(run, worker)
+    data_folder = folder / "DataFiles"
+    data_folder.mkdir(parents=True, exist_ok=True)
+    # pdfs are uploaded from the worker's own folder, workers never upload each other's files
+    blob.data_file = str(data_folder)
+    # the run's watermarks, saved to the worker's file and merged by the coordinator
+    watermarks = delta.Watermarks(folder / "watermarks.json")
+    watermarks.merge(delta.Watermarks().marks)
+    snapshots = SnapshotStore()
+    today = planned['today']
+    today_tr = pd.Timestamp(today).strftime('%d-%m-%Y')
+    full_backfill = bool(planned['full_backfill'])
+
+    tasks = 0
+    try:
+      while True:
+        task = queue.claim(run, worker)
+        if task is None:
+          break
+        try:
+          with metrics.timer('shard.task'):
+            if task['kind'] == 'currency':
+              getCurrency(data_folder, today_tr, engine, watermarks, full_backfill, snapshots)
+            else:
+              completed = queue.completed(run, task['symbols'])
+              pending = [(symbol, name) for symbol, name in zip(task['symbols'], task['names']) if symbol not in completed]
+              metrics.count('shard.skipped', len(task['symbols']) - len(pending))
+              if pending:
+                getStocks([symbol for symbol, _ in pending], [name for _, name in pending], data_folder, today, task['index_name'],
+                          is_crypto=bool(task['is_crypto']), engine=engine, watermarks=watermarks, full_backfill=full_backfill,
+                          snapshots=snapshots, done=partial(queue.markDone, run, task['task'], worker))
+          queue.finish(run, task['task'], worker)
+          tasks += 1
+        except Exception as e:
+          metrics.failure('shard', e, f"task {task['task']}")
+          print(f"task {task['task']} of run {run} failed: {e}")
+          queue.finish(run, task['task'], worker, e)
+      watermarks.save()
+      return tasks
+    finally:
+      if own_engine:
+        engine.shutdown()
+      metrics.write(name=f"shard-{shardFolder(run).name}-{folder.name}", run=run, worker=worker, tasks=tasks)
+
+# Waits until every task of the run is done or failed, then merges the workers' watermarks, moves the documents
+# they left into data_folder and uploads / indexes them once, a second coordinator of the same run only waits
+# alive() -> False stops the wait when the local workers exited with tasks still claimed
+def coordinateShards(run, queue=None, data_folder=Path("BlobStorage/DataFiles"), poll=SHARD_POLL_SECONDS, alive=None):
+    queue = queue or ShardQueue()
+    if queue.run(run) is None:
+      raise ValueError(f"run {run} is not planned")
+    while not queue.finished(run):
+      if alive is not None and not alive():
+        raise RuntimeError(f"run {run}: workers exited before finishing, {queue.progress(run)}")
+      print(f"run {run}: {queue.progress(run)}")
+      time.sleep(poll)
+
+    progress = queue.progress(run)
+    progress['failed_tasks'] = queue.failures(run)
+    if not queue.claimIndex(run, f"{socket.gethostname()}-{os.getpid()}"):
+      print(f"run {run}: {queue.run(run)['indexed']}, not indexed again")
+      return progress
+
+    metrics.reset()
+    try:
+      watermarks = delta.Watermarks()
+      for path in sorted(shardFolder(run).glob("*/watermarks.json")):
+        watermarks.merge(delta.Watermarks(path).marks)
+      watermarks.save()
+
+      Path(data_folder).mkdir(parents=True, exist_ok=True)
+      for path in sorted(shardFolder(run).glob("*/DataFiles/*")):
+        if documentFormat.isDocumentFile(path.name):
+          os.replace(path, Path(data_folder) / path.name)
+      with metrics.timer('upload'):
+        uploadBatch()
+      with metrics.timer('index'):
+        indexAll(data_folder)
+    except BaseException:
+      queue.indexDone(run, ok=False)
+      raise
+    finally:
+      metrics.write(name=f"shard-{shardFolder(run).name}-coordinator", run=run, progress=progress)
+    queue.indexDone(run)
+    return progress
+
+# One sharded run on this machine: plans it, starts `workers` worker processes and coordinates them
+def fetchSharded(workers, run=None, full_backfill=FULL_BACKFILL):
+    run = run or datetime.today().strftime('%Y-%m-%d')
+    queue = ShardQueue()
+    with FetchEngine() as engine:
+      planShards(run, queue, engine, full_backfill)
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker', f"local-{i}", '--run', run])
+                 for i in range(workers)]
+    try:
+      return coordinateShards(run, queue, alive=lambda: any(process.poll() is None for process in processes))
+    finally:
+      for process in processes:
+        process.wait()
+
+def fetch_schedule(run_now=False):
   
   newpath = r'BlobStorage/DataFiles' 
   if not os.path.exists(newpath):
     os.makedirs(newpath)
 
   for file in os.scandir("."):
-    if file.name.endswith(".json"):
+    if documentFormat.isDocumentFile(file.name):
         os.unlink(file.path)
   
   for file in os.scandir("./BlobStorage/DataFiles"):
-     if file.name.endswith(".json"):
+     if documentFormat.isDocumentFile(file.name):
         os.unlink(file.path)
   
-  schedule.every().monday.at("23:30", pytz.timezone("Europe/Istanbul")).do(fetchAll)
-  schedule.every().tuesday.at("23:30", pytz.timezone("Europe/Istanbul")).do(fetchAll)
-  schedule.every().wednesday.at("23:30", pytz.timezone("Europe/Istanbul")).do(fetchAll)
-  schedule.every().thursday.at("23:30", pytz.timezone("Europe/Istanbul")).do(fetchAll)
-  schedule.every().friday.at("23:30", pytz.timezone("Europe/Istanbul")).do(fetchAll)
-  
-  while True:
-   schedule.run_pending()
-   time.sleep(1)
+  # weekdays at 23:30 Istanbul time, a run missed while the process was down is made up on start
+  scheduler = Scheduler(fetchAll, at="23:30", days=(0, 1, 2, 3, 4), timezone="Europe/Istanbul")
+  if hasattr(signal, "SIGUSR1"):
+    signal.signal(signal.SIGUSR1, lambda *args: scheduler.runNow())
+  if run_now:
+    scheduler.runNow()
+  scheduler.serveForever()
   
+# python fetch.py          -> scheduled runs (kill -USR1 <pid> starts a run right away)
+# python fetch.py --now    -> one run right away, then scheduled runs
+# python fetch.py --once   -> a single run
+# python fetch.py --shards 4                -> a single sharded run on 4 local worker processes
+# python fetch.py --plan [--run 2024-07-17] -> queues a sharded run (today's date by default) for workers on any machine
+# python fetch.py --worker node1-0 [--run]  -> works on a queued run until no task is left
+# python fetch.py --coordinate [--run]      -> waits for the workers of a run, then uploads and indexes it once
 if __name__ == '__main__':
-  fetch_schedule()
-  fetchAll()
\ No newline at end of file
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--once', action='store_true')
+  parser.add_argument('--now', action='store_true')
+  parser.add_argument('--shards', type=int)
+  parser.add_argument('--plan', action='store_true')
+  parser.add_argument('--worker')
+  parser.add_argument('--coordinate', action='store_true')
+  parser.add_argument('--run', default=datetime.today().strftime('%Y-%m-%d'))
+  args = parser.parse_args()
+
+  if args.once:
+    print(json.dumps(fetchAll(), indent=2))
+  elif args.shards:
+    print(json.dumps(fetchSharded(args.shards, args.run), indent=2))
+  elif args.plan or args.worker or args.coordinate:
+    if args.plan:
+      with FetchEngine() as engine:
+        print(f"run {args.run} planned" if planShards(args.run, ShardQueue(), engine) else f"run {args.run} was already planned")
+    if args.worker:
+      print(f"{shardWorker(args.run, args.worker)} tasks done by {args.worker}")
+    if args.coordinate:
+      print(json.dumps(coordinateShards(args.run), indent=2))
+  else:
+    fetch_schedule(run_now=args.now)
@@ -0,0 +1,118 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import requests
+from instrumentation import metrics
+
+
+# Number of concurrent symbol / series fetches
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", "8"))
+
+# Requests per second allowed for each host, None means not limited
+HOST_RATE_LIMITS = {
+    "yahoo": float(os.getenv("YAHOO_RATE_LIMIT", "2")),
+    "evds": float(os.getenv("EVDS_RATE_LIMIT", "5")),
+    "wikipedia": float(os.getenv("WIKIPEDIA_RATE_LIMIT", "1")),
+    "coinranking": float(os.getenv("COINRANKING_RATE_LIMIT", "1")),
+    "getmidas": float(os.getenv("GETMIDAS_RATE_LIMIT", "1")),
+}
+
+# Maps a url to the host key used in HOST_RATE_LIMITS
+# (ex. 'https://en.wikipedia.org/wiki/...' -> 'wikipedia'), unknown hosts map to their hostname
+def hostOf(url):
+    hostname = urlparse(url).hostname or url
+    for host in HOST_RATE_LIMITS:
+        if host in hostname:
+            return host
+    return hostname
+
+
+# Spaces calls to one host so that at most `rate` of them start per second
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+# Calls fn, retrying up to `retries` more times with exponential backoff (plus jitter) when it raises
+def withRetry(fn, *args, retries=3, backoff=1.0, **kwargs):
+    for attempt in range(retries + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = backoff * (2 ** attempt) + random.uniform(0, backoff)
+            print(f"{getattr(fn, '__name__', fn)} failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+# Bounded worker pool shared by every fetch of a run
+# Each call is rate limited per host and retried with backoff
+class FetchEngine:
+    def __init__(self, max_workers=FETCH_WORKERS, rate_limits=None, retries=3, backoff=1.0, session=None):
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.rate_limits = HOST_RATE_LIMITS if rate_limits is None else rate_limits
+        self.limiters = {}
+        self.limiters_lock = threading.Lock()
+        self.session = session or requests.Session()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fetch")
+
+    def limiter(self, host):
+        with self.limiters_lock:
+            if host not in self.limiters:
+                self.limiters[host] = RateLimiter(self.rate_limits.get(host))
+            return self.limiters[host]
+
+    # Runs fn(*args, **kwargs) in the calling thread, rate limited for host and retried
+    def call(self, host, fn, *args, **kwargs):
+        limiter = self.limiter(host)
+        attempts = 0
+
+        def attempt():
+            nonlocal attempts
+            if attempts:
+                metrics.count(f'{host}.retries')
+            attempts += 1
+            limiter.wait()
+            return fn(*args, **kwargs)
+        attempt.__name__ = getattr(fn, '__name__', 'fetch')
+        return withRetry(attempt, retries=self.retries, backoff=self.backoff)
+
+    # Same as call but runs on the worker pool, returns a Future
+    def submit(self, host, fn, *args, **kwargs):
+        return self.pool.submit(self.call, host, fn, *args, **kwargs)
+
+    # requests.get through the pooled session, rate limited by the url's host
+    def get(self, url, **kwargs):
+        def get(url, **kwargs):
+            response = self.session.get(url, **kwargs)
+            response.raise_for_status()
+            return response
+        return self.call(hostOf(url), get, url, **kwargs)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
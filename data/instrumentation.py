@@ -0,0 +1,151 @@
+import cProfile
+import functools
+import json
+import os
+import re
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+
+# 'cpu' profiles every stage with cProfile, 'memory' traces allocations with tracemalloc, 'cpu,memory' both
+PROFILE = {mode.strip() for mode in os.getenv("PIPELINE_PROFILE", "").split(",") if mode.strip()}
+# JSON run reports (and .prof files of the stages when profiling) are written here
+RUN_REPORT_FOLDER = Path(os.getenv("RUN_REPORT_FOLDER", "BlobStorage/RunReports"))
+# Failures kept in a report, the counters still count all of them
+MAX_FAILURES = 1000
+
+
+# Timers, counters and failures of one pipeline run, shared by every thread and module of the run
+# Per symbol values (rows, bytes, seconds...) are kept next to the totals
+class RunMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = datetime.now()
+            self.timers = {}
+            self.counters = {}
+            self.symbols = {}
+            self.failures = []
+
+    def addTime(self, name, seconds, symbol=None):
+        with self.lock:
+            timer = self.timers.setdefault(name, {'count': 0, 'seconds': 0.0, 'max': 0.0})
+            timer['count'] += 1
+            timer['seconds'] += seconds
+            timer['max'] = max(timer['max'], seconds)
+            if symbol is not None:
+                values = self.symbols.setdefault(symbol, {})
+                values[f'{name}.seconds'] = values.get(f'{name}.seconds', 0.0) + seconds
+
+    @contextmanager
+    def timer(self, name, symbol=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addTime(name, time.perf_counter() - start, symbol)
+
+    def count(self, name, value=1, symbol=None):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            if symbol is not None:
+                values = self.symbols.setdefault(symbol, {})
+                values[name] = values.get(name, 0) + value
+
+    # reason -> exception or message
+    def failure(self, stage, reason, symbol=None):
+        if isinstance(reason, BaseException):
+            reason = f"{type(reason).__name__}: {reason}"
+        self.count(f'{stage}.failures', symbol=symbol)
+        with self.lock:
+            if len(self.failures) < MAX_FAILURES:
+                self.failures.append({'stage': stage, 'symbol': symbol, 'reason': str(reason)})
+
+    def report(self, **extra):
+        with self.lock:
+            finished = datetime.now()
+            return {
+                'started': self.started.isoformat(timespec='seconds'),
+                'finished': finished.isoformat(timespec='seconds'),
+                'seconds': round((finished - self.started).total_seconds(), 3),
+                **extra,
+                'timers': {name: {**timer, 'seconds': round(timer['seconds'], 6), 'max': round(timer['max'], 6)}
+                           for name, timer in sorted(self.timers.items(), key=lambda item: -item[1]['seconds'])},
+                'counters': dict(sorted(self.counters.items())),
+                'failures': list(self.failures),
+                'symbols': {symbol: dict(values) for symbol, values in sorted(self.symbols.items())},
+            }
+
+    # Writes the report atomically to RUN_REPORT_FOLDER/run-<start>.json (or <name>.json) and returns its path
+    def write(self, folder=RUN_REPORT_FOLDER, name=None, **extra):
+        report = self.report(**extra)
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        path = folder / f"{name or 'run-' + self.started.strftime('%Y%m%d-%H%M%S')}.json"
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'w') as file:
+            json.dump(report, file, indent=2, default=str)
+        os.replace(tmp_path, path)
+        return path
+
+
+metrics = RunMetrics()
+
+
+# Optional profiling of a run, a no-op unless PIPELINE_PROFILE is set
+# cProfile only sees the thread it runs in, so every stage gets its own profile (stage threads, not the download workers)
+class Profiler:
+    def __init__(self, modes=PROFILE, folder=RUN_REPORT_FOLDER, top=20):
+        self.modes = set(modes)
+        self.folder = Path(folder)
+        self.top = top
+        self.prefix = None
+        self.profiles = []
+
+    def start(self):
+        self.prefix = f"run-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+        if 'memory' in self.modes:
+            tracemalloc.start(10)
+
+    # fn wrapped to run under its own cProfile, dumped to <folder>/<run>-<name>.prof
+    def wrap(self, name, fn):
+        if 'cpu' not in self.modes:
+            return fn
+
+        @functools.wraps(fn)
+        def profiled(*args, **kwargs):
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profile.disable()
+                self.folder.mkdir(parents=True, exist_ok=True)
+                path = self.folder / f"{self.prefix}-{re.sub(r'[^A-Za-z0-9]+', '_', name)}.prof"
+                profile.dump_stats(str(path))
+                self.profiles.append(str(path))
+        return profiled
+
+    # Profile files and the top allocation sites, for the run report
+    def stop(self):
+        result = {}
+        if self.profiles:
+            result['cpu_profiles'] = list(self.profiles)
+        if 'memory' in self.modes and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            result['memory'] = {
+                'current_bytes': current,
+                'peak_bytes': peak,
+                'top': [{'where': str(stat.traceback[0]), 'bytes': stat.size, 'count': stat.count}
+                        for stat in snapshot.statistics('lineno')[:self.top]],
+            }
+        return result
@@ -0,0 +1,209 @@
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import partial
+from pathlib import Path
+import pandas as pd
+import pytz
+import fetch
+import deltaFetch as delta
+import documentFormat
+import BlobStorage.BlobStorageYedek as blob
+import Indexing.createOrUpdateIndex as create_index
+import Indexing.directIngest as direct_ingest
+from BlobStorage.contentManifest import ContentManifest
+from fetchEngine import FetchEngine
+from instrumentation import metrics
+from snapshotStore import SnapshotStore
+from symbolCache import SymbolCache
+
+
+# Seconds between two polls of the open markets
+INTRADAY_POLL_SECONDS = float(os.getenv("INTRADAY_POLL_SECONDS", "300"))
+# Search documents per upload of an update
+INTRADAY_BATCH_SIZE = int(os.getenv("INTRADAY_BATCH_SIZE", "32"))
+# Documents of a poll are dumped here and removed once indexed
+INTRADAY_FOLDER = Path(os.getenv("INTRADAY_FOLDER", "BlobStorage/Intraday"))
+# Bars of the nightly run, a bar is complete (and polled) one interval after its start
+BAR_INTERVAL = '1h'
+
+# Regular session of every exchange getExchange names, in the exchange's time zone (fetch.EXCHANGE_TIMEZONES, holidays are not known)
+# Symbols of an exchange missing here (cryptos) are always open
+SESSIONS = {
+    "Istanbul Stock Exchange": ("10:00", "18:00"),
+    "London Stock Exchange": ("08:00", "16:30"),
+    "Frankfurt Stock Exchange": ("09:00", "17:30"),
+    "Euronext": ("09:00", "17:30"),
+    "Euronext Paris": ("09:00", "17:30"),
+    "Bolsa de Madrid": ("09:00", "17:30"),
+    "Borsa Italiana": ("09:00", "17:30"),
+    "Nasdaq Helsinki": ("10:00", "18:30"),
+    "Hong Kong Stock Exchange": ("09:30", "16:00"),
+    "New York Stock Exchange / NASDAQ": ("09:30", "16:00"),
+}
+TRADING_HOURS = {exchange: (fetch.EXCHANGE_TIMEZONES[exchange], opens, closes) for exchange, (opens, closes) in SESSIONS.items()}
+
+
+# Whether an exchange trades at now (aware datetime), or closed less than grace ago so its last bar still gets polled
+def isOpen(exchange, now, grace=pd.Timedelta(BAR_INTERVAL)):
+    if exchange not in TRADING_HOURS:
+        return True
+    zone, open_time, close_time = TRADING_HOURS[exchange]
+    local = now.astimezone(pytz.timezone(zone))
+    opens = local.replace(hour=int(open_time[:2]), minute=int(open_time[3:]), second=0, microsecond=0)
+    closes = local.replace(hour=int(close_time[:2]), minute=int(close_time[3:]), second=0, microsecond=0)
+    return local.weekday() < 5 and opens <= local < closes + grace
+
+# Aware end time of a bar from the symbol's watermark, which is in the exchange's local time ('2024-08-05 15:30:00')
+def barEnd(last, exchange):
+    zone = TRADING_HOURS[exchange][0] if exchange in TRADING_HOURS else "UTC"
+    return pd.Timestamp(last).tz_localize(zone) + pd.Timedelta(BAR_INTERVAL)
+
+
+# Polls the newest bars of the symbols whose market is open, merges them like a nightly run does
+# and indexes only the search documents they changed, in batches of batch_size
+# mode follows INGEST_MODE: 'direct' uploads the changed chunks straight to the search index, 'pdf' renders
+# the changed documents, uploads the pdfs from data_folder and indexes them through Document Intelligence
+# Every poll updates the run report at RUN_REPORT_FOLDER/intraday-<start>.json: bars, documents,
+# poll / index times and the update latency (end of a bar until its document is indexed)
+class IntradayUpdater:
+    def __init__(self, engine, search_client=None, data_folder=INTRADAY_FOLDER, batch_size=INTRADAY_BATCH_SIZE,
+                 watermarks=None, snapshots=None, symbols=None, manifest=None, clock=lambda: datetime.now(pytz.utc),
+                 mode=fetch.INGEST_MODE):
+        self.engine = engine
+        self.mode = mode
+        self.search_client = search_client
+        self.data_folder = Path(data_folder)
+        self.batch_size = batch_size
+        self.watermarks = watermarks or delta.Watermarks()
+        self.snapshots = snapshots or SnapshotStore()
+        self.symbols = symbols or SymbolCache()
+        self.manifest = manifest or ContentManifest(os.path.join("BlobStorage", "indexed_content_manifest.json"))
+        self.clock = clock
+        self.stopped = threading.Event()
+        self.polls = 0
+        self.name = f"intraday-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+        self.data_folder.mkdir(parents=True, exist_ok=True)
+        if mode != 'direct':
+            # pdfs are uploaded from the intraday folder, not from the nightly run's DataFiles
+            blob.data_file = str(self.data_folder)
+
+    # (index, is_crypto) -> [(symbol, name, exchange)], constituents come from the symbol cache while they are fresh
+    def universes(self):
+        universes = {}
+        for index, loader, is_crypto in fetch.UNIVERSES:
+            try:
+                stocks, names = self.symbols.universe(index, loader, self.engine, partial(fetch.symbolMetadata, is_crypto=is_crypto))
+            except Exception as e:
+                metrics.failure('intraday.universe', e, index)
+                print(f"{index} could not be resolved: {e}")
+                continue
+            universes[(index, is_crypto)] = [(stock, name, None if is_crypto else fetch.getExchange(stock)) for stock, name in zip(stocks, names)]
+        return universes
+
+    # One poll: downloads the bars completed since each open symbol's watermark and indexes the changed documents
+    # Returns the poll's summary
+    def poll(self):
+        now = self.clock()
+        # the download's end date is exclusive, tomorrow includes today's bars
+        end = (now + timedelta(days=1)).strftime('%Y-%m-%d')
+        exchanges = {}
+        updated = []
+        active = 0
+        start = time.perf_counter()
+        with metrics.timer('intraday.poll'):
+            for (index, is_crypto), members in self.universes().items():
+                members = [member for member in members if isOpen(member[2], now)]
+                active += len(members)
+                if not members:
+                    continue
+                exchanges.update({stock: exchange for stock, _, exchange in members})
+                previous = {stock: self.watermarks.get(stock) for stock, _, _ in members}
+                fetch.getStocks([stock for stock, _, _ in members], [name for _, name, _ in members], self.data_folder, end, index,
+                                interval=BAR_INTERVAL, is_crypto=is_crypto, engine=self.engine, watermarks=self.watermarks,
+                                snapshots=self.snapshots, now=now, upload=False)
+                # symbols whose watermark moved got new bars, the others had none completed since the last poll
+                updated.extend(stock for stock, last in previous.items() if self.watermarks.get(stock) != last)
+        poll_seconds = time.perf_counter() - start
+
+        paths = [self.data_folder / file_name for file_name in sorted(os.listdir(self.data_folder)) if documentFormat.isDocumentFile(file_name)]
+        start = time.perf_counter()
+        with metrics.timer('intraday.index'):
+            if not paths:
+                indexed = 0
+            elif self.mode == 'direct':
+                indexed = len(direct_ingest.index_files(paths, self.search_client, self.manifest, self.batch_size))
+            else:
+                blob.upload_batch()
+                indexed = create_index.main(search_client=self.search_client, chunk_size=self.batch_size)
+        index_seconds = time.perf_counter() - start
+
+        indexed_at = self.clock()
+        latencies = []
+        for symbol in updated:
+            last = self.watermarks.get(symbol)
+            latency = (indexed_at - barEnd(last, exchanges.get(symbol))).total_seconds()
+            latencies.append(latency)
+            metrics.addTime('intraday.latency', latency, symbol)
+
+        self.polls += 1
+        metrics.count('intraday.polls')
+        metrics.count('intraday.documents', indexed)
+        summary = {
+            'poll': self.polls,
+            'at': now.isoformat(timespec='seconds'),
+            'active_symbols': active,
+            'updated_symbols': len(updated),
+            'files': len(paths),
+            'indexed_documents': indexed,
+            'poll_seconds': round(poll_seconds, 3),
+            'index_seconds': round(index_seconds, 3),
+            'symbols_per_second': round(active / poll_seconds, 1) if poll_seconds else None,
+            'latency_p50': round(float(pd.Series(latencies).median()), 1) if latencies else None,
+            'latency_max': round(max(latencies), 1) if latencies else None,
+        }
+        metrics.write(name=self.name, last_poll=summary)
+        return summary
+
+    def stop(self):
+        self.stopped.set()
+
+    # Polls every poll_seconds (measured from the start of a poll) until stop()
+    def serveForever(self, poll_seconds=INTRADAY_POLL_SECONDS):
+        metrics.reset()
+        while not self.stopped.is_set():
+            started = time.monotonic()
+            try:
+                print(json.dumps(self.poll()))
+            except Exception as e:
+                metrics.failure('intraday', e)
+                print(f"intraday poll failed: {e}")
+            self.stopped.wait(max(0.0, poll_seconds - (time.monotonic() - started)))
+
+
+# python intraday.py [--interval 300] [--once]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--interval', type=float, default=INTRADAY_POLL_SECONDS)
+    parser.add_argument('--once', action='store_true')
+    args = parser.parse_args()
+
+    from azure.search.documents import SearchClient
+    from azure.core.credentials import AzureKeyCredential
+    from Indexing.createOrUpdateIndex import azure_search_endpoint, azure_search_key, azure_search_index, create_or_update_search_index
+
+    create_or_update_search_index()
+    search_client = SearchClient(endpoint=azure_search_endpoint, index_name=azure_search_index, credential=AzureKeyCredential(azure_search_key))
+    with FetchEngine() as engine:
+        updater = IntradayUpdater(engine, search_client)
+        if args.once:
+            metrics.reset()
+            print(json.dumps(updater.poll(), indent=2))
+        else:
+            try:
+                updater.serveForever(args.interval)
+            except KeyboardInterrupt:
+                updater.stop()
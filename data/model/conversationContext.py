@@ -0,0 +1,166 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# tiktoken counts tokens exactly when installed, otherwise ~4 characters per token is assumed
+try:
+    import tiktoken
+    encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    encoding = None
+
+# Token budgets of a request: earlier turns of the session, retrieved market data, and the answer's upper bound
+history_tokens = int(os.getenv("RAG_HISTORY_TOKENS", "1024"))
+context_tokens = int(os.getenv("RAG_CONTEXT_TOKENS", "3000"))
+max_answer_tokens = int(os.getenv("RAG_MAX_TOKENS", "4096"))
+# Sessions kept in memory, the least recently used one is dropped first, idle ones after RAG_SESSION_TTL seconds
+max_sessions = int(os.getenv("RAG_MAX_SESSIONS", "1000"))
+session_ttl = float(os.getenv("RAG_SESSION_TTL", str(60 * 60)))
+
+# max_tokens of the answer per question type: a single figure / fact, a list or comparison, an explanation
+answer_tokens = {"fact": 300, "list": 800, "explain": 1500}
+explain_pattern = re.compile(r"\b(why|how|explain|analy[sz]e|summar\w*|outlook|should|reason\w*|impact|predict\w*|forecast\w*|"
+                             r"neden|niye|nas[iı]l|a[cç][iı]kla\w*|yorumla\w*)\b", re.IGNORECASE)
+list_pattern = re.compile(r"\b(list|top|which|compare\w*|vs|versus|between|rank\w*|each|all|"
+                          r"hangi\w*|listele\w*|kar[sş][iı]la[sş]t[iı]r\w*)\b", re.IGNORECASE)
+# A retrieved chunk is left out when at least this share of its lines is already in the context
+duplicate_share = 0.8
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return max(1, len(text) // 4)
+
+# Cuts text to at most budget tokens, at a line end when there is one
+def trim_to_tokens(text, budget):
+    if count_tokens(text) <= budget:
+        return text
+    lines = []
+    used = 0
+    for line in text.splitlines():
+        size = count_tokens(line) + 1
+        if used + size > budget:
+            break
+        lines.append(line)
+        used += size
+    if lines:
+        return "\n".join(lines)
+    return text[:budget * 4]
+
+def question_type(text):
+    if explain_pattern.search(text):
+        return "explain"
+    if list_pattern.search(text):
+        return "list"
+    return "fact"
+
+def max_tokens_for(text):
+    return min(answer_tokens[question_type(text)], max_answer_tokens)
+
+# First sentence (or line) of a text, at most limit characters
+def first_sentence(text, limit=160):
+    sentence = re.split(r"(?<=[.!?])\s|\n", text.strip(), maxsplit=1)[0]
+    return sentence if len(sentence) <= limit else sentence[:limit - 3] + "..."
+
+def normalize_line(line):
+    return " ".join(line.lower().split())
+
+# Market data context from ranked retrieval chunks ({'text': ...} or str): chunks mostly repeating lines already taken
+# are skipped, at most max_chunks are taken and the whole context stays within budget tokens
+def assemble_context(chunks, budget=context_tokens, max_chunks=None):
+    seen = set()
+    parts = []
+    used = 0
+    for chunk in chunks:
+        if max_chunks is not None and len(parts) >= max_chunks:
+            break
+        text = chunk["text"] if isinstance(chunk, dict) else chunk
+        lines = {normalize_line(line) for line in text.splitlines() if line.strip()}
+        if not lines or len(lines & seen) >= duplicate_share * len(lines):
+            continue
+        size = count_tokens(text)
+        if used + size > budget:
+            if not parts:
+                parts.append(trim_to_tokens(text, budget))
+            break
+        seen |= lines
+        parts.append(text)
+        used += size
+    return "\n\n".join(parts)
+
+
+# Turns of one chat session: the newest ones are sent as they were, older ones are folded into a short summary
+# (first sentence of the question and of the answer) so the history stays within budget tokens
+class Conversation:
+    def __init__(self, budget=history_tokens):
+        self.budget = budget
+        self.turns = []
+        self.summary = []
+        self.last_used = time.monotonic()
+
+    def turn_tokens(self):
+        return sum(count_tokens(question) + count_tokens(answer) for question, answer in self.turns)
+
+    def add(self, question, answer):
+        self.turns.append((question, answer))
+        self.last_used = time.monotonic()
+        # three quarters of the budget for the turns kept verbatim, the rest for the summary
+        while len(self.turns) > 1 and self.turn_tokens() > self.budget * 3 // 4:
+            old_question, old_answer = self.turns.pop(0)
+            self.summary.append(f"- {first_sentence(old_question)} -> {first_sentence(old_answer)}")
+        if self.turn_tokens() > self.budget * 3 // 4:
+            question, answer = self.turns[-1]
+            self.turns[-1] = (question, trim_to_tokens(answer, max(self.budget * 3 // 4 - count_tokens(question), 1)))
+        while len(self.summary) > 1 and count_tokens("\n".join(self.summary)) > self.budget // 4:
+            self.summary.pop(0)
+
+    # Chat messages of the history, to go between the system prompts and the new question
+    def messages(self):
+        messages = []
+        if self.summary:
+            messages.append({"role": "system", "content": "Earlier in this conversation:\n" + "\n".join(self.summary)})
+        for question, answer in self.turns:
+            messages.append({"role": "user", "content": question})
+            messages.append({"role": "assistant", "content": answer})
+        return messages
+
+    # Follow-ups ("and its volume?") are retrieved together with the previous question, which names the symbol
+    def retrieval_query(self, text):
+        if not self.turns:
+            return text
+        return self.turns[-1][0] + "\n" + text
+
+
+# session id -> Conversation, shared by the requests of a process
+class Conversations:
+    def __init__(self, max_sessions=max_sessions, ttl=session_ttl, budget=history_tokens):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.budget = budget
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, session_id):
+        with self.lock:
+            now = time.monotonic()
+            # the requested session is taken out first, it is never the one evicted to make room
+            conversation = self.sessions.pop(session_id, None)
+            if conversation is None or now - conversation.last_used >= self.ttl:
+                conversation = Conversation(self.budget)
+            while self.sessions:
+                oldest = next(iter(self.sessions.values()))
+                if now - oldest.last_used < self.ttl and len(self.sessions) < self.max_sessions:
+                    break
+                self.sessions.popitem(last=False)
+            conversation.last_used = now
+            self.sessions[session_id] = conversation
+            return conversation
+
+    def drop(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
@@ -0,0 +1,247 @@
+import os
+import re
+import json
+import math
+import threading
+from collections import Counter, defaultdict
+import numpy as np
+from responseCache import data_version_path, read_data_version, turkish_characters
+
+# In-process retrieval over the documents fetch.py keeps in BlobStorage/History, no search service needed:
+# a symbol / name inverted index narrows a question down to the symbols it mentions,
+# BM25 (and optionally precomputed embeddings) ranks the monthly chunks of those symbols
+
+data_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+source_folder = os.getenv("LOCAL_INDEX_SOURCE", os.path.join(data_directory, "BlobStorage", "History"))
+index_folder = os.getenv("LOCAL_INDEX_FOLDER", os.path.join(data_directory, "BlobStorage", "LocalIndex"))
+
+token_pattern = re.compile(r"[a-z0-9][a-z0-9.&-]*")
+# Words that appear in every price question and would only add noise to the name index
+stop_words = {"the", "of", "and", "inc", "inc.", "plc", "corp", "corp.", "co", "ltd", "a.s.", "as", "sa", "ag", "nv", "se",
+              "holding", "group", "company", "price", "stock", "hisse", "fiyat", "what", "is", "how", "today", "ne", "nedir",
+              "a", "i", "in", "on", "for", "to", "was", "did", "do", "this", "last", "week", "month", "day", "bugun", "ve"}
+
+
+def tokenize(text):
+    return token_pattern.findall(text.translate(turkish_characters).lower())
+
+# 'THYAO.IS' -> ['thyao.is', 'thyao'], 'BTC-USD' -> ['btc-usd', 'btc']
+def symbol_tokens(symbol):
+    symbol = symbol.lower()
+    return list(dict.fromkeys([symbol, re.split(r"[.\-]", symbol)[0]]))
+
+# Monthly chunks of one history document: (symbol, name, month, text)
+def document_chunks(document):
+    if isinstance(document, list):
+        document = document[0]
+    header = {key: value for key, value in document.items() if not key.startswith("Date: ") and key != "Analytics"}
+    months = defaultdict(list)
+    # precomputed daily close / return / moving averages, ahead of the month's raw bars
+    for date, row in sorted(document.get("Analytics", {}).get("Daily", {}).items()):
+        months[date[:7]].append(f"{date} daily | " + ", ".join(f"{key}: {value:.6g}" for key, value in row.items() if isinstance(value, float)))
+    for key in sorted(key for key in document if key.startswith("Date: ")):
+        bar = document[key]
+        date = key[len("Date: "):]
+        line = f"{date} | {bar.get('AnlikDeger')}"
+        if "Volume" in bar:
+            line += f" | {bar.get('Volume')}"
+        months[date[:7]].append(line)
+    header_text = "\n".join(f"{key}: {value}" for key, value in header.items())
+    symbol = str(header.get("Symbol", ""))
+    name = str(header.get("Name", ""))
+    return [(symbol, name, month, f"{header_text}\nMonth: {month}\n" + "\n".join(lines)) for month, lines in months.items()]
+
+def normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class LocalIndex:
+    def __init__(self, chunks, k1=1.5, b=0.75):
+        # chunks -> list of {'symbol', 'name', 'month', 'text'}
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self.embeddings = None
+        # data version (data_version.txt) the chunks were read at
+        self.version = None
+
+        self.symbol_index = defaultdict(set)
+        self.postings = defaultdict(list)
+        self.lengths = []
+        for i, chunk in enumerate(chunks):
+            for token in symbol_tokens(chunk["symbol"]):
+                self.symbol_index[token].add(i)
+            for token in tokenize(chunk["name"]):
+                if token not in stop_words:
+                    self.symbol_index[token].add(i)
+            terms = Counter(tokenize(chunk["text"]))
+            self.lengths.append(sum(terms.values()))
+            for term, count in terms.items():
+                self.postings[term].append((i, count))
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        self.idf = {term: math.log(1 + (len(chunks) - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for term, postings in self.postings.items()}
+
+    @classmethod
+    def from_folder(cls, folder=source_folder, version_path=data_version_path):
+        # read before the documents, data published meanwhile makes the index stale rather than missed
+        version = read_data_version(version_path)
+        chunks = []
+        for file_name in sorted(os.listdir(folder)):
+            if not file_name.endswith(".json"):
+                continue
+            with open(os.path.join(folder, file_name), "r", encoding="utf-8", errors="replace") as file:
+                document = json.load(file)
+            chunks.extend({"symbol": symbol, "name": name, "month": month, "text": text}
+                          for symbol, name, month, text in document_chunks(document))
+        index = cls(chunks)
+        index.version = version
+        return index
+
+    # Chunks, the data version they were read at, plus embeddings.npy, the embeddings are memory mapped when loaded back
+    def save(self, folder=index_folder):
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, "chunks.json"), "w") as file:
+            json.dump(self.chunks, file)
+        with open(os.path.join(folder, "data_version.txt"), "w") as file:
+            file.write(self.version or "")
+        embeddings_path = os.path.join(folder, "embeddings.npy")
+        if self.embeddings is not None:
+            # written aside and renamed, a process still mapping the previous file keeps reading it
+            np.save(embeddings_path + ".tmp.npy", np.asarray(self.embeddings, dtype=np.float32))
+            os.replace(embeddings_path + ".tmp.npy", embeddings_path)
+        elif os.path.exists(embeddings_path):
+            os.remove(embeddings_path)
+
+    @classmethod
+    def load(cls, folder=index_folder):
+        with open(os.path.join(folder, "chunks.json"), "r") as file:
+            index = cls(json.load(file))
+        index.version = read_data_version(os.path.join(folder, "data_version.txt")) or None
+        embeddings_path = os.path.join(folder, "embeddings.npy")
+        if os.path.exists(embeddings_path):
+            index.embeddings = np.load(embeddings_path, mmap_mode="r")
+        return index
+
+    # Precomputes normalized chunk embeddings with embed (text -> vector)
+    # Chunks whose text is unchanged in previous (an index with embeddings) keep their vector, only the others are embedded
+    def build_embeddings(self, embed, previous=None):
+        reused = {}
+        if previous is not None and previous.embeddings is not None:
+            reused = {chunk["text"]: i for i, chunk in enumerate(previous.chunks)}
+        vectors = np.array([previous.embeddings[reused[chunk["text"]]] if chunk["text"] in reused else normalize(embed(chunk["text"]))
+                            for chunk in self.chunks], dtype=np.float32)
+        self.embeddings = vectors if self.chunks else None
+
+    # Chunk ids of the symbols a question mentions by symbol or name, None if it mentions none
+    def mentioned(self, query):
+        ids = set()
+        for token in tokenize(query):
+            if token not in stop_words:
+                ids |= self.symbol_index.get(token, set())
+        return ids or None
+
+    def bm25(self, query, candidates=None):
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for i, count in self.postings[term]:
+                if candidates is not None and i not in candidates:
+                    continue
+                norm = count + self.k1 * (1 - self.b + self.b * self.lengths[i] / self.average_length)
+                scores[i] += idf * count * (self.k1 + 1) / norm
+        return scores
+
+    # Top k chunks for a question, newest month first among equal scores
+    # query_vector (normalized embedding of the question) blends in cosine similarity when embeddings are loaded
+    def search(self, query, k=5, query_vector=None, vector_weight=0.5):
+        candidates = self.mentioned(query)
+        scores = self.bm25(query, candidates)
+        if candidates is not None:
+            for i in candidates:
+                scores.setdefault(i, 0.0)
+        if query_vector is not None and self.embeddings is not None and scores:
+            ids = np.fromiter(scores, dtype=np.int64)
+            top = max(scores.values()) or 1.0
+            similarities = self.embeddings[ids] @ np.asarray(query_vector, dtype=np.float32)
+            for i, similarity in zip(ids.tolist(), similarities.tolist()):
+                scores[i] = (1 - vector_weight) * scores[i] / top + vector_weight * similarity
+        ranked = sorted(scores.items(), key=lambda item: (item[1], self.chunks[item[0]]["month"]), reverse=True)
+        return [self.chunks[i] for i, _ in ranked[:k]]
+
+    # Retrieved chunks joined into the context passed to the model
+    def context(self, query, k=5, query_vector=None):
+        return "\n\n".join(chunk["text"] for chunk in self.search(query, k, query_vector))
+
+
+# Local index of the currently published data, checked before every search like the router and the response cache:
+# the saved index is used while it was built at the current data version, otherwise the index is rebuilt
+# from the history and saved again
+# With embed (text -> vector) the chunks are embedded (only the changed ones on a rebuild) and every question
+# is embedded to blend cosine similarity into the BM25 ranking
+class CurrentIndex:
+    def __init__(self, source=source_folder, folder=index_folder, version_path=data_version_path, embed=None):
+        self.source = source
+        self.folder = folder
+        self.version_path = version_path
+        self.embed = embed
+        self.lock = threading.Lock()
+        self.index = None
+        self.refresh()
+
+    def build(self, version):
+        saved = None
+        if os.path.exists(os.path.join(self.folder, "chunks.json")):
+            saved = LocalIndex.load(self.folder)
+            if saved.version == version and (self.embed is None or saved.embeddings is not None):
+                return saved
+        index = LocalIndex.from_folder(self.source, self.version_path)
+        if self.embed is not None:
+            index.build_embeddings(self.embed, saved)
+        try:
+            index.save(self.folder)
+        except OSError as e:
+            print(f"local index could not be saved: {e}")
+        return index
+
+    def refresh(self):
+        version = read_data_version(self.version_path)
+        index = self.index
+        if index is not None and index.version == version:
+            return index
+        # one request rebuilds, concurrent ones wait for it instead of rebuilding too
+        with self.lock:
+            if self.index is None or self.index.version != version:
+                self.index = self.build(version)
+            return self.index
+
+    def query_vector(self, query, index):
+        if self.embed is None or index.embeddings is None:
+            return None
+        return normalize(self.embed(query))
+
+    def search(self, query, k=5, query_vector=None, vector_weight=0.5):
+        index = self.refresh()
+        if query_vector is None:
+            query_vector = self.query_vector(query, index)
+        return index.search(query, k, query_vector, vector_weight)
+
+    def context(self, query, k=5, query_vector=None):
+        return "\n\n".join(chunk["text"] for chunk in self.search(query, k, query_vector))
+
+
+# Builds the local index from the fetched history and saves it, ex. python localRetrieval.py
+# With AZURE_OAI_EMBEDDING_DEPLOYMENT set the chunks are embedded too, reusing the saved vectors of unchanged chunks
+if __name__ == "__main__":
+    from rag import embedding_function
+    embed = embedding_function()
+    index = LocalIndex.from_folder()
+    if embed is not None:
+        saved = LocalIndex.load() if os.path.exists(os.path.join(index_folder, "chunks.json")) else None
+        index.build_embeddings(embed, saved)
+    index.save()
+    print(f"{len(index.chunks)} chunks indexed into {index_folder}" + (" with embeddings" if embed is not None else ""))
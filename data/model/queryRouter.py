@@ -0,0 +1,219 @@
+import os
+import re
+import sys
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+from localRetrieval import tokenize, symbol_tokens, stop_words
+from responseCache import read_data_version, turkish_characters
+
+# Answers "price of X on date Y" / "% change of X this week" style questions straight from the fetched time series,
+# everything else falls through to the model
+
+data_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.append(data_directory)
+from snapshotStore import SnapshotStore
+
+snapshot_folder = os.getenv("SNAPSHOT_FOLDER", os.path.join(data_directory, "BlobStorage", "Snapshots"))
+day_seconds = 24 * 60 * 60
+
+date_patterns = [
+    (re.compile(r"\b(\d{4})-(\d{1,2})-(\d{1,2})\b"), lambda m: (m[1], m[2], m[3])),
+    (re.compile(r"\b(\d{1,2})[./](\d{1,2})[./](\d{4})\b"), lambda m: (m[3], m[2], m[1])),
+]
+price_words = {"price", "value", "close", "closing", "worth", "trading", "fiyat", "fiyati", "deger", "degeri", "kapanis", "kac"}
+change_words = {"change", "changed", "return", "perform", "performance", "move", "moved", "up", "down", "gain", "loss", "%", "percent",
+                "degisim", "degisti", "yuzde", "getiri", "artti", "dustu"}
+high_words = {"high", "highest", "max", "maximum", "peak", "yuksek", "zirve"}
+low_words = {"low", "lowest", "min", "minimum", "dusuk", "dip"}
+volume_words = {"volume", "hacim", "hacmi"}
+# Words that make a question open-ended even when it mentions a symbol and a number
+open_words = {"why", "should", "predict", "forecast", "recommend", "compare", "news", "neden", "tahmin", "oneri", "almali", "satmali"}
+query_words = price_words | change_words | high_words | low_words | volume_words | open_words
+# Ticker as written in the question, '$' prefixed or not ('AAPL', '$all', 'THYAO.IS')
+ticker_pattern = re.compile(r"\$?[A-Za-z0-9][A-Za-z0-9.\-]*")
+
+
+# Per-symbol aggregates precomputed from the hourly bars (whose value is the bar's opening price, not a true OHLC):
+# last hourly price of each day, first one, hourly extremes, daily returns of the last prices, rolling min/max
+class SymbolAggregates:
+    def __init__(self, bars, rolling_days=5):
+        days = bars['ts'] // day_seconds
+        valid = ~np.isnan(bars['value'])
+        days, values, volumes = days[valid], bars['value'][valid], bars['volume'][valid]
+        ends = np.r_[np.flatnonzero(np.diff(days)), len(days) - 1] if len(days) else np.empty(0, dtype=np.int64)
+        starts = np.r_[0, ends[:-1] + 1] if len(ends) else ends
+
+        self.days = days[ends]
+        self.close = values[ends]
+        self.open = values[starts]
+        self.high = np.maximum.reduceat(values, starts) if len(starts) else values[:0]
+        self.low = np.minimum.reduceat(values, starts) if len(starts) else values[:0]
+        self.volume = np.add.reduceat(np.nan_to_num(volumes), starts) if len(starts) else values[:0]
+        self.returns = np.diff(self.close) / self.close[:-1] if len(self.close) > 1 else values[:0]
+        if len(self.close) >= rolling_days:
+            windows = np.lib.stride_tricks.sliding_window_view(self.close, rolling_days)
+            self.rolling_min, self.rolling_max = windows.min(axis=1), windows.max(axis=1)
+        else:
+            self.rolling_min = self.rolling_max = self.close[:0]
+
+    def day_index(self, date, before=True):
+        day = np.datetime64(date, 'D').astype(np.int64)
+        i = np.searchsorted(self.days, day, side='right' if before else 'left')
+        return i - 1 if before else i
+
+    @staticmethod
+    def day_string(day):
+        return str(np.datetime64(int(day), 'D'))
+
+
+# Symbol / name lookup and aggregates of every stored symbol at one data version
+# Built in full before the router swaps it in, routes running on other threads keep using the one they started with
+class SymbolLookup:
+    def __init__(self, store, version):
+        self.store = store
+        self.version = version
+        self.aggregates = {}
+        self.headers = {}
+        self.tickers = {}
+        self.names = {}
+        for symbol in store.symbols():
+            header = store.header(symbol)
+            self.headers[symbol] = header
+            # currencies are stored under their EVDS code and asked about by their display symbol ('USD')
+            for token in symbol_tokens(symbol) + symbol_tokens(str(header.get("Symbol", symbol))):
+                self.tickers.setdefault(token, symbol)
+            for token in tokenize(str(header.get("Name", ""))):
+                if token not in stop_words:
+                    self.names.setdefault(token, symbol)
+
+    # computed on first use, two threads asking at once may both compute it and keep either
+    def symbol_aggregates(self, symbol):
+        aggregates = self.aggregates.get(symbol)
+        if aggregates is None:
+            aggregates = self.aggregates.setdefault(symbol, SymbolAggregates(self.store.read(symbol)))
+        return aggregates
+
+    # Tickers only count when written as one, in capitals or with a '$' ('ALL', '$all'), so 'all Apple shares' is Apple
+    # Names match in any case; a lowercase word is only taken for a ticker when no name matched
+    # and it is too long to be an ordinary short word ('thyao', not 'now' or 'all')
+    def find_symbol(self, text, words):
+        for token in ticker_pattern.findall(text):
+            bare = token.lstrip("$").rstrip(".-")
+            if (token.startswith("$") or (bare.isupper() and len(bare) >= 2)) and bare.lower() in self.tickers:
+                return self.tickers[bare.lower()]
+        for word in words:
+            if word not in stop_words and word in self.names:
+                return self.names[word]
+        for word in words:
+            if len(word) >= 4 and word not in stop_words and word not in query_words and word in self.tickers:
+                return self.tickers[word]
+        return None
+
+
+class QueryRouter:
+    def __init__(self, store=None):
+        self.store = store or SnapshotStore(snapshot_folder)
+        self.lock = threading.Lock()
+        self.lookup = None
+        self.load()
+
+    # Rebuilt when new data is published
+    def load(self):
+        self.lookup = SymbolLookup(self.store, read_data_version())
+
+    # Lookup of the current data version, one thread rebuilds it while the others wait like ResponseCache / CurrentIndex
+    def current(self):
+        version = read_data_version()
+        if self.lookup.version != version:
+            with self.lock:
+                if self.lookup.version != version:
+                    self.load()
+        return self.lookup
+
+    @staticmethod
+    def find_date(text):
+        for pattern, parts in date_patterns:
+            match = pattern.search(text)
+            if match:
+                year, month, day = parts(match)
+                try:
+                    return datetime(int(year), int(month), int(day)).strftime("%Y-%m-%d")
+                except ValueError:
+                    return None
+        return None
+
+    # First day of the period a question asks about, relative to the symbol's last stored day
+    @staticmethod
+    def period_start(text, last_day):
+        last = datetime.strptime(last_day, "%Y-%m-%d")
+        match = re.search(r"(?:last|past|son)\s+(\d+)\s+(?:days?|gun|gunde|gunluk)", text)
+        if match:
+            return (last - timedelta(days=int(match[1]) - 1)).strftime("%Y-%m-%d"), f"last {match[1]} days"
+        if re.search(r"this week|bu hafta", text):
+            return (last - timedelta(days=last.weekday())).strftime("%Y-%m-%d"), "this week"
+        if re.search(r"last week|gecen hafta", text):
+            return (last - timedelta(days=7)).strftime("%Y-%m-%d"), "the last 7 days"
+        if re.search(r"this month|bu ay", text):
+            return last.strftime("%Y-%m-01"), "this month"
+        if re.search(r"this year|bu yil|ytd", text):
+            return last.strftime("%Y-01-01"), "this year"
+        if re.search(r"today|bugun|daily|gunluk", text):
+            return last_day, "today"
+        return None, None
+
+    # Direct answer of a numeric question, None when it has to go to the model
+    def route(self, text):
+        normalized = text.translate(turkish_characters).lower()
+        words = tokenize(normalized) + re.findall(r"%", normalized)
+        word_set = set(words)
+        if word_set & open_words:
+            return None
+        lookup = self.current()
+        symbol = lookup.find_symbol(text.translate(turkish_characters), words)
+        if symbol is None:
+            return None
+        aggregates = lookup.symbol_aggregates(symbol)
+        if len(aggregates.days) == 0:
+            return None
+
+        header = lookup.headers[symbol]
+        name = " ".join(str(part) for part in (header.get("Name", symbol), header.get("Action")) if part)
+        display = header.get("Symbol", symbol)
+        last_day = aggregates.day_string(aggregates.days[-1])
+        date = self.find_date(normalized)
+
+        if word_set & (change_words | high_words | low_words | volume_words):
+            start, label = self.period_start(normalized, last_day)
+            if start is None:
+                return None
+            i = aggregates.day_index(start, before=False)
+            if i >= len(aggregates.days):
+                return None
+            # "today" compares with the previous day's last price, other periods with the first day's first price
+            base = aggregates.close[i - 1] if label == "today" and i > 0 else aggregates.open[i]
+            close = aggregates.close[-1]
+            if word_set & high_words:
+                return f"{name} ({display}) highest hourly price {label} ({start} - {last_day}): {aggregates.high[i:].max():.4f}"
+            if word_set & low_words:
+                return f"{name} ({display}) lowest hourly price {label} ({start} - {last_day}): {aggregates.low[i:].min():.4f}"
+            if word_set & volume_words:
+                return f"{name} ({display}) total volume {label} ({start} - {last_day}): {aggregates.volume[i:].sum():,.0f}"
+            change = (close - base) / base * 100 if base else float("nan")
+            return f"{name} ({display}) changed {change:+.2f}% {label} ({start} - {last_day}), from {base:.4f} to the last hourly price {close:.4f}"
+
+        if word_set & price_words:
+            if date is None:
+                answer = f"{name} ({display}) last hourly price on {last_day}: {aggregates.close[-1]:.4f}"
+                if len(aggregates.returns):
+                    answer += f", {aggregates.returns[-1] * 100:+.2f}% on the previous day"
+                if len(aggregates.rolling_min):
+                    answer += f", 5 day range of the last hourly prices {aggregates.rolling_min[-1]:.4f} - {aggregates.rolling_max[-1]:.4f}"
+                return answer
+            i = aggregates.day_index(date)
+            if i < 0:
+                return None
+            day = aggregates.day_string(aggregates.days[i])
+            note = "" if day == date else f" (no data on {date}, last trading day before it)"
+            return f"{name} ({display}) price on {day}{note}: last hourly price {aggregates.close[i]:.4f}, hourly range {aggregates.low[i]:.4f} - {aggregates.high[i]:.4f}"
+        return None
@@ -4,58 +4,174 @@ import dotenv
 import logging
 import re
 import json
+import time
+from responseCache import ResponseCache
+from localRetrieval import CurrentIndex
+from queryRouter import QueryRouter
+from conversationContext import Conversation, assemble_context, max_tokens_for, context_tokens
 
 dotenv.load_dotenv()
 
 endpoint = os.getenv("AZURE_OAI_ENDPOINT")
 api_key = os.getenv("AZURE_OAI_KEY")
 deployment = os.getenv("AZURE_OAI_DEPLOYMENT")
+embedding_deployment = os.getenv("AZURE_OAI_EMBEDDING_DEPLOYMENT")
 promt = os.getenv("SystemPromt")
 client = openai.AzureOpenAI(base_url=f"{endpoint}/openai/deployments/{deployment}/extensions",
                             api_key= api_key,
                             api_version="2023-08-01-preview")
 
+# 'search' lets Azure OpenAI query the AZURE_SEARCH_* index, 'local' builds the context from localRetrieval.py
+retrieval = os.getenv("RAG_RETRIEVAL", "search")
+retrieval_chunks = int(os.getenv("RAG_RETRIEVAL_CHUNKS", "5"))
+
+# [docN] citation markers the search data source adds to answers, removed before they are shown
+citation_pattern = re.compile(r"\[doc\d*\]")
+
+# '0' sends numeric price / change questions to the model too instead of answering them from the fetched data
+query_router = os.getenv("RAG_QUERY_ROUTER", "1") == "1"
+
+# Response cache settings, RAG_CACHE_SIMILARITY also matches differently worded questions through embeddings
+cache_size = int(os.getenv("RAG_CACHE_SIZE", "1024"))
+cache_ttl = float(os.getenv("RAG_CACHE_TTL", str(24 * 60 * 60)))
+cache_similarity = os.getenv("RAG_CACHE_SIMILARITY")
+
+# text -> embedding vector through the AZURE_OAI_EMBEDDING_DEPLOYMENT deployment, None if it is not configured
+def embedding_function():
+    if not embedding_deployment:
+        return None
+    embedding_client = openai.AzureOpenAI(azure_endpoint=endpoint, api_key=api_key, api_version="2023-05-15")
+    def embed(text):
+        return embedding_client.embeddings.create(model=embedding_deployment, input=text).data[0].embedding
+    return embed
+
+# Plain chat completions client for prompts that carry their own context
+def create_local_client():
+    return openai.AzureOpenAI(azure_endpoint=endpoint, api_key=api_key, api_version="2024-02-01")
+
+# Follows data_version.txt, a saved index of older data is rebuilt from the history
+# With AZURE_OAI_EMBEDDING_DEPLOYMENT set, chunks and questions are embedded and similarity is blended into the ranking
+def load_retriever():
+    return CurrentIndex(embed=embedding_function())
+
+def create_cache():
+    if cache_similarity:
+        return ResponseCache(cache_size, cache_ttl, embedding_function(), float(cache_similarity))
+    return ResponseCache(cache_size, cache_ttl)
+
+# Keyword arguments of chat.completions.create for a prompt
+# With a context (local retrieval) it is sent in the messages instead of going through the search data source
+# history -> earlier turns of the session (Conversation.messages()), max_tokens defaults to the size the question type needs
+def build_request(text, context=None, history=(), max_tokens=None):
+    max_tokens = max_tokens or max_tokens_for(text)
+    if context is not None:
+        return dict(
+                model = deployment,
+                temperature= 0.7,
+                max_tokens= max_tokens,
+                top_p=0.95,
+                messages = [
+                    {"role":"system", "content": promt},
+                    {"role":"system", "content": "Market data:\n" + context},
+                    *history,
+                    {"role":"user", "content": text},
+                ]
+            )
+    return dict(
+                model = deployment,
+                temperature= 0.7,
+                max_tokens= max_tokens,
+                top_p=0.95,
+                messages = [
+                    {
+                        "role":"system",
+                        "content": promt
+
+                    },
+                    *history,
+                    {   
+                        "role":"user",
+                        "content": text
+                    },
+                ],
+                extra_body={
+                    "dataSources":[
+                        {
+                            "type":"AzureCognitiveSearch",
+                            "parameters":{
+                                "endpoint": os.environ["AZURE_SEARCH_ENDPOINT"],
+                                "key": os.environ["AZURE_SEARCH_KEY"],
+                                "indexName": os.environ["AZURE_SEARCH_INDEX"],
+                                "query_type": "semantic",
+                                "semanticConfiguration":"Config",
+                                # the search data source's context is bounded by its number of documents
+                                "topNDocuments": retrieval_chunks
+                            }
+                        }
+                    ]
+                }
+            )
+
+def complete(text, completion_client=client, context=None, history=()):
+    response = completion_client.chat.completions.create(**build_request(text, context, history))
+    content = response.choices[0].message.content
+    content = citation_pattern.sub("", content) # reference removal [docN]
+    return content
+
+# Market data of a question from the local index: twice the chunks asked for are ranked,
+# repeated ones are dropped and the rest kept within the RAG_CONTEXT_TOKENS budget
+def retrieve_context(retriever, query):
+    return assemble_context(retriever.search(query, retrieval_chunks * 2), context_tokens, retrieval_chunks)
+
+# Answer of a prompt, from the cache when the same question was answered since the last data refresh
+# With a router numeric questions are answered from the fetched data, with a retriever the context is assembled locally
+# With a conversation the earlier turns of the session are sent along (within their token budget) and the answer is added to it,
+# follow-ups are not answered from the cache since the same words can ask something else there
+def ask(text, completion_client=client, cache=None, retriever=None, router=None, conversation=None):
+    if router is not None:
+        answer = router.route(text)
+        if answer is not None:
+            if conversation is not None:
+                conversation.add(text, answer)
+            return answer
+
+    use_cache = cache is not None and (conversation is None or not conversation.turns)
+    if use_cache:
+        cached = cache.get(text)
+        if cached is not None:
+            if conversation is not None:
+                conversation.add(text, cached)
+            return cached
+
+    start = time.perf_counter()
+    query = conversation.retrieval_query(text) if conversation is not None else text
+    context = retrieve_context(retriever, query) if retriever is not None else None
+    history = conversation.messages() if conversation is not None else []
+    content = complete(text, completion_client, context, history)
+    if use_cache:
+        cache.put(text, content, time.perf_counter() - start)
+    if conversation is not None:
+        conversation.add(text, content)
+    return content
+
 def main():
+    cache = create_cache()
+    retriever = None
+    router = QueryRouter() if query_router else None
+    completion_client = client
+    conversation = Conversation()
+    if retrieval == "local":
+        retriever = load_retriever()
+        completion_client = create_local_client()
     try:
         while True:
             text = input("\nEnter the prompt:\n")
             if text.lower() == "exit":
                 print("Exiting...")
+                print(f"Cache: {json.dumps(cache.stats())}")
                 break
             
-            response = client.chat.completions.create(
-                        model = deployment,
-                        temperature= 0.7,
-                        max_tokens= 4096,
-                        top_p=0.95,
-                        messages = [
-                            {
-                                "role":"system",
-                                "content": promt
-
-                            },
-                            {   
-                                "role":"user",
-                                "content": text
-                            },
-                        ],
-                        extra_body={
-                            "dataSources":[
-                                {
-                                    "type":"AzureCognitiveSearch",
-                                    "parameters":{
-                                        "endpoint": os.environ["AZURE_SEARCH_ENDPOINT"],
-                                        "key": os.environ["AZURE_SEARCH_KEY"],
-                                        "indexName": os.environ["AZURE_SEARCH_INDEX"],
-                                        "query_type": "semantic",
-                                        "semanticConfiguration":"Config"
-                                    }
-                                }
-                            ]
-                        }
-                    )
-            content = response.choices[0].message.content
-            content = re.sub(r"\[doc.*\]", "", content) # reference removal [doc.]
+            content = ask(text, completion_client, cache, retriever, router, conversation)
             print(content)
 
     except Exception as e:
@@ -63,4 +179,4 @@ def main():
         print(e)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
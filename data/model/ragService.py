@@ -0,0 +1,167 @@
+import os
+import re
+import json
+import time
+import asyncio
+import statistics
+from collections import deque
+import openai
+from rag import endpoint, api_key, deployment, build_request, create_cache, retrieval, load_retriever, query_router, retrieve_context, citation_pattern
+from queryRouter import QueryRouter
+from conversationContext import Conversations
+
+# Async, streaming version of rag.py: tokens are printed as they arrive and many sessions share one client
+
+max_concurrency = int(os.getenv("RAG_MAX_CONCURRENCY", "32"))
+
+# Text that may still turn into a citation marker once the next piece arrives
+citation_prefix_pattern = re.compile(r"\[(d(o(c\d*)?)?)?")
+
+
+# Removes [docN] citation markers from a stream of text pieces, markers may be split across pieces
+class CitationStripper:
+    def __init__(self):
+        self.pending = ""
+
+    def feed(self, text):
+        buffer = self.pending + text
+        self.pending = ""
+        output = []
+        i = 0
+        while i < len(buffer):
+            start = buffer.find("[", i)
+            if start == -1:
+                output.append(buffer[i:])
+                break
+            output.append(buffer[i:start])
+            end = buffer.find("]", start)
+            if end == -1:
+                if citation_prefix_pattern.fullmatch(buffer[start:]):
+                    self.pending = buffer[start:]
+                    break
+            elif citation_pattern.fullmatch(buffer[start:end + 1]):
+                i = end + 1
+                continue
+            output.append("[")
+            i = start + 1
+        return "".join(output)
+
+    def flush(self):
+        rest = self.pending
+        self.pending = ""
+        return rest
+
+
+def chunk_text(chunk):
+    if not chunk.choices:
+        return None
+    return getattr(chunk.choices[0].delta, "content", None)
+
+def percentile(values, q):
+    if not values:
+        return None
+    return statistics.quantiles(values, n=100, method="inclusive")[q - 1] if len(values) > 1 else values[0]
+
+
+# Serves concurrent RAG sessions from one pooled async client, at most max_concurrency requests in flight
+class RagService:
+    def __init__(self, completion_client=None, max_concurrency=max_concurrency, cache=None, retriever=None, router=None):
+        if completion_client is None and retriever is not None:
+            completion_client = openai.AsyncAzureOpenAI(azure_endpoint=endpoint, api_key=api_key, api_version="2024-02-01")
+        self.client = completion_client or openai.AsyncAzureOpenAI(base_url=f"{endpoint}/openai/deployments/{deployment}/extensions",
+                                                                    api_key=api_key,
+                                                                    api_version="2023-08-01-preview")
+        self.retriever = retriever
+        self.router = router
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.cache = cache
+        self.conversations = Conversations()
+        self.time_to_first_token = deque(maxlen=1000)
+        self.durations = deque(maxlen=1000)
+
+    # Yields the answer piece by piece as the model streams it, citation markers removed
+    # Requests of the same session share their history like rag.ask's conversation
+    # The router, the cache (an embedding request with RAG_CACHE_SIMILARITY) and local retrieval are blocking calls,
+    # they run on worker threads so the other sessions keep streaming meanwhile
+    async def stream(self, text, session=None):
+        conversation = self.conversations.get(session) if session is not None else None
+        if self.router is not None:
+            answer = await asyncio.to_thread(self.router.route, text)
+            if answer is not None:
+                if conversation is not None:
+                    conversation.add(text, answer)
+                yield answer
+                return
+
+        use_cache = self.cache is not None and (conversation is None or not conversation.turns)
+        if use_cache:
+            cached = await asyncio.to_thread(self.cache.get, text)
+            if cached is not None:
+                if conversation is not None:
+                    conversation.add(text, cached)
+                yield cached
+                return
+
+        async with self.semaphore:
+            start = time.perf_counter()
+            first = None
+            parts = []
+            stripper = CitationStripper()
+            query = conversation.retrieval_query(text) if conversation is not None else text
+            context = await asyncio.to_thread(retrieve_context, self.retriever, query) if self.retriever is not None else None
+            history = conversation.messages() if conversation is not None else []
+            response = await self.client.chat.completions.create(stream=True, **build_request(text, context, history))
+            async for chunk in response:
+                piece = chunk_text(chunk)
+                if not piece:
+                    continue
+                piece = stripper.feed(piece)
+                if not piece:
+                    continue
+                if first is None:
+                    first = time.perf_counter() - start
+                    self.time_to_first_token.append(first)
+                parts.append(piece)
+                yield piece
+            rest = stripper.flush()
+            if rest:
+                parts.append(rest)
+                yield rest
+            elapsed = time.perf_counter() - start
+            self.durations.append(elapsed)
+
+        if use_cache:
+            await asyncio.to_thread(self.cache.put, text, "".join(parts), elapsed)
+        if conversation is not None:
+            conversation.add(text, "".join(parts))
+
+    async def answer(self, text, session=None):
+        return "".join([piece async for piece in self.stream(text, session)])
+
+    def metrics(self):
+        ttft = list(self.time_to_first_token)
+        durations = list(self.durations)
+        return {
+            "requests": len(durations),
+            "ttft_p50": percentile(ttft, 50),
+            "ttft_p95": percentile(ttft, 95),
+            "duration_p50": percentile(durations, 50),
+            "duration_p95": percentile(durations, 95),
+        }
+
+
+async def main():
+    service = RagService(cache=create_cache(), retriever=load_retriever() if retrieval == "local" else None,
+                         router=QueryRouter() if query_router else None)
+    while True:
+        text = await asyncio.to_thread(input, "\nEnter the prompt:\n")
+        if text.lower() == "exit":
+            print("Exiting...")
+            print(json.dumps(service.metrics()))
+            break
+        async for piece in service.stream(text, session="console"):
+            print(piece, end="", flush=True)
+        print()
+
+if __name__ == "__main__":
+    asyncio.run(main())
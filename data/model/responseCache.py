@@ -0,0 +1,116 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+# Written by the indexing step whenever new data is published, a change empties the cache
+data_version_path = os.getenv("DATA_VERSION_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "data_version.txt"))
+
+turkish_characters = str.maketrans("ıİğĞüÜşŞöÖçÇ", "iIgGuUsSoOcC")
+
+
+# Same question asked with different casing, punctuation, spacing or Turkish characters maps to the same key
+def normalize_prompt(text):
+    text = text.translate(turkish_characters).lower()
+    text = re.sub(r"[^\w\s%&.-]", " ", text)
+    text = re.sub(r"\s+", " ", text)
+    return text.strip(" .")
+
+def read_data_version(path=data_version_path):
+    try:
+        with open(path, "r") as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+# LRU cache of model responses keyed on the normalized prompt
+# With embed (text -> vector) a miss falls back to the most similar cached prompt above similarity_threshold
+# Entries expire after ttl seconds and the whole cache is dropped when the data version changes
+class ResponseCache:
+    def __init__(self, max_entries=1024, ttl=24 * 60 * 60, embed=None, similarity_threshold=0.95, version_path=data_version_path):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.embed = embed
+        self.similarity_threshold = similarity_threshold
+        self.version_path = version_path
+        self.version = read_data_version(version_path)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+
+    def check_version(self):
+        version = read_data_version(self.version_path)
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+
+    def expire(self):
+        now = time.monotonic()
+        for key in [key for key, entry in self.entries.items() if now - entry["created"] > self.ttl]:
+            del self.entries[key]
+
+    def most_similar(self, vector):
+        keys = [key for key, entry in self.entries.items() if entry["vector"] is not None]
+        if not keys:
+            return None
+        similarities = np.stack([self.entries[key]["vector"] for key in keys]) @ vector
+        best = int(np.argmax(similarities))
+        return keys[best] if similarities[best] >= self.similarity_threshold else None
+
+    def vector(self, key):
+        if self.embed is None:
+            return None
+        vector = np.asarray(self.embed(key), dtype=float)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    # Cached response of a prompt, None on a miss
+    def get(self, prompt):
+        key = normalize_prompt(prompt)
+        with self.lock:
+            self.check_version()
+            self.expire()
+            similarity_lookup = key not in self.entries and self.embed is not None and bool(self.entries)
+        if similarity_lookup:
+            # embedding is a remote call, it runs outside the lock
+            vector = self.vector(key)
+            with self.lock:
+                if key not in self.entries:
+                    key = self.most_similar(vector)
+        with self.lock:
+            entry = self.entries.get(key) if key is not None else None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.seconds_saved += entry["latency"]
+            return entry["response"]
+
+    # latency -> seconds the response took, reported as saved on every hit
+    def put(self, prompt, response, latency=0.0):
+        key = normalize_prompt(prompt)
+        vector = self.vector(key)
+        with self.lock:
+            self.check_version()
+            self.entries[key] = {"response": response, "created": time.monotonic(), "latency": latency, "vector": vector}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "seconds_saved": self.seconds_saved,
+            }
@@ -0,0 +1,161 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timedelta
+from pathlib import Path
+import pytz
+
+
+# Last completed run, used to catch up on runs missed while the scheduler was down
+SCHEDULE_STATE_PATH = Path(os.getenv("SCHEDULE_STATE_PATH", "BlobStorage/schedule_state.json"))
+# Longest single sleep, the next due time is recomputed after it (clock changes, suspended hosts)
+MAX_SLEEP = 3600
+
+
+# One step of a run, started once every stage in after has finished
+# A failed optional stage is reported but does not stop the stages depending on it
+class Stage:
+    def __init__(self, name, fn, after=(), optional=False):
+        self.name = name
+        self.fn = fn
+        self.after = tuple(after)
+        self.optional = optional
+
+
+# Runs stages as a dependency DAG, independent stages in parallel
+# Returns dict of stage name -> {'status': 'ok' | 'failed' | 'skipped', 'duration': seconds, 'error': ...}
+def runStages(stages, max_workers=None):
+    stages = {stage.name: stage for stage in stages}
+    for stage in stages.values():
+        missing = [name for name in stage.after if name not in stages]
+        if missing:
+            raise ValueError(f"stage {stage.name} depends on unknown stages {missing}")
+
+    report = {}
+    pending = dict(stages)
+    running = {}
+
+    def timed(stage):
+        start = time.perf_counter()
+        try:
+            stage.fn()
+        finally:
+            report[stage.name] = {'duration': round(time.perf_counter() - start, 3)}
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(stages) or 1, thread_name_prefix="stage") as pool:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if any(dependency in pending or dependency in running.values() for dependency in stage.after):
+                    continue
+                del pending[name]
+                blocked = [dependency for dependency in stage.after
+                           if report[dependency]['status'] != 'ok' and not stages[dependency].optional]
+                if blocked:
+                    report[name] = {'status': 'skipped', 'duration': 0.0, 'error': f"{', '.join(blocked)} did not finish"}
+                    print(f"stage {name} skipped, {', '.join(blocked)} did not finish")
+                    continue
+                running[pool.submit(timed, stage)] = name
+
+            if not running:
+                if pending:
+                    raise ValueError(f"stages {list(pending)} have a dependency cycle")
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                error = future.exception()
+                report[name]['status'] = 'ok' if error is None else 'failed'
+                if error is not None:
+                    report[name]['error'] = str(error)
+                print(f"stage {name} {report[name]['status']} in {report[name]['duration']:.1f}s")
+    return report
+
+
+# Runs job at a time of day on the given weekdays (0 = monday), sleeping until the next due time
+# Runs never overlap: a run requested while one is in progress is dropped
+class Scheduler:
+    def __init__(self, job, at="23:30", days=(0, 1, 2, 3, 4), timezone="Europe/Istanbul", state_path=SCHEDULE_STATE_PATH):
+        self.job = job
+        self.at = datetime.strptime(at, "%H:%M").time()
+        self.days = set(days)
+        self.timezone = pytz.timezone(timezone)
+        self.state_path = Path(state_path)
+        self.running = threading.Lock()
+        self.wake = threading.Event()
+        self.requested = False
+        self.stopped = False
+
+    def now(self):
+        return datetime.now(self.timezone)
+
+    # First due time strictly after moment
+    def nextRun(self, moment):
+        moment = moment.astimezone(self.timezone)
+        for offset in range(8):
+            day = moment.date() + timedelta(days=offset)
+            if day.weekday() not in self.days:
+                continue
+            due = self.timezone.localize(datetime.combine(day, self.at))
+            if due > moment:
+                return due
+        raise ValueError("no weekday to run on")
+
+    def lastRun(self):
+        if not self.state_path.exists():
+            return None
+        with open(self.state_path, "r") as file:
+            return datetime.fromisoformat(json.load(file)["last_run"])
+
+    def saveRun(self, started, report):
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.state_path.with_name(self.state_path.name + ".tmp")
+        with open(tmp_path, "w") as file:
+            json.dump({"last_run": started.isoformat(), "report": report}, file, indent=2, default=str)
+        os.replace(tmp_path, self.state_path)
+
+    # A due time passed since the last completed run (ex. the host was down at 23:30)
+    def missedRun(self):
+        last = self.lastRun()
+        return last is not None and self.nextRun(last) <= self.now()
+
+    def runOnce(self):
+        if not self.running.acquire(blocking=False):
+            print("a run is already in progress, skipping")
+            return None
+        try:
+            started = self.now()
+            report = self.job()
+            self.saveRun(started, report)
+            return report
+        finally:
+            self.running.release()
+
+    # Wakes the scheduler to run right away
+    def runNow(self):
+        self.requested = True
+        self.wake.set()
+
+    def stop(self):
+        self.stopped = True
+        self.wake.set()
+
+    def serveForever(self, catch_up=True):
+        if catch_up and self.missedRun():
+            print("catching up on a missed run")
+            self.runOnce()
+        due = self.nextRun(self.now())
+        print(f"next run at {due}")
+        while not self.stopped:
+            self.wake.wait(timeout=min(MAX_SLEEP, max(0.0, (due - self.now()).total_seconds())))
+            self.wake.clear()
+            if self.stopped:
+                break
+            if self.requested or self.now() >= due:
+                self.runOnce()
+                # requests made during the run are dropped, not queued
+                self.requested = False
+                self.wake.clear()
+                due = self.nextRun(self.now())
+                print(f"next run at {due}")
@@ -0,0 +1,180 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+
+# Work queue of the sharded runs, one SQLite file every worker process opens (on one machine or a shared file system)
+SHARD_QUEUE_PATH = Path(os.getenv("SHARD_QUEUE_PATH", "BlobStorage/shard_queue.sqlite"))
+# A claimed task nobody reported on for this long is handed to another worker (its worker is taken as dead)
+SHARD_LEASE_SECONDS = float(os.getenv("SHARD_LEASE_SECONDS", "1800"))
+# Claims of a failing task before it is given up as failed
+SHARD_MAX_ATTEMPTS = int(os.getenv("SHARD_MAX_ATTEMPTS", "3"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run TEXT PRIMARY KEY,
+    today TEXT NOT NULL,
+    full_backfill INTEGER NOT NULL,
+    created REAL NOT NULL,
+    indexed TEXT
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    run TEXT NOT NULL,
+    task INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    index_name TEXT,
+    is_crypto INTEGER NOT NULL DEFAULT 0,
+    symbols TEXT NOT NULL,
+    names TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    claimed REAL,
+    finished REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    PRIMARY KEY (run, task)
+);
+CREATE TABLE IF NOT EXISTS done (
+    run TEXT NOT NULL,
+    symbol TEXT NOT NULL,
+    worker TEXT NOT NULL,
+    finished REAL NOT NULL,
+    PRIMARY KEY (run, symbol)
+);
+"""
+
+
+# Tasks of a run (a slice of one universe's symbols, or the currencies) claimed by the workers one at a time,
+# with a completion marker per symbol so a task taken over from a dead worker skips what was already done
+# Every method opens its own connection, an instance can be shared by threads and each process has its own
+class ShardQueue:
+    def __init__(self, path=SHARD_QUEUE_PATH, lease=SHARD_LEASE_SECONDS, max_attempts=SHARD_MAX_ATTEMPTS, clock=time.time):
+        self.path = Path(path)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.clock = clock
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        connection = self.connect()
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+        finally:
+            connection.close()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    # BEGIN IMMEDIATE takes the write lock up front, two workers never claim the same task
+    @contextmanager
+    def transaction(self):
+        connection = self.connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    # Adds a run and its tasks, tasks -> list of {'kind', 'index', 'is_crypto', 'symbols', 'names'}
+    # Planning a run that already exists changes nothing, returns whether the run was added
+    def plan(self, run, today, tasks, full_backfill=False):
+        with self.transaction() as connection:
+            if connection.execute("SELECT 1 FROM runs WHERE run = ?", (run,)).fetchone():
+                return False
+            connection.execute("INSERT INTO runs (run, today, full_backfill, created) VALUES (?, ?, ?, ?)",
+                               (run, today, int(full_backfill), self.clock()))
+            connection.executemany(
+                "INSERT INTO tasks (run, task, kind, index_name, is_crypto, symbols, names) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(run, i, task['kind'], task.get('index'), int(task.get('is_crypto', False)),
+                  json.dumps(task.get('symbols', [])), json.dumps(task.get('names', []))) for i, task in enumerate(tasks)])
+            return True
+
+    def run(self, run):
+        with self.transaction() as connection:
+            row = connection.execute("SELECT * FROM runs WHERE run = ?", (run,)).fetchone()
+        return dict(row) if row else None
+
+    # Next pending task of the run (or one whose lease ran out) for worker, None when there is nothing left to claim
+    def claim(self, run, worker):
+        now = self.clock()
+        with self.transaction() as connection:
+            row = connection.execute(
+                "SELECT * FROM tasks WHERE run = ? AND (status = 'pending' OR (status = 'claimed' AND claimed < ?)) ORDER BY task LIMIT 1",
+                (run, now - self.lease)).fetchone()
+            if row is None:
+                return None
+            connection.execute("UPDATE tasks SET status = 'claimed', worker = ?, claimed = ?, attempts = attempts + 1 WHERE run = ? AND task = ?",
+                               (worker, now, run, row['task']))
+        task = dict(row)
+        task['symbols'] = json.loads(task['symbols'])
+        task['names'] = json.loads(task['names'])
+        task['attempts'] += 1
+        return task
+
+    # Symbols of the run already completed by any worker
+    def completed(self, run, symbols=None):
+        with self.transaction() as connection:
+            rows = connection.execute("SELECT symbol FROM done WHERE run = ?", (run,)).fetchall()
+        done = {row['symbol'] for row in rows}
+        return done if symbols is None else done.intersection(symbols)
+
+    # Completion marker of a symbol, marking it twice keeps the first one
+    # Also renews the lease of the worker's task, a worker making progress is never taken for dead
+    def markDone(self, run, task, worker, symbol):
+        now = self.clock()
+        with self.transaction() as connection:
+            connection.execute("INSERT OR IGNORE INTO done (run, symbol, worker, finished) VALUES (?, ?, ?, ?)", (run, symbol, worker, now))
+            connection.execute("UPDATE tasks SET claimed = ? WHERE run = ? AND task = ? AND worker = ? AND status = 'claimed'", (now, run, task, worker))
+
+    # Ends worker's claim on a task: done, or back to pending after an error until max_attempts claims failed
+    # Returns False when the task was taken over by another worker in the meantime
+    def finish(self, run, task, worker, error=None):
+        with self.transaction() as connection:
+            row = connection.execute("SELECT worker, status, attempts FROM tasks WHERE run = ? AND task = ?", (run, task)).fetchone()
+            if row is None or row['worker'] != worker or row['status'] != 'claimed':
+                return False
+            if error is None:
+                status = 'done'
+            else:
+                status = 'failed' if row['attempts'] >= self.max_attempts else 'pending'
+            connection.execute("UPDATE tasks SET status = ?, finished = ?, error = ? WHERE run = ? AND task = ?",
+                               (status, self.clock(), None if error is None else str(error), run, task))
+            return True
+
+    # Number of tasks per status, plus the completed symbols
+    def progress(self, run):
+        with self.transaction() as connection:
+            rows = connection.execute("SELECT status, COUNT(*) AS count FROM tasks WHERE run = ? GROUP BY status", (run,)).fetchall()
+            symbols = connection.execute("SELECT COUNT(*) FROM done WHERE run = ?", (run,)).fetchone()[0]
+        progress = {'pending': 0, 'claimed': 0, 'done': 0, 'failed': 0}
+        progress.update({row['status']: row['count'] for row in rows})
+        progress['symbols'] = symbols
+        return progress
+
+    def failures(self, run):
+        with self.transaction() as connection:
+            rows = connection.execute("SELECT task, kind, index_name, worker, attempts, error FROM tasks WHERE run = ? AND status = 'failed'", (run,)).fetchall()
+        return [dict(row) for row in rows]
+
+    # Every task of a planned run is done or failed
+    def finished(self, run):
+        progress = self.progress(run)
+        return self.run(run) is not None and progress['pending'] == 0 and progress['claimed'] == 0
+
+    # Indexing of a run is claimed once, by the first coordinator asking, and released again when it fails
+    def claimIndex(self, run, coordinator):
+        with self.transaction() as connection:
+            return connection.execute("UPDATE runs SET indexed = ? WHERE run = ? AND indexed IS NULL", (f"running {coordinator}", run)).rowcount == 1
+
+    def indexDone(self, run, ok=True):
+        with self.transaction() as connection:
+            connection.execute("UPDATE runs SET indexed = ? WHERE run = ?", (f"done {self.clock():.0f}" if ok else None, run))
@@ -0,0 +1,154 @@
+import json
+import os
+import re
+import sys
+import threading
+from pathlib import Path
+import numpy as np
+
+
+# One <symbol>.bars file of fixed size records plus a <symbol>.meta.json header per symbol
+SNAPSHOT_FOLDER = Path(os.getenv("SNAPSHOT_FOLDER", "BlobStorage/Snapshots"))
+
+# ts -> seconds since epoch of the bar's "YYYY-mm-dd HH:MM:SS" key (as written in the documents, no timezone)
+# value -> AnlikDeger, volume -> Volume (NaN for currencies)
+BAR_DTYPE = np.dtype([('ts', '<i8'), ('value', '<f8'), ('volume', '<f8')])
+
+EMPTY_BARS = np.empty(0, dtype=BAR_DTYPE)
+
+
+def safeName(symbol):
+    return re.sub(r'[^a-zA-Z0-9_.-]', '_', symbol)
+
+# 'Date: 2024-07-17 09:30:00' / 'Date: 2024-07-17' / '2024-07-17' -> epoch seconds array
+def toTimestamps(keys):
+    dates = [key[len('Date: '):] if key.startswith('Date: ') else key for key in keys]
+    return np.array(dates, dtype='datetime64[s]').astype('<i8')
+
+def fromTimestamps(ts, daily=False):
+    dates = np.datetime_as_string(ts.astype('datetime64[s]'), unit='D' if daily else 's')
+    return [date.replace('T', ' ') for date in dates]
+
+
+# Columnar local store of every fetched symbol keyed by symbol and timestamp
+# Appends are O(new bars), reads of a date range are zero-copy slices of a memory map
+class SnapshotStore:
+    def __init__(self, folder=SNAPSHOT_FOLDER):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+
+    def barsPath(self, symbol):
+        return self.folder / f"{safeName(symbol)}.bars"
+
+    def metaPath(self, symbol):
+        return self.folder / f"{safeName(symbol)}.meta.json"
+
+    # Keys the symbols were appended under (currency series are stored under their EVDS code, their 'Symbol' is 'USD')
+    # meta files written without a 'Key' fall back to their file name
+    def symbols(self):
+        symbols = []
+        for path in self.folder.glob("*.meta.json"):
+            with open(path, 'r') as file:
+                symbols.append(json.load(file).get('Key', path.name[:-len(".meta.json")]))
+        return sorted(symbols)
+
+    def header(self, symbol):
+        path = self.metaPath(symbol)
+        if not path.exists():
+            return {}
+        with open(path, 'r') as file:
+            return json.load(file)
+
+    # Appends document bars ({'Date: ...': {'AnlikDeger': .., 'Volume': ..}}) of a symbol
+    # Bars at or before the last stored one are ignored, replace=True rewrites the symbol from scratch
+    # Returns the number of bars written
+    def append(self, symbol, bars, header=None, replace=False):
+        if not bars:
+            return 0
+        keys = sorted(bars)
+        records = np.empty(len(keys), dtype=BAR_DTYPE)
+        records['ts'] = toTimestamps(keys)
+        records['value'] = np.array([bars[key].get('AnlikDeger') for key in keys], dtype=float)
+        records['volume'] = np.array([bars[key].get('Volume') for key in keys], dtype=float)
+
+        with self.lock:
+            if not replace:
+                last = self.lastTimestamp(symbol)
+                if last is not None:
+                    records = records[records['ts'] > last]
+            if len(records) == 0:
+                return 0
+            path = self.barsPath(symbol)
+            if replace or not path.exists():
+                with open(path, 'wb') as file:
+                    file.write(records.tobytes())
+            else:
+                with open(path, 'r+b') as file:
+                    # a record cut short by a crash while appending is dropped, new records start on a record boundary
+                    size = file.seek(0, os.SEEK_END)
+                    aligned = size - size % BAR_DTYPE.itemsize
+                    if aligned != size:
+                        file.truncate(aligned)
+                        file.seek(aligned)
+                    file.write(records.tobytes())
+            if header is not None or replace or not self.metaPath(symbol).exists():
+                meta = dict(header or self.header(symbol))
+                # 'Key' is what read() takes, 'Symbol' stays the header's display symbol
+                meta['Key'] = symbol
+                meta['Symbol'] = meta.get('Symbol', symbol)
+                # keys without a time (EVDS daily currencies) are exported the same way
+                meta['Daily'] = all(len(key) == len('Date: YYYY-mm-dd') for key in keys)
+                meta['HasVolume'] = any('Volume' in bars[key] for key in keys)
+                with open(self.metaPath(symbol), 'w') as file:
+                    json.dump(meta, file)
+        return len(records)
+
+    # All bars of a symbol as a read-only memory mapped record array
+    # A record cut short by a crash while appending is left out, the next append truncates it
+    def bars(self, symbol):
+        path = self.barsPath(symbol)
+        count = path.stat().st_size // BAR_DTYPE.itemsize if path.exists() else 0
+        if count == 0:
+            return EMPTY_BARS
+        return np.memmap(path, dtype=BAR_DTYPE, mode='r', shape=(count,))
+
+    def lastTimestamp(self, symbol):
+        bars = self.bars(symbol)
+        return int(bars['ts'][-1]) if len(bars) else None
+
+    # Bars between start and end (inclusive, 'YYYY-mm-dd' or 'YYYY-mm-dd HH:MM:SS'), a view on the memory map
+    def read(self, symbol, start=None, end=None):
+        bars = self.bars(symbol)
+        lo = 0 if start is None else np.searchsorted(bars['ts'], toTimestamps([start])[0], side='left')
+        if end is None:
+            hi = len(bars)
+        else:
+            end_ts = toTimestamps([end])[0]
+            # a date only end includes the whole day
+            if len(end) == len('YYYY-mm-dd'):
+                end_ts += 24 * 60 * 60 - 1
+            hi = np.searchsorted(bars['ts'], end_ts, side='right')
+        return bars[lo:hi]
+
+    # The existing json document shape ([{header..., 'Date: ...': {...}}]) for a symbol and date range
+    def toDocument(self, symbol, start=None, end=None):
+        meta = self.header(symbol)
+        bars = self.read(symbol, start, end)
+        document = {key: value for key, value in meta.items() if key not in ('Key', 'Daily', 'HasVolume')}
+        dates = fromTimestamps(bars['ts'], meta.get('Daily', False))
+        values = [None if np.isnan(value) else value for value in bars['value'].tolist()]
+        if meta.get('HasVolume', True):
+            volumes = [None if np.isnan(volume) else volume for volume in bars['volume'].tolist()]
+            for date, value, volume in zip(dates, values, volumes):
+                document['Date: ' + date] = {'AnlikDeger': value, 'Volume': volume}
+        else:
+            for date, value in zip(dates, values):
+                document['Date: ' + date] = {'AnlikDeger': value}
+        return [document]
+
+
+# Prints the json document of a symbol, ex. python snapshotStore.py AAPL 2024-08-01 2024-08-31
+if __name__ == "__main__":
+    symbol, *date_range = sys.argv[1:]
+    print(json.dumps(SnapshotStore().toDocument(symbol, *date_range), indent=2))
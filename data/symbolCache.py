@@ -0,0 +1,118 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import as_completed
+from pathlib import Path
+
+
+# Names, exchanges, currencies and index memberships of every symbol seen, plus the constituents of every universe
+SYMBOL_CACHE_PATH = Path(os.getenv("SYMBOL_CACHE_PATH", "BlobStorage/symbol_cache.json"))
+# Constituent lists are scraped again after UNIVERSE_TTL_HOURS, symbol metadata (names hardly ever change) after METADATA_TTL_HOURS
+UNIVERSE_TTL = float(os.getenv("UNIVERSE_TTL_HOURS", "168")) * 3600
+METADATA_TTL = float(os.getenv("METADATA_TTL_HOURS", "720")) * 3600
+
+
+# Persistent symbol metadata cache shared by all universe loaders of a run
+# path=None keeps it in memory only
+class SymbolCache:
+    def __init__(self, path=SYMBOL_CACHE_PATH, universe_ttl=UNIVERSE_TTL, metadata_ttl=METADATA_TTL, clock=time.time):
+        self.path = Path(path) if path is not None else None
+        self.universe_ttl = universe_ttl
+        self.metadata_ttl = metadata_ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.symbols = {}
+        self.universes = {}
+        if self.path is not None and self.path.exists():
+            with open(self.path, "r") as file:
+                cache = json.load(file)
+            self.symbols = cache.get("Symbols", {})
+            self.universes = cache.get("Universes", {})
+
+    def fresh(self, entry, ttl):
+        return entry is not None and self.clock() - entry.get("FetchedAt", 0) < ttl
+
+    def metadata(self, symbol):
+        with self.lock:
+            return dict(self.symbols.get(symbol, {}))
+
+    # Merges fields (Name, Exchange, Currency...) into a symbol's entry, index adds it to the index's members
+    def update(self, symbol, fields=None, index=None):
+        with self.lock:
+            entry = self.symbols.setdefault(symbol, {})
+            if fields:
+                entry.update({key: value for key, value in fields.items() if value is not None})
+                entry["FetchedAt"] = self.clock()
+            if index is not None and index not in entry.setdefault("Indices", []):
+                entry["Indices"].append(index)
+
+    # Metadata of every symbol, lookup(symbol) -> {'Name': ...} is only called for symbols missing or expired in the cache,
+    # concurrently on the engine's worker pool when one is given
+    # Symbols whose lookup fails keep their expired entry, those never resolved are left out of the result
+    def resolve(self, symbols, lookup, engine=None, host='yahoo'):
+        with self.lock:
+            stale = [symbol for symbol in symbols if not self.fresh(self.symbols.get(symbol), self.metadata_ttl)]
+
+        if engine is None:
+            for symbol in stale:
+                try:
+                    self.update(symbol, lookup(symbol))
+                except Exception as e:
+                    print(f"{symbol} info not found: {e}")
+        elif stale:
+            futures = {engine.submit(host, lookup, symbol): symbol for symbol in stale}
+            for future in as_completed(futures):
+                try:
+                    self.update(futures[future], future.result())
+                except Exception as e:
+                    print(f"{futures[future]} info not found: {e}")
+
+        with self.lock:
+            return {symbol: dict(self.symbols[symbol]) for symbol in symbols if self.symbols.get(symbol, {}).get("Name")}
+
+    # (symbols, names) of a universe, loader(engine, cache) is only called once the cached constituents expired
+    # If the loader fails, the expired constituents are used rather than skipping the universe
+    # describe(symbol) -> fields every member gets (Exchange, Currency...), over what the loader looked up;
+    # cached members missing any of them are described too
+    def universe(self, index, loader, engine=None, describe=None):
+        with self.lock:
+            entry = self.universes.get(index)
+            entry = dict(entry) if entry else None
+        if not self.fresh(entry, self.universe_ttl):
+            try:
+                symbols, names = loader(engine, self)
+                if not symbols:
+                    raise ValueError("no constituents found")
+            except Exception as e:
+                if not entry:
+                    raise
+                print(f"{index} constituents could not be refreshed, using the cached ones: {e}")
+            else:
+                for symbol, name in zip(symbols, names):
+                    fields = {"Name": name} if isinstance(name, str) and name else {}
+                    if describe is not None:
+                        fields.update(describe(symbol))
+                    self.update(symbol, fields or None, index)
+                with self.lock:
+                    self.universes[index] = {"Symbols": list(symbols), "FetchedAt": self.clock()}
+                return list(symbols), list(names)
+
+        if describe is not None:
+            for symbol in entry["Symbols"]:
+                fields = describe(symbol)
+                if any(key not in self.metadata(symbol) for key in fields):
+                    self.update(symbol, fields)
+        with self.lock:
+            return list(entry["Symbols"]), [self.symbols.get(symbol, {}).get("Name", symbol) for symbol in entry["Symbols"]]
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            cache = json.dumps({"Symbols": self.symbols, "Universes": self.universes}, indent=2, sort_keys=True)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as file:
+            file.write(cache)
+        os.replace(tmp_path, self.path)